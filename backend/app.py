@@ -1,16 +1,29 @@
 import base64
-import io
-import uuid
+import shutil
+import tempfile
+import time
+from concurrent import futures
+from contextlib import nullcontext
 from pathlib import Path
-from datetime import datetime, timezone, timedelta
-from flask import Flask, request, jsonify, send_from_directory
+from datetime import datetime
+import click
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
-from sqlalchemy import select, func
+from sqlalchemy import insert, select
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.exceptions import HTTPException
 
 import config
-from db import Base, engine, SessionLocal
+import metrics
+import querylog
+from db import pool_stats, set_replica_reads, use_primary
+from events import publish_exception, publish_semi_products, publish_work_order
+from exporter import EXPORTS, MIMETYPES as EXPORT_MIMETYPES, stream_export
+from importer import FORMATS, ImportFormatError, detect_format, import_material_inspections
+from json_provider import dumps, provider_class
+from labels import MAX_LABELS, label_font, needs_cjk_font, render_label_sheet
+from lineage import is_derived, link_lineage, link_lineage_many, rebuild_lineage
+from migrations import applied_versions, upgrade as schema_upgrade
 from models import (
     Material,
     Personnel,
@@ -24,72 +37,216 @@ from models import (
     MaterialReceipt,
     ProductInventoryMove,
     SemiProduct,
+    QrToken,
+    WORK_ORDER_DONE,
+    WORK_ORDER_PENDING,
+    WORK_ORDER_RUNNING,
 )
+from pagination import BadPageRequest, apply_filters, page_response, paginate
+from progress import add_progress, recompute_work_order_totals
+from qr_service import DEFAULT_BORDER, DEFAULT_BOX_SIZE, MIMETYPES, QrImageCache, job_status
+from serializers import (
+    material_to_dict,
+    personnel_to_dict,
+    product_to_dict,
+    semi_product_to_dict,
+    process_to_dict,
+    user_to_dict,
+    work_order_to_dict,
+    progress_to_dict,
+    exception_to_dict,
+    inspection_to_dict,
+    receipt_to_dict,
+    product_move_to_dict,
+    columns_of,
+    rows_to_dicts,
+)
+from services import EXTENSION, build_services, current_services, load_settings
+from stock import add_stock, consume_stock
+from tokens import TOKEN_MODELS, backfill_tokens, new_token, register_token, register_tokens, resolve_token
+from traceability import forward_trace, material_trace, product_trace, semi_trace, trace_tags
+from tracecache import material_batch_tag, wo_tag
+from versions import bump_versions, content_validators, not_modified, resource_validators, with_validators
 
 FRONTEND_DIR = Path(__file__).resolve().parent.parent / "frontend"
-app = Flask(__name__, static_folder=str(FRONTEND_DIR), static_url_path="")
-CORS(app)
-
-
-@app.errorhandler(Exception)
+# 路由、钩子与 CLI 命令都挂在蓝图上，由 create_app() 注册；导入本模块不建 app、不连数据库
+bp = Blueprint("mes", __name__, cli_group=None)
+
+
+def create_app(overrides: dict | None = None) -> Flask:
+    """Application factory (`flask --app app` finds it automatically).
+
+    overrides replaces config.py settings for this app only, e.g. {"DATABASE_URL": ...} for
+    tests and benchmarks. Engines, caches, the QR renderer and the event broker are built from
+    the result and stored on app.extensions["mes"] (see services.py); the config module is left
+    untouched. No connection is opened here: the schema is verified on the first request.
+    """
+    settings = load_settings(overrides)
+    services = build_services(settings)
+    app = Flask(__name__, static_folder=str(FRONTEND_DIR), static_url_path="")
+    app.config.from_mapping(overrides or {})
+    app.extensions[EXTENSION] = services
+    app.json = provider_class(settings["JSON_PROVIDER"])(app)
+    CORS(app, expose_headers=["X-Next-Cursor", "Link", "Server-Timing", "X-Trace-Cache"])
+    if settings["METRICS_ENABLED"]:
+        metrics.install()
+    if settings["SQL_DIAGNOSTICS"]:
+        for eng in {services.engine, services.read_engine}:
+            querylog.install(eng, settings["SLOW_QUERY_MS"])
+    app.register_blueprint(bp)
+    return app
+
+
+def db_session():
+    """A session of the current app (use as a context manager); reads may go to its replica."""
+    return current_services().session()
+
+
+@bp.app_errorhandler(Exception)
 def handle_exception(err):
     """Return JSON for all errors to avoid HTML bodies breaking frontend parsing."""
     if isinstance(err, HTTPException):
         return jsonify({"error": err.description}), err.code
-    app.logger.exception("Unhandled server error")
+    current_app.logger.exception("Unhandled server error")
     return jsonify({"error": "internal server error", "detail": str(err)}), 500
 
-# Initialize database schema if missing
-Base.metadata.create_all(bind=engine)
-
-BASE_QR_DIR = Path(__file__).resolve().parent / "qrcodes"
-TZ = timezone(timedelta(hours=8))  # UTC+8
-
-
-def format_ts(dt):
-    if not dt:
-        return None
-    # Assume stored as UTC naive; attach UTC then convert
-    if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=timezone.utc)
-    return dt.astimezone(TZ).isoformat()
 
+@bp.app_errorhandler(BadPageRequest)
+def handle_bad_page_request(err):
+    return jsonify({"error": str(err)}), 400
 
-def generate_qr_base64(data: str, category: str = "misc", filename: str | None = None) -> str:
-    import qrcode
-    from qrcode.image.pil import PilImage
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+READ_PRIMARY_COOKIE = "mes_read_primary"
 
-    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=8, border=2)
-    qr.add_data(data)
-    qr.make(fit=True)
-    # Use PIL image backend so we can save with format="PNG" without PyPNG issues
-    img: PilImage = qr.make_image(image_factory=PilImage, fill_color="black", back_color="white")
-    buffer = io.BytesIO()
-    img.save(buffer, format="PNG")
 
-    # persist to categorized folder for printing/archival
-    save_dir = BASE_QR_DIR / category
-    save_dir.mkdir(parents=True, exist_ok=True)
-    file_name = filename or f"{data}.png"
-    (save_dir / file_name).write_bytes(buffer.getvalue())
-
-    return base64.b64encode(buffer.getvalue()).decode("ascii")
-
-
-def new_token() -> str:
-    return uuid.uuid4().hex
+@bp.before_app_request
+def start_request_metrics():
+    # 最先注册，计时覆盖其余钩子
+    settings = current_services().settings
+    if settings["METRICS_ENABLED"]:
+        metrics.start_request()
+    if settings["SQL_DIAGNOSTICS"]:
+        querylog.start_request()
+
+
+@bp.after_app_request
+def add_server_timing(resp):
+    stats = metrics.current()
+    if stats is not None:
+        stats.status = resp.status_code
+        if current_services().settings["SERVER_TIMING"]:
+            resp.headers["Server-Timing"] = metrics.server_timing(stats)
+    return resp
+
+
+@bp.teardown_app_request
+def finish_request_metrics(_exc):
+    # 流式响应在输出结束后才 teardown，耗时与 SQL 计数包含整个响应体
+    metrics.finish_request(request.endpoint or "unmatched", request.method)
+    querylog.finish_request(current_services().settings["N_PLUS_ONE_THRESHOLD"])
+
+
+@bp.before_app_request
+def verify_schema():
+    # 首个请求时检查一次迁移版本（SCHEMA_AUTO_UPGRADE 时顺带升级），之后每个请求只是一次标志判断（记录在本应用的 Services 上）
+    current_services().verify_schema()
+
+
+@bp.before_app_request
+def route_reads():
+    """GET/HEAD read the replica unless the client asks for, or recently wrote and so needs, primary reads."""
+    consistent = (
+        request.method not in SAFE_METHODS
+        or request.headers.get("X-Read-Primary")
+        or request.args.get("consistent")
+        or request.cookies.get(READ_PRIMARY_COOKIE)
+    )
+    set_replica_reads(not consistent)
+
+
+@bp.after_app_request
+def pin_reads_after_write(resp):
+    # 副本有复制延迟：写成功后短时间内让该客户端继续读主库
+    services = current_services()
+    if services.read_engine is not services.engine and request.method not in SAFE_METHODS and resp.status_code < 400:
+        resp.set_cookie(READ_PRIMARY_COOKIE, "1", max_age=services.settings["READ_YOUR_WRITES_SECONDS"], httponly=True, samesite="Lax")
+    return resp
+
+
+def invalidate_traces(*tags):
+    """Drop cached traces showing any of these tokens / work orders; call right after the write commits."""
+    tags = [t for t in tags if t]
+    if tags:
+        current_services().trace_cache.invalidate(tags)
+
+
+def trace_reads(cache):
+    """Where a trace cache miss reads from: the replica like any GET, or the primary right after an invalidation.
+
+    A fill that started before an invalidation is dropped by the generation guard. One that starts after it
+    may still see a replica that has not applied the write yet, so only within READ_YOUR_WRITES_SECONDS of
+    the latest invalidation is the fill pinned to the primary.
+    """
+    services = current_services()
+    if services.read_engine is services.engine:
+        return nullcontext()
+    if time.time() - cache.invalidated_at() < services.settings["READ_YOUR_WRITES_SECONDS"]:
+        return use_primary()
+    return nullcontext()
+
+
+def trace_response(body: str, cache_status: str):
+    """Trace body with an ETag over its content: a lineage that has not changed keeps its validator and gets a 304."""
+    validators = content_validators(body)
+    resp = not_modified(validators)
+    if resp is None:
+        resp = with_validators(current_app.response_class(body, mimetype="application/json"), validators)
+    resp.headers["X-Trace-Cache"] = cache_status
+    return resp
+
+
+def cache_trace(key: str, payload: dict, since: int, extra_tags=()):
+    """Serialize a freshly built trace, store it under its lineage tags and return the response."""
+    body = dumps(payload)
+    current_services().trace_cache.put(key, body, trace_tags(payload) | set(extra_tags), since)
+    return trace_response(body, "MISS")
+
+
+def qr_payload(job, token: str) -> dict:
+    """QR fields for a response.
+
+    Default inlines the base64 PNG if the background render finishes within QR_INLINE_WAIT,
+    otherwise reports the job as pending with poll and image URLs (the record is already committed);
+    ?qr=url returns only the image URL and ?qr=async returns a job poll URL.
+    """
+    mode = request.args.get("qr")
+    if mode == "url":
+        return {"qr_image_url": f"/api/qr/{token}.png"}
+    if mode == "async" and job is not None:
+        return {"qr_status_url": f"/api/qr/jobs/{token}"}
+    if job is None:
+        png, _ = current_services().image_cache.get(token)
+        return {"qr_image_base64": base64.b64encode(png).decode("ascii")}
+    futures.wait([job], timeout=current_services().settings["QR_INLINE_WAIT"])
+    status = job_status(job)
+    if status["status"] == "done":
+        return {"qr_image_base64": status["qr_image_base64"]}
+    payload = {"qr_status": status["status"], "qr_status_url": f"/api/qr/jobs/{token}", "qr_image_url": f"/api/qr/{token}.png"}
+    if "error" in status:
+        payload["qr_error"] = status["error"]
+    return payload
 
 
 # ---- 用户 / 权限 ----
 
 
-@app.post("/api/users")
+@bp.post("/api/users")
 def create_user():
     payload = request.json or {}
     required = ["username", "name", "password", "role"]
     if not all(k in payload for k in required):
         return jsonify({"error": "Missing required fields"}), 400
-    with SessionLocal() as session:
+    with db_session() as session:
         existing = session.scalars(select(User).where(User.username == payload["username"])).first()
         if existing:
             return jsonify({"error": "Username already exists"}), 400
@@ -101,36 +258,42 @@ def create_user():
             permissions=payload.get("permissions"),
         )
         session.add(user)
+        bump_versions(session, "users")
         session.commit()
         session.refresh(user)
         return jsonify(user_to_dict(user))
 
 
-@app.post("/api/login")
+@bp.post("/api/login")
 def login():
     payload = request.json or {}
     username = payload.get("username")
     password = payload.get("password")
     if not username or not password:
         return jsonify({"error": "Missing credentials"}), 400
-    with SessionLocal() as session:
+    with db_session() as session:
         user = session.scalars(select(User).where(User.username == username, User.is_active == True)).first()
         if not user or not check_password_hash(user.password_hash, password):
             return jsonify({"error": "Invalid username or password"}), 401
         return jsonify(user_to_dict(user))
 
 
-@app.get("/api/users")
+@bp.get("/api/users")
 def list_users():
-    with SessionLocal() as session:
-        users = session.scalars(select(User)).all()
-        return jsonify([user_to_dict(u) for u in users])
+    with db_session() as session:
+        validators = resource_validators(session, ["users"])
+        cached = not_modified(validators)
+        if cached:
+            return cached
+        stmt = apply_filters(select(*columns_of(User, exclude=("password_hash",))), User, ("role",))
+        users, next_cursor = paginate(session, stmt, User, descending=False)
+        return with_validators(page_response(jsonify([user_to_dict(u) for u in users]), next_cursor), validators)
 
 
 # ---- 人员管理 ----
 
 
-@app.post("/api/personnel")
+@bp.post("/api/personnel")
 def create_personnel():
     payload = request.json or {}
     required = ["name", "employee_id", "role"]
@@ -141,14 +304,14 @@ def create_personnel():
     if payload.get("role") not in allowed_roles:
         return jsonify({"error": "role must be one of operator/qa/manager"}), 400
  
-    with SessionLocal() as session:
+    with db_session() as session:
         existing_emp = session.scalars(select(Personnel).where(Personnel.employee_id == payload["employee_id"])).first()
         if existing_emp:
             return jsonify({"error": "Employee ID already exists"}), 400
 
         qr_token = payload.get("qr_token") or new_token()
-        existing_token = session.scalars(select(Personnel).where(Personnel.qr_token == qr_token)).first()
-        if existing_token:
+        # token 在注册表全局唯一，客户端传入的 token 可能已被物料、成品等占用
+        if resolve_token(session, qr_token, current_services().token_cache):
             return jsonify({"error": "QR token already exists"}), 400
 
         person = Personnel(
@@ -159,141 +322,56 @@ def create_personnel():
             qr_token=qr_token,
         )
         session.add(person)
+        session.flush()
+        register_token(session, person.qr_token, "personnel", person.id)
+        bump_versions(session, "personnel")
         session.commit()
         session.refresh(person)
-        qr_image = generate_qr_base64(person.qr_token, category="personnel", filename=f"person_{person.id}.png")
-        return jsonify({"personnel": personnel_to_dict(person), "qr_image_base64": qr_image})
+        job = current_services().qr_service.submit(person.qr_token, category="personnel", filename=f"person_{person.id}.png")
+        return jsonify({"personnel": personnel_to_dict(person), **qr_payload(job, person.qr_token)})
 
 
-@app.get("/api/personnel")
+@bp.get("/api/personnel")
 def list_personnel():
-    with SessionLocal() as session:
-        people = session.scalars(select(Personnel).order_by(Personnel.created_at.desc())).all()
-        return jsonify([personnel_to_dict(p) for p in people])
-
-
-def material_to_dict(m: Material):
-    return {
-        "id": m.id,
-        "name": m.name,
-        "batch_code": m.batch_code,
-        "supplier": m.supplier,
-        "inspection_result": m.inspection_result,
-        "stock_qty": m.stock_qty,
-        "qr_token": m.qr_token,
-        "extra": m.extra,
-        "created_at": format_ts(m.created_at),
-    }
-
-
-def personnel_to_dict(p: Personnel):
-    return {
-        "id": p.id,
-        "name": p.name,
-        "employee_id": p.employee_id,
-        "role": p.role,
-        "allowed_operations": p.allowed_operations,
-        "qr_token": p.qr_token,
-        "created_at": format_ts(p.created_at),
-    }
-
-
-def product_to_dict(p: Product):
-    return {
-        "id": p.id,
-        "name": p.name,
-        "status": p.status,
-        "final_inspection": p.final_inspection,
-        "linked_materials": p.linked_materials,
-        "process_data": p.process_data,
-        "parent_token": p.parent_token,
-        "qty": p.qty,
-        "inspection_qr_token": p.inspection_qr_token,
-        "qr_token": p.qr_token,
-        "created_at": format_ts(p.created_at),
-    }
-
-
-def semi_product_to_dict(sp: SemiProduct):
-    return {
-        "id": sp.id,
-        "name": sp.name,
-        "stage": sp.stage,
-        "stock_qty": sp.stock_qty,
-        "parent_token": sp.parent_token,
-        "qr_token": sp.qr_token,
-        "work_order_id": sp.work_order_id,
-        "operator_id": sp.operator_id,
-        "created_at": format_ts(sp.created_at),
-    }
-
-
-def process_to_dict(p: Process):
-    return {
-        "id": p.id,
-        "name": p.name,
-        "sequence": p.sequence,
-        "description": p.description,
-        "created_at": format_ts(p.created_at),
-    }
+    with db_session() as session:
+        validators = resource_validators(session, ["personnel"])
+        cached = not_modified(validators)
+        if cached:
+            return cached
+        people, next_cursor = paginate(session, apply_filters(select(*columns_of(Personnel)), Personnel, ("role",)), Personnel)
+        return with_validators(page_response(jsonify(rows_to_dicts(people)), next_cursor), validators)
 
 
 # ---- 基础数据：工序 ----
 
 
-@app.post("/api/processes")
+@bp.post("/api/processes")
 def create_process():
     payload = request.json or {}
     if not payload.get("name"):
         return jsonify({"error": "Missing name"}), 400
-    with SessionLocal() as session:
+    with db_session() as session:
         process = Process(
             name=payload["name"],
             sequence=payload.get("sequence"),
             description=payload.get("description"),
         )
         session.add(process)
+        bump_versions(session, "processes")
         session.commit()
         session.refresh(process)
         return jsonify(process_to_dict(process))
 
 
-@app.get("/api/processes")
+@bp.get("/api/processes")
 def list_processes():
-    with SessionLocal() as session:
-        items = session.scalars(select(Process).order_by(Process.sequence)).all()
-        return jsonify([process_to_dict(p) for p in items])
-
-
-def user_to_dict(u: User):
-    return {
-        "id": u.id,
-        "username": u.username,
-        "name": u.name,
-        "role": u.role,
-        "permissions": u.permissions,
-        "is_active": u.is_active,
-        "created_at": u.created_at.isoformat(),
-    }
-
-
-def work_order_to_dict(w: WorkOrder):
-    return {
-        "id": w.id,
-        "code": w.code,
-        "product_name": w.product_name,
-        "material_batch": w.material_batch,
-        "plan_qty": w.plan_qty,
-        "line": w.line,
-        "status": w.status,
-        "planned_start": w.planned_start,
-        "planned_end": w.planned_end,
-        "qr_token": w.qr_token,
-        "completion_qr_token": w.completion_qr_token,
-        "created_by": w.created_by,
-        "notes": w.notes,
-        "created_at": format_ts(w.created_at),
-    }
+    with db_session() as session:
+        validators = resource_validators(session, ["processes"])
+        cached = not_modified(validators)
+        if cached:
+            return cached
+        items = session.execute(select(*columns_of(Process)).order_by(Process.sequence)).all()
+        return with_validators(jsonify(rows_to_dicts(items)), validators)
 
 
 def require_personnel(session, role: str, employee_id: str):
@@ -306,78 +384,14 @@ def require_personnel(session, role: str, employee_id: str):
     return person, None
 
 
-def progress_to_dict(p: WorkOrderProgress):
-    return {
-        "id": p.id,
-        "work_order_id": p.work_order_id,
-        "actual_qty": p.actual_qty,
-        "defect_qty": p.defect_qty,
-        "operator_id": p.operator_id,
-        "note": p.note,
-        "created_at": format_ts(p.created_at),
-    }
-
-
-def exception_to_dict(e: WorkOrderException):
-    return {
-        "id": e.id,
-        "work_order_id": e.work_order_id,
-        "exception_type": e.exception_type,
-        "description": e.description,
-        "action": e.action,
-        "status": e.status,
-        "resolved_at": format_ts(e.resolved_at),
-        "created_at": format_ts(e.created_at),
-    }
-
-
-def inspection_to_dict(r: InspectionRecord):
-    return {
-        "id": r.id,
-        "object_type": r.object_type,
-        "object_token": r.object_token,
-        "result": r.result,
-        "inspector": r.inspector,
-        "items": r.items,
-        "note": r.note,
-        "created_at": format_ts(r.created_at),
-    }
-
-
-def receipt_to_dict(r: MaterialReceipt):
-    return {
-        "id": r.id,
-        "material_id": r.material_id,
-        "location": r.location,
-        "qty": r.qty,
-        "operator": r.operator,
-        "created_at": format_ts(r.created_at),
-    }
-
-
-def product_move_to_dict(m: ProductInventoryMove):
-    return {
-        "id": m.id,
-        "product_id": m.product_id,
-        "product_name": m.product_name,
-        "direction": m.direction,
-        "qty": m.qty,
-        "location": m.location,
-        "order_code": m.order_code,
-        "customer": m.customer,
-        "note": m.note,
-        "created_at": format_ts(m.created_at),
-    }
-
-
-@app.post("/api/materials")
+@bp.post("/api/materials")
 def create_material():
     payload = request.json or {}
     required = ["name", "batch_code", "supplier", "inspection_result", "stock_qty"]
     if not all(k in payload for k in required):
         return jsonify({"error": "Missing required fields"}), 400
 
-    with SessionLocal() as session:
+    with db_session() as session:
         token = new_token()
         material = Material(
             name=payload["name"],
@@ -389,37 +403,50 @@ def create_material():
             extra=payload.get("extra"),
         )
         session.add(material)
+        session.flush()
+        register_token(session, token, "material", material.id)
+        bump_versions(session, "materials")
+        stale = (material_batch_tag(material.name), material_batch_tag(material.batch_code))
         session.commit()
+        invalidate_traces(*stale)
         session.refresh(material)
-        qr_image = generate_qr_base64(token, category="materials", filename=f"material_{material.id}.png")
-        return jsonify({"material": material_to_dict(material), "qr_image_base64": qr_image})
+        job = current_services().qr_service.submit(token, category="materials", filename=f"material_{material.id}.png")
+        return jsonify({"material": material_to_dict(material), **qr_payload(job, token)})
 
 
-@app.get("/api/materials")
+@bp.get("/api/materials")
 def list_materials():
-    with SessionLocal() as session:
-        items = session.scalars(select(Material)).all()
-        return jsonify([material_to_dict(m) for m in items])
+    with db_session() as session:
+        validators = resource_validators(session, ["materials"])
+        cached = not_modified(validators)
+        if cached:
+            return cached
+        stmt = apply_filters(select(*columns_of(Material)), Material, ("name", "batch_code", "supplier", "inspection_result"))
+        items, next_cursor = paginate(session, stmt, Material, descending=False)
+        return with_validators(page_response(jsonify(rows_to_dicts(items)), next_cursor), validators)
 
 
-@app.get("/api/materials/<int:material_id>")
+@bp.get("/api/materials/<int:material_id>")
 def get_material(material_id: int):
-    with SessionLocal() as session:
+    with db_session() as session:
+        validators = resource_validators(session, ["materials"])
+        cached = not_modified(validators)
+        if cached:
+            return cached
         material = session.get(Material, material_id)
         if not material:
             return jsonify({"error": "Material not found"}), 404
-        return jsonify(material_to_dict(material))
-
+        return with_validators(jsonify(material_to_dict(material)), validators)
 
 
-@app.post("/api/products")
+@bp.post("/api/products")
 def create_product():
     payload = request.json or {}
     required = ["name", "status"]
     if not all(k in payload for k in required):
         return jsonify({"error": "Missing required fields"}), 400
 
-    with SessionLocal() as session:
+    with db_session() as session:
         token = new_token()
         product = Product(
             name=payload["name"],
@@ -430,23 +457,26 @@ def create_product():
             qr_token=token,
         )
         session.add(product)
+        session.flush()
+        register_token(session, token, "product", product.id)
+        bump_versions(session, "products")
         session.commit()
         session.refresh(product)
-        qr_image = generate_qr_base64(token, category="products", filename=f"product_{product.id}.png")
-        return jsonify({"product": product_to_dict(product), "qr_image_base64": qr_image})
+        job = current_services().qr_service.submit(token, category="products", filename=f"product_{product.id}.png")
+        return jsonify({"product": product_to_dict(product), **qr_payload(job, token)})
 
 
 # ---- 生产工单 ----
 
 
-@app.post("/api/workorders")
+@bp.post("/api/workorders")
 def create_work_order():
     payload = request.json or {}
     required = ["product_name", "plan_qty", "material_name", "employee_id"]
     if not all(payload.get(k) for k in required):
         return jsonify({"error": "Missing required fields: product_name, plan_qty, material_name, employee_id"}), 400
 
-    with SessionLocal() as session:
+    with db_session() as session:
         # only manager with matching employee_id can create work order
         _, err = require_personnel(session, "manager", payload.get("employee_id"))
         if err:
@@ -464,7 +494,7 @@ def create_work_order():
             material_batch=material.name,
             plan_qty=int(payload.get("plan_qty", 0)),
             line=payload.get("line"),
-            status=payload.get("status", "待执行"),
+            status=payload.get("status", WORK_ORDER_PENDING),
             planned_start=payload.get("planned_start"),
             planned_end=payload.get("planned_end"),
             qr_token=token,
@@ -472,34 +502,32 @@ def create_work_order():
             notes=payload.get("notes"),
         )
         session.add(wo)
+        session.flush()
+        register_token(session, token, "work_order", wo.id)
+        bump_versions(session, "work_orders")
         session.commit()
         session.refresh(wo)
-        qr_image = generate_qr_base64(token, category="work_orders", filename=f"wo_{wo.id}.png")
-        return jsonify({"work_order": work_order_to_dict(wo), "qr_image_base64": qr_image})
+        publish_work_order(current_services().broker, wo)
+        job = current_services().qr_service.submit(token, category="work_orders", filename=f"wo_{wo.id}.png")
+        return jsonify({"work_order": work_order_to_dict(wo), **qr_payload(job, token)})
 
 
-@app.get("/api/workorders")
+@bp.get("/api/workorders")
 def list_work_orders():
-    with SessionLocal() as session:
-        orders = session.scalars(select(WorkOrder).order_by(WorkOrder.created_at.desc())).all()
-        result = []
-        for w in orders:
-            totals = session.execute(
-                select(func.coalesce(func.sum(WorkOrderProgress.actual_qty), 0), func.coalesce(func.sum(WorkOrderProgress.defect_qty), 0)).where(
-                    WorkOrderProgress.work_order_id == w.id
-                )
-            ).first()
-            actual_sum, defect_sum = totals if totals else (0, 0)
-            data = work_order_to_dict(w)
-            data.update({"actual_qty": int(actual_sum or 0), "defect_qty": int(defect_sum or 0)})
-            result.append(data)
-        return jsonify(result)
+    with db_session() as session:
+        validators = resource_validators(session, ["work_orders"])
+        cached = not_modified(validators)
+        if cached:
+            return cached
+        orders, next_cursor = paginate(session, apply_filters(select(*columns_of(WorkOrder)), WorkOrder, ("status", "line")), WorkOrder)
+        # actual_qty/defect_qty 为进度写入时维护的合计，无需逐单 SUM
+        return with_validators(page_response(jsonify(rows_to_dicts(orders)), next_cursor), validators)
 
 
-@app.post("/api/workorders/<int:work_order_id>/progress")
+@bp.post("/api/workorders/<int:work_order_id>/progress")
 def add_work_order_progress(work_order_id: int):
     payload = request.json or {}
-    with SessionLocal() as session:
+    with db_session() as session:
         wo = session.get(WorkOrder, work_order_id)
         if not wo:
             return jsonify({"error": "Work order not found"}), 404
@@ -527,49 +555,54 @@ def add_work_order_progress(work_order_id: int):
             material_obj = session.scalars(select(Material).where(Material.name == wo.material_batch)).first()
             if not material_obj:
                 return jsonify({"error": f"Linked material '{wo.material_batch}' not found"}), 404
-            if delta_qty > 0:
-                if (material_obj.stock_qty or 0) < delta_qty:
-                    return jsonify({"error": "Insufficient material stock"}), 400
-                material_obj.stock_qty = (material_obj.stock_qty or 0) - delta_qty
+            if not consume_stock(session, material_obj, delta_qty):
+                return jsonify({"error": "Insufficient material stock"}), 400
 
-        prog = WorkOrderProgress(
-            work_order_id=work_order_id,
+        prog = add_progress(
+            session,
+            wo,
             actual_qty=int(payload.get("actual_qty", 0)),
             defect_qty=int(payload.get("defect_qty", 0)),
             operator_id=operator_id,
             note=payload.get("note"),
         )
-        session.add(prog)
-        session.flush()  # ensure progress row is available for aggregation
-
-        # 计算累计实绩以判断完工
-        total_actual = session.execute(
-            select(func.coalesce(func.sum(WorkOrderProgress.actual_qty), 0)).where(WorkOrderProgress.work_order_id == work_order_id)
-        ).scalar_one()
-
-        if wo.status == "待执行":
-            wo.status = "执行中"
-        if wo.plan_qty and int(total_actual or 0) >= wo.plan_qty:
-            wo.status = "完成"
+
+        # 累计实绩由 add_progress 原子累加，直接据此判断完工
+        completion_issued = False
+        if wo.status == WORK_ORDER_PENDING:
+            wo.status = WORK_ORDER_RUNNING
+        if wo.plan_qty and int(wo.actual_qty or 0) >= wo.plan_qty:
+            wo.status = WORK_ORDER_DONE
             if not wo.completion_qr_token:
                 wo.completion_qr_token = new_token()
-                # generate and persist completion QR
-                generate_qr_base64(wo.completion_qr_token, category="work_order_completion", filename=f"wo_{wo.id}_completion.png")
+                register_token(session, wo.completion_qr_token, "work_order_completion", wo.id)
+                completion_issued = True
 
+        stale = (wo_tag(wo.id), material_obj.qr_token if material_obj else None)
         session.commit()
+        invalidate_traces(*stale)
         session.refresh(prog)
         session.refresh(wo)
+        publish_work_order(current_services().broker, wo)
+        if completion_issued:
+            # generate and persist completion QR outside the transaction
+            current_services().qr_service.submit(wo.completion_qr_token, category="work_order_completion", filename=f"wo_{wo.id}_completion.png")
         return jsonify({"progress": progress_to_dict(prog), "work_order": work_order_to_dict(wo)})
 
 
-@app.get("/api/workorders/<int:work_order_id>/progress")
+@bp.get("/api/workorders/<int:work_order_id>/progress")
 def list_work_order_progress(work_order_id: int):
-    with SessionLocal() as session:
-        items = session.scalars(select(WorkOrderProgress).where(WorkOrderProgress.work_order_id == work_order_id).order_by(WorkOrderProgress.created_at)).all()
-        return jsonify([progress_to_dict(p) for p in items])
+    with db_session() as session:
+        validators = resource_validators(session, ["work_order_progress"])
+        cached = not_modified(validators)
+        if cached:
+            return cached
+        stmt = apply_filters(select(*columns_of(WorkOrderProgress)).where(WorkOrderProgress.work_order_id == work_order_id), WorkOrderProgress)
+        items, next_cursor = paginate(session, stmt, WorkOrderProgress, descending=False)
+        return with_validators(page_response(jsonify(rows_to_dicts(items)), next_cursor), validators)
 
 
-@app.post("/api/process/steps")
+@bp.post("/api/process/steps")
 def process_steps():
     payload = request.json or {}
     step = payload.get("step")
@@ -583,7 +616,7 @@ def process_steps():
     if qty <= 0:
         return jsonify({"error": "qty must be > 0"}), 400
 
-    with SessionLocal() as session:
+    with db_session() as session:
         operator, err = require_personnel(session, "operator", payload.get("employee_id"))
         if err:
             return err
@@ -591,16 +624,14 @@ def process_steps():
         if not wo:
             return jsonify({"error": "Work order not found"}), 404
 
-        qr_image = None
         if step == "juice":
             if not input_token:
                 return jsonify({"error": "material qr token required for juicing"}), 400
             material = session.scalars(select(Material).where(Material.qr_token == input_token)).first()
             if not material:
                 return jsonify({"error": "material not found for token"}), 404
-            if (material.stock_qty or 0) < qty:
+            if not consume_stock(session, material, qty):
                 return jsonify({"error": "insufficient material stock"}), 400
-            material.stock_qty = (material.stock_qty or 0) - qty
             semi = SemiProduct(
                 name=f"{wo.product_name}-葡萄汁",
                 stage="juice",
@@ -612,10 +643,17 @@ def process_steps():
             )
             session.add(semi)
             session.flush()
-            qr_image = generate_qr_base64(semi.qr_token, category="semi", filename=f"semi_{semi.id}.png")
+            register_token(session, semi.qr_token, "semi_product", semi.id)
+            link_lineage(session, semi.parent_token, semi.qr_token)
+            bump_versions(session, "semi_products")
+            line = wo.line
+            stale = semi.parent_token
             session.commit()
+            invalidate_traces(stale)
             session.refresh(semi)
-            return jsonify({"semi_product": semi_product_to_dict(semi), "qr_image_base64": qr_image})
+            publish_semi_products(current_services().broker, [semi_product_to_dict(semi)], line)
+            job = current_services().qr_service.submit(semi.qr_token, category="semi", filename=f"semi_{semi.id}.png")
+            return jsonify({"semi_product": semi_product_to_dict(semi), **qr_payload(job, semi.qr_token)})
 
         if step == "ferment":
             if not input_token:
@@ -623,9 +661,8 @@ def process_steps():
             juice = session.scalars(select(SemiProduct).where(SemiProduct.qr_token == input_token, SemiProduct.stage == "juice")).first()
             if not juice:
                 return jsonify({"error": "juice semi-product not found"}), 404
-            if (juice.stock_qty or 0) < qty:
+            if not consume_stock(session, juice, qty):
                 return jsonify({"error": "insufficient juice stock"}), 400
-            juice.stock_qty = (juice.stock_qty or 0) - qty
             semi = SemiProduct(
                 name=f"{wo.product_name}-酒液",
                 stage="ferment",
@@ -637,10 +674,17 @@ def process_steps():
             )
             session.add(semi)
             session.flush()
-            qr_image = generate_qr_base64(semi.qr_token, category="semi", filename=f"semi_{semi.id}.png")
+            register_token(session, semi.qr_token, "semi_product", semi.id)
+            link_lineage(session, semi.parent_token, semi.qr_token)
+            bump_versions(session, "semi_products")
+            line = wo.line
+            stale = semi.parent_token
             session.commit()
+            invalidate_traces(stale)
             session.refresh(semi)
-            return jsonify({"semi_product": semi_product_to_dict(semi), "qr_image_base64": qr_image})
+            publish_semi_products(current_services().broker, [semi_product_to_dict(semi)], line)
+            job = current_services().qr_service.submit(semi.qr_token, category="semi", filename=f"semi_{semi.id}.png")
+            return jsonify({"semi_product": semi_product_to_dict(semi), **qr_payload(job, semi.qr_token)})
 
         # bottle -> 生成瓶装半成品，待质检入库转成成品
         if not input_token:
@@ -648,9 +692,8 @@ def process_steps():
         ferment_obj = session.scalars(select(SemiProduct).where(SemiProduct.qr_token == input_token, SemiProduct.stage == "ferment")).first()
         if not ferment_obj:
             return jsonify({"error": "ferment semi-product not found"}), 404
-        if (ferment_obj.stock_qty or 0) < qty:
+        if not consume_stock(session, ferment_obj, qty):
             return jsonify({"error": "insufficient ferment stock"}), 400
-        ferment_obj.stock_qty = (ferment_obj.stock_qty or 0) - qty
 
         bottle_semi = SemiProduct(
             name=wo.product_name,
@@ -663,18 +706,137 @@ def process_steps():
         )
         session.add(bottle_semi)
         session.flush()
-        qr_image = generate_qr_base64(bottle_semi.qr_token, category="semi", filename=f"semi_{bottle_semi.id}.png")
+        register_token(session, bottle_semi.qr_token, "semi_product", bottle_semi.id)
+        link_lineage(session, bottle_semi.parent_token, bottle_semi.qr_token)
+        bump_versions(session, "semi_products")
+        line = wo.line
+        stale = bottle_semi.parent_token
         session.commit()
+        invalidate_traces(stale)
         session.refresh(bottle_semi)
-        return jsonify({"semi_product": semi_product_to_dict(bottle_semi), "qr_image_base64": qr_image})
+        publish_semi_products(current_services().broker, [semi_product_to_dict(bottle_semi)], line)
+        job = current_services().qr_service.submit(bottle_semi.qr_token, category="semi", filename=f"semi_{bottle_semi.id}.png")
+        return jsonify({"semi_product": semi_product_to_dict(bottle_semi), **qr_payload(job, bottle_semi.qr_token)})
+
 
+# step -> (上游类型, 上游半成品阶段, 产出命名)，与 process_steps 的三段保持一致
+BATCH_STEPS = {
+    "juice": ("material", None, "{product}-葡萄汁"),
+    "ferment": ("semi_product", "juice", "{product}-酒液"),
+    "bottle": ("semi_product", "ferment", "{product}"),
+}
+MAX_BATCH_STEPS = 500
 
-@app.post("/api/workorders/<int:work_order_id>/exceptions")
+
+@bp.post("/api/process/steps/batch")
+def process_steps_batch():
+    """Run many juice/ferment/bottle steps for one operator and work order in a single transaction.
+
+    All items succeed or none do; failures are reported per item index. QR images are rendered in the
+    background after commit and exposed as qr_image_url / qr_status_url.
+    """
+    payload = request.json or {}
+    work_order_id = payload.get("work_order_id")
+    items = payload.get("steps")
+    if not work_order_id:
+        return jsonify({"error": "work_order_id is required"}), 400
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "steps must be a non-empty list"}), 400
+    if len(items) > MAX_BATCH_STEPS:
+        return jsonify({"error": f"At most {MAX_BATCH_STEPS} steps per batch"}), 400
+
+    errors = []
+    parsed = []
+    for idx, item in enumerate(items):
+        item = item if isinstance(item, dict) else {}
+        step = item.get("step")
+        try:
+            qty = int(item.get("qty", 0))
+        except (TypeError, ValueError):
+            qty = 0
+        if step not in BATCH_STEPS:
+            errors.append({"index": idx, "error": "step must be juice/ferment/bottle"})
+        elif qty <= 0:
+            errors.append({"index": idx, "error": "qty must be > 0"})
+        elif not item.get("input_token"):
+            errors.append({"index": idx, "error": "input_token is required"})
+        else:
+            parsed.append((idx, step, qty, item["input_token"]))
+    if errors:
+        return jsonify({"error": "invalid steps", "errors": errors}), 400
+
+    with db_session() as session:
+        operator, err = require_personnel(session, "operator", payload.get("employee_id"))
+        if err:
+            return err
+        wo = session.get(WorkOrder, work_order_id)
+        if not wo:
+            return jsonify({"error": "Work order not found"}), 404
+
+        input_tokens = {token for _, _, _, token in parsed}
+        materials = {m.qr_token: m for m in session.scalars(select(Material).where(Material.qr_token.in_(input_tokens)))}
+        semis = {sp.qr_token: sp for sp in session.scalars(select(SemiProduct).where(SemiProduct.qr_token.in_(input_tokens)))}
+
+        # 同一上游批次的用量合并成一次条件扣减
+        demand = {}
+        for idx, step, qty, token in parsed:
+            source_type, source_stage, _ = BATCH_STEPS[step]
+            source = materials.get(token) if source_type == "material" else semis.get(token)
+            if source is None or (source_stage and source.stage != source_stage):
+                errors.append({"index": idx, "error": f"{source_stage or 'material'} not found for input_token"})
+                continue
+            entry = demand.setdefault(token, {"source": source, "qty": 0, "items": []})
+            entry["qty"] += qty
+            entry["items"].append(idx)
+        for token, entry in demand.items():
+            if not consume_stock(session, entry["source"], entry["qty"]):
+                for idx in entry["items"]:
+                    errors.append({"index": idx, "error": f"insufficient stock on {token} (batch needs {entry['qty']})"})
+        if errors:
+            session.rollback()
+            return jsonify({"error": "batch rejected, nothing was written", "errors": sorted(errors, key=lambda e: e["index"])}), 400
+
+        rows = []
+        for _, step, qty, token in parsed:
+            rows.append(
+                {
+                    "name": BATCH_STEPS[step][2].format(product=wo.product_name),
+                    "stage": step,
+                    "stock_qty": qty,
+                    "parent_token": token,
+                    "qr_token": new_token(),
+                    "work_order_id": wo.id,
+                    "operator_id": operator.id if operator else None,
+                }
+            )
+        session.execute(insert(SemiProduct), rows)
+        new_tokens = [r["qr_token"] for r in rows]
+        created = {sp.qr_token: sp for sp in session.scalars(select(SemiProduct).where(SemiProduct.qr_token.in_(new_tokens)))}
+        register_tokens(session, [(t, "semi_product", created[t].id) for t in new_tokens])
+        link_lineage_many(session, [(r["parent_token"], r["qr_token"]) for r in rows])
+        bump_versions(session, "semi_products")
+        # 提交前序列化：新行的字段已齐全，避免提交后逐行刷新
+        items = [semi_product_to_dict(created[t]) for t in new_tokens]
+        line = wo.line
+        session.commit()
+        invalidate_traces(*demand)
+
+        publish_semi_products(current_services().broker, items, line)
+        results = []
+        for item in items:
+            current_services().qr_service.submit(item["qr_token"], category="semi", filename=f"semi_{item['id']}.png")
+            results.append(
+                {"semi_product": item, "qr_image_url": f"/api/qr/{item['qr_token']}.png", "qr_status_url": f"/api/qr/jobs/{item['qr_token']}"}
+            )
+        return jsonify({"count": len(results), "results": results})
+
+
+@bp.post("/api/workorders/<int:work_order_id>/exceptions")
 def create_work_order_exception(work_order_id: int):
     payload = request.json or {}
     if not payload.get("exception_type"):
         return jsonify({"error": "Missing exception_type"}), 400
-    with SessionLocal() as session:
+    with db_session() as session:
         _, err = require_personnel(session, "manager", payload.get("employee_id"))
         if err:
             return err
@@ -689,15 +851,17 @@ def create_work_order_exception(work_order_id: int):
             status=payload.get("status", "open"),
         )
         session.add(exc)
+        line = wo.line
         session.commit()
         session.refresh(exc)
+        publish_exception(current_services().broker, exc, line)
         return jsonify(exception_to_dict(exc))
 
 
-@app.post("/api/workorders/<int:work_order_id>/exceptions/<int:exc_id>/resolve")
+@bp.post("/api/workorders/<int:work_order_id>/exceptions/<int:exc_id>/resolve")
 def resolve_work_order_exception(work_order_id: int, exc_id: int):
     payload = request.json or {}
-    with SessionLocal() as session:
+    with db_session() as session:
         _, err = require_personnel(session, "manager", payload.get("employee_id"))
         if err:
             return err
@@ -707,15 +871,18 @@ def resolve_work_order_exception(work_order_id: int, exc_id: int):
         exc.status = payload.get("status", "resolved")
         exc.action = payload.get("action", exc.action)
         exc.resolved_at = datetime.utcnow()
+        wo = session.get(WorkOrder, work_order_id)
+        line = wo.line if wo else None
         session.commit()
         session.refresh(exc)
+        publish_exception(current_services().broker, exc, line)
         return jsonify(exception_to_dict(exc))
 
 
 # ---- 质检 / 追溯 ----
 
 
-@app.post("/api/inspections")
+@bp.post("/api/inspections")
 def create_inspection():
     payload = request.json or {}
     object_type = payload.get("object_type")
@@ -725,14 +892,13 @@ def create_inspection():
     if object_type not in {"material", "product", "semi_product"}:
         return jsonify({"error": "object_type must be material, semi_product or product"}), 400
 
-    with SessionLocal() as session:
+    with db_session() as session:
         qa_person, err = require_personnel(session, "qa", payload.get("employee_id"))
         if err:
             return err
         inspector_name = qa_person.name if qa_person else payload.get("inspector")
         if object_type == "material":
             material = None
-            qr_image = None
 
             material_id = payload.get("material_id")
             created_new = False
@@ -756,12 +922,13 @@ def create_inspection():
                 )
                 session.add(material)
                 session.flush()
+                register_token(session, token, "material", material.id)
                 created_new = True
 
             receipt_obj = None
             if payload.get("qty") is not None:
                 qty = int(payload.get("qty", 0))
-                material.stock_qty = (material.stock_qty or 0) + qty
+                add_stock(session, material, qty)
                 receipt_obj = MaterialReceipt(
                     material_id=material.id,
                     location=payload.get("location"),
@@ -779,13 +946,19 @@ def create_inspection():
                 note=payload.get("note"),
             )
             session.add(record)
+            bump_versions(session, "materials", "inspection_records")
+            stale = (material.qr_token, material_batch_tag(material.name), material_batch_tag(material.batch_code))
             session.commit()
+            invalidate_traces(*stale)
             session.refresh(record)
-            qr_image = generate_qr_base64(material.qr_token, category="materials", filename=f"material_{material.id}.png")
+            # 已有物料的二维码不变，复用缓存而不是重新编码落盘
+            job = None
+            if created_new:
+                job = current_services().qr_service.submit(material.qr_token, category="materials", filename=f"material_{material.id}.png")
             response = {
                 "inspection": inspection_to_dict(record),
                 "material": material_to_dict(material),
-                "qr_image_base64": qr_image,
+                **qr_payload(job, material.qr_token),
             }
             if receipt_obj:
                 response["receipt"] = receipt_to_dict(receipt_obj)
@@ -807,7 +980,10 @@ def create_inspection():
                 note=payload.get("note"),
             )
             session.add(record)
+            bump_versions(session, "inspection_records")
+            stale = semi.qr_token
             session.commit()
+            invalidate_traces(stale)
             session.refresh(record)
             return jsonify({"inspection": inspection_to_dict(record), "semi_product": semi_product_to_dict(semi)})
 
@@ -828,6 +1004,7 @@ def create_inspection():
             existing_product.qty = qty or existing_product.qty
             if not existing_product.inspection_qr_token:
                 existing_product.inspection_qr_token = new_token()
+                register_token(session, existing_product.inspection_qr_token, "product", existing_product.id)
             move = ProductInventoryMove(
                 product_id=existing_product.id,
                 product_name=existing_product.name,
@@ -851,26 +1028,33 @@ def create_inspection():
 
             # 完工判断沿用工单累计逻辑
             wo = session.scalars(select(WorkOrder).where(WorkOrder.code == existing_product.process_data)).first()
+            completion_issued = False
             if wo:
-                total_actual = session.execute(
-                    select(func.coalesce(func.sum(WorkOrderProgress.actual_qty), 0)).where(WorkOrderProgress.work_order_id == wo.id)
-                ).scalar_one()
-                if wo.plan_qty and int(total_actual or 0) >= wo.plan_qty:
-                    wo.status = "完成"
+                if wo.plan_qty and int(wo.actual_qty or 0) >= wo.plan_qty:
+                    wo.status = WORK_ORDER_DONE
                     if not wo.completion_qr_token:
                         wo.completion_qr_token = new_token()
-                        generate_qr_base64(wo.completion_qr_token, category="work_order_completion", filename=f"wo_{wo.id}_completion.png")
+                        register_token(session, wo.completion_qr_token, "work_order_completion", wo.id)
+                        completion_issued = True
 
+            bump_versions(session, "products", "inspection_records", "work_orders")
+            stale = (existing_product.qr_token, wo_tag(wo.id) if wo else None)
             session.commit()
+            invalidate_traces(*stale)
             session.refresh(record)
             session.refresh(move)
             session.refresh(existing_product)
+            if wo:
+                publish_work_order(current_services().broker, wo)
+            if completion_issued:
+                current_services().qr_service.submit(wo.completion_qr_token, category="work_order_completion", filename=f"wo_{wo.id}_completion.png")
+            job = current_services().qr_service.submit(existing_product.inspection_qr_token, category="products", filename=f"product_{existing_product.id}_qa.png")
             return jsonify(
                 {
                     "inspection": inspection_to_dict(record),
                     "inventory_move": product_move_to_dict(move),
                     "product": product_to_dict(existing_product),
-                    "qr_image_base64": generate_qr_base64(existing_product.inspection_qr_token, category="products", filename=f"product_{existing_product.id}_qa.png"),
+                    **qr_payload(job, existing_product.inspection_qr_token),
                 }
             )
 
@@ -883,9 +1067,8 @@ def create_inspection():
             wo = session.get(WorkOrder, bottle.work_order_id)
 
         # 入库生成成品并扣除瓶装半成品库存
-        if (bottle.stock_qty or 0) < qty:
+        if not consume_stock(session, bottle, qty):
             return jsonify({"error": "insufficient bottled stock"}), 400
-        bottle.stock_qty = (bottle.stock_qty or 0) - qty
 
         product = Product(
             name=bottle.name,
@@ -900,6 +1083,9 @@ def create_inspection():
         )
         session.add(product)
         session.flush()
+        register_token(session, product.qr_token, "product", product.id)
+        register_token(session, product.inspection_qr_token, "product", product.id)
+        link_lineage(session, product.parent_token, product.qr_token)
 
         move = ProductInventoryMove(
             product_id=product.id,
@@ -924,470 +1110,474 @@ def create_inspection():
         session.add(record)
 
         # 将装瓶数量计入工单完成量
+        completion_issued = False
         if wo:
-            prog = WorkOrderProgress(
-                work_order_id=wo.id,
-                actual_qty=qty,
-                defect_qty=0,
-                operator_id=None,
-                note="瓶装入库",
-            )
-            session.add(prog)
-            session.flush()
-            total_actual = session.execute(
-                select(func.coalesce(func.sum(WorkOrderProgress.actual_qty), 0)).where(WorkOrderProgress.work_order_id == wo.id)
-            ).scalar_one()
-            if wo.status == "待执行":
-                wo.status = "执行中"
-            if wo.plan_qty and int(total_actual or 0) >= wo.plan_qty:
-                wo.status = "完成"
+            add_progress(session, wo, actual_qty=qty, defect_qty=0, operator_id=None, note="瓶装入库")
+            if wo.status == WORK_ORDER_PENDING:
+                wo.status = WORK_ORDER_RUNNING
+            if wo.plan_qty and int(wo.actual_qty or 0) >= wo.plan_qty:
+                wo.status = WORK_ORDER_DONE
                 if not wo.completion_qr_token:
                     wo.completion_qr_token = new_token()
-                    generate_qr_base64(wo.completion_qr_token, category="work_order_completion", filename=f"wo_{wo.id}_completion.png")
+                    register_token(session, wo.completion_qr_token, "work_order_completion", wo.id)
+                    completion_issued = True
 
-        qr_image = generate_qr_base64(product.inspection_qr_token, category="products", filename=f"product_{product.id}_qa.png")
+        bump_versions(session, "products", "inspection_records")
+        stale = (bottle.qr_token, wo_tag(wo.id) if wo else None)
         session.commit()
+        invalidate_traces(*stale)
         session.refresh(record)
         session.refresh(move)
         session.refresh(product)
         if wo:
             session.refresh(wo)
+            publish_work_order(current_services().broker, wo)
+        if completion_issued:
+            current_services().qr_service.submit(wo.completion_qr_token, category="work_order_completion", filename=f"wo_{wo.id}_completion.png")
+        job = current_services().qr_service.submit(product.inspection_qr_token, category="products", filename=f"product_{product.id}_qa.png")
         return jsonify(
             {
                 "inspection": inspection_to_dict(record),
                 "inventory_move": product_move_to_dict(move),
                 "work_order": work_order_to_dict(wo) if wo else None,
                 "product": product_to_dict(product),
-                "qr_image_base64": qr_image,
+                **qr_payload(job, product.inspection_qr_token),
             }
         )
 
 
-@app.get("/api/inspections")
-def list_inspections():
-    with SessionLocal() as session:
-        items = session.scalars(select(InspectionRecord).order_by(InspectionRecord.created_at.desc())).all()
-        return jsonify([inspection_to_dict(i) for i in items])
+@bp.post("/api/inspections/materials/import")
+def import_material_inspections_endpoint():
+    """Bulk goods-in: CSV/NDJSON rows (multipart `file` or raw body) become materials, receipts and inspections.
+
+    The upload is spooled to disk first, then rows are written in chunks and the per-row
+    report is streamed back as NDJSON, ending with a summary line.
+    """
+    employee_id = request.args.get("employee_id") or request.form.get("employee_id")
+    upload = request.files.get("file")
+    try:
+        fmt = detect_format(
+            upload.filename if upload else None,
+            upload.mimetype if upload else request.mimetype,
+            request.args.get("format") or request.form.get("format"),
+        )
+    except ImportFormatError as err:
+        return jsonify({"error": str(err)}), 400
+    with db_session() as session:
+        qa_person, err = require_personnel(session, "qa", employee_id)
+        if err:
+            return err
+        inspector = qa_person.name
+
+    if upload:
+        source = upload.stream
+    else:
+        source = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        shutil.copyfileobj(request.stream, source)
+        source.seek(0)
+
+    def generate():
+        with db_session() as session, source:
+            for entry in import_material_inspections(session, source, fmt, current_services(), inspector=inspector, operator=employee_id):
+                yield dumps(entry) + "\n"
 
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
-@app.get("/api/trace/product/<string:qr_token>")
+
+@bp.get("/api/inspections")
+def list_inspections():
+    with db_session() as session:
+        validators = resource_validators(session, ["inspection_records"])
+        cached = not_modified(validators)
+        if cached:
+            return cached
+        stmt = apply_filters(select(*columns_of(InspectionRecord)), InspectionRecord, ("result", "object_type", "object_token"))
+        items, next_cursor = paginate(session, stmt, InspectionRecord)
+        return with_validators(page_response(jsonify(rows_to_dicts(items)), next_cursor), validators)
+
+
+@bp.get("/api/export/<string:name>.<string:fmt>")
+def export_records(name: str, fmt: str):
+    """Stream inspections/moves/progress as NDJSON or CSV; same filters as the list endpoints, no page limit."""
+    if name not in EXPORTS or fmt not in EXPORT_MIMETYPES:
+        return jsonify({"error": f"export must be one of {sorted(EXPORTS)} as .ndjson or .csv"}), 404
+    model, serializer, fields = EXPORTS[name]
+    stmt = apply_filters(select(*columns_of(model)), model, fields)
+    body = stream_export(db_session(), stmt, model, serializer, fmt)
+    resp = Response(stream_with_context(body), mimetype=EXPORT_MIMETYPES[fmt])
+    resp.headers["Content-Disposition"] = f"attachment; filename={name}_{datetime.now().strftime('%Y%m%d%H%M%S')}.{fmt}"
+    return resp
+
+
+@bp.get("/api/qr/<string:qr_token>.<string:ext>")
+def qr_image(qr_token: str, ext: str):
+    """Serve a QR image on demand (png/svg, ?size=box pixels, ?border=modules) with strong, immutable validators."""
+    if ext not in MIMETYPES:
+        return jsonify({"error": "format must be png or svg"}), 404
+    box_size = request.args.get("size", DEFAULT_BOX_SIZE, type=int)
+    border = request.args.get("border", DEFAULT_BORDER, type=int)
+    if not 1 <= box_size <= 40 or not 0 <= border <= 10:
+        return jsonify({"error": "size must be 1-40 and border 0-10"}), 400
+    with db_session() as session:
+        if not resolve_token(session, qr_token, current_services().token_cache):
+            return jsonify({"error": "QR token not found"}), 404
+
+    key = QrImageCache.key(qr_token, ext, box_size, border)
+    if request.if_none_match.contains(key):
+        resp = Response(status=304)
+    else:
+        data, key = current_services().image_cache.get(qr_token, ext, box_size, border)
+        resp = Response(data, mimetype=MIMETYPES[ext])
+    resp.set_etag(key)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 31536000
+    resp.cache_control.immutable = True
+    return resp
+
+
+@bp.post("/api/qr/labels")
+def qr_label_sheet():
+    """Print a multi-up label sheet for a list of tokens or every semi-product/product of a work order."""
+    payload = request.json or {}
+    fmt = payload.get("format", "pdf")
+    if fmt not in {"pdf", "png"}:
+        return jsonify({"error": "format must be pdf or png"}), 400
+    cols = int(payload.get("cols", 3))
+    rows = int(payload.get("rows", 8))
+    if not 1 <= cols <= 8 or not 1 <= rows <= 20:
+        return jsonify({"error": "cols must be 1-8 and rows 1-20"}), 400
+
+    with db_session() as session:
+        if payload.get("work_order_id"):
+            wo = session.get(WorkOrder, payload["work_order_id"])
+            if not wo:
+                return jsonify({"error": "Work order not found"}), 404
+            semis = session.scalars(select(SemiProduct).where(SemiProduct.work_order_id == wo.id).order_by(SemiProduct.id)).all()
+            products = session.scalars(select(Product).where(Product.process_data == wo.code).order_by(Product.id)).all()
+            labels = [(sp.qr_token, f"{sp.name} {sp.stage}") for sp in semis] + [(p.qr_token, p.name) for p in products]
+        else:
+            items = payload.get("tokens") or []
+            if not isinstance(items, list):
+                return jsonify({"error": "tokens must be a list"}), 400
+            # 支持纯 token 字符串或 {"token", "caption"}
+            labels = []
+            for item in items:
+                if isinstance(item, str):
+                    labels.append((item, ""))
+                elif isinstance(item, dict) and isinstance(item.get("token"), str):
+                    labels.append((item["token"], str(item.get("caption") or "")))
+                else:
+                    return jsonify({"error": "tokens items must be strings or {token, caption} objects"}), 400
+            tokens = [t for t, _ in labels]
+            if not tokens or not all(tokens):
+                return jsonify({"error": "tokens or work_order_id is required"}), 400
+            known = set(session.scalars(select(QrToken.token).where(QrToken.token.in_(tokens))).all())
+            missing = [t for t in tokens if t not in known]
+            if missing:
+                return jsonify({"error": "QR token not found", "tokens": missing}), 404
+
+    if not labels:
+        return jsonify({"error": "No labels to print"}), 404
+    if len(labels) > MAX_LABELS:
+        return jsonify({"error": f"At most {MAX_LABELS} labels per sheet"}), 400
+    settings = current_services().settings
+    font_path = label_font(settings["LABEL_FONT_PATH"])
+    # 默认字体没有中文字形，打出来是方框；找不到中文字体时直接拒绝，而不是生成一批废标签
+    if font_path is None and needs_cjk_font(labels):
+        return jsonify({"error": "Captions contain CJK text but no CJK font was found; set LABEL_FONT_PATH to a TTF/TTC font such as Noto Sans CJK"}), 400
+    data, mimetype, filename = render_label_sheet(
+        labels, fmt=fmt, cols=cols, rows=rows, font_path=font_path, workers=settings["LABEL_RENDER_WORKERS"]
+    )
+    resp = Response(data, mimetype=mimetype)
+    resp.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return resp
+
+
+@bp.get("/api/qr/jobs/<string:qr_token>")
+def qr_job_status(qr_token: str):
+    """Poll a background QR render; ?wait=<seconds> blocks until it finishes or the wait expires."""
+    job = current_services().qr_service.get(qr_token)
+    if job is None:
+        return jsonify({"error": "QR render job not found"}), 404
+    wait = request.args.get("wait", type=float)
+    if wait:
+        futures.wait([job], timeout=min(wait, current_services().settings["QR_RENDER_TIMEOUT"]))
+    return jsonify({"qr_token": qr_token, **job_status(job)})
+
+
+@bp.get("/api/trace/product/<string:qr_token>")
 def trace_product(qr_token: str):
     qr_token = (qr_token or "").strip()
-    with SessionLocal() as session:
-        product = session.scalars(select(Product).where((Product.qr_token == qr_token) | (Product.inspection_qr_token == qr_token))).first()
-        if not product:
+    with db_session() as session:
+        key = f"product:{qr_token}"
+        cache = current_services().trace_cache
+        body = cache.get(key)
+        if body is not None:
+            return trace_response(body, "HIT")
+        since = cache.generation()
+        with trace_reads(cache):
+            product = session.scalars(select(Product).where((Product.qr_token == qr_token) | (Product.inspection_qr_token == qr_token))).first()
+            if product:
+                return cache_trace(key, product_trace(session, product), since, [product.qr_token])
+
             # 容错：若传入的是半成品或物料码，转到对应追溯
             semi = session.scalars(select(SemiProduct).where(SemiProduct.qr_token == qr_token)).first()
             if semi:
-                # inline trace_semi logic (read-only)
-                semi_chain = [semi_product_to_dict(semi)]
-                semi_tokens = [semi.qr_token]
-                current_token = semi.parent_token
-                last_parent = None
-                while current_token:
-                    sp = session.scalars(select(SemiProduct).where(SemiProduct.qr_token == current_token)).first()
-                    if not sp:
-                        last_parent = current_token
-                        break
-                    semi_chain.append(semi_product_to_dict(sp))
-                    semi_tokens.append(sp.qr_token)
-                    last_parent = sp.parent_token
-                    current_token = sp.parent_token
-
-                materials = []
-                if last_parent:
-                    mat_extra = session.scalars(select(Material).where(Material.qr_token == last_parent)).first()
-                    if mat_extra:
-                        materials.append(mat_extra)
-
-                material_inspections = []
-                if materials:
-                    material_tokens = [m.qr_token for m in materials]
-                    material_inspections = session.scalars(
-                        select(InspectionRecord)
-                        .where(InspectionRecord.object_type == "material", InspectionRecord.object_token.in_(material_tokens))
-                        .order_by(InspectionRecord.created_at.desc())
-                    ).all()
-
-                semi_inspections = session.scalars(
-                    select(InspectionRecord)
-                    .where(InspectionRecord.object_token.in_(semi_tokens))
-                    .order_by(InspectionRecord.created_at.desc())
-                ).all()
-
-                products = session.scalars(select(Product).where(Product.parent_token == qr_token)).all()
-                work_order = None
-                if semi.work_order_id:
-                    work_order = session.get(WorkOrder, semi.work_order_id)
-
-                operator_ids = [sp.get("operator_id") for sp in semi_chain if isinstance(sp, dict) and sp.get("operator_id")]
-                operator_map = {}
-                if operator_ids:
-                    ops = session.scalars(select(Personnel).where(Personnel.id.in_(operator_ids))).all()
-                    operator_map = {o.id: personnel_to_dict(o) for o in ops}
-
-                return jsonify(
-                    {
-                        "semi_products": [
-                            {**sp, "operator": operator_map.get(sp.get("operator_id")) if isinstance(sp, dict) else None}
-                            for sp in semi_chain
-                        ],
-                        "semi_inspections": [
-                            {
-                                "object_token": i.object_token,
-                                "result": i.result,
-                                "inspector": i.inspector,
-                                "note": i.note,
-                                "created_at": format_ts(i.created_at),
-                            }
-                            for i in semi_inspections
-                        ],
-                        "materials": [
-                            {
-                                "name": m.name,
-                                "batch_code": m.batch_code,
-                                "supplier": m.supplier,
-                                "inspection_result": m.inspection_result,
-                            }
-                            for m in materials
-                        ],
-                        "material_inspections": [
-                            {
-                                "result": i.result,
-                                "inspector": i.inspector,
-                                "note": i.note,
-                                "created_at": format_ts(i.created_at),
-                            }
-                            for i in material_inspections
-                        ],
-                        "products": [product_to_dict(p) for p in products],
-                        "work_order": work_order_to_dict(work_order) if work_order else None,
-                    }
-                )
-
+                return cache_trace(key, semi_trace(session, semi), since)
             material = session.scalars(select(Material).where(Material.qr_token == qr_token)).first()
             if material:
-                inspections = session.scalars(
-                    select(InspectionRecord)
-                    .where(InspectionRecord.object_type == "material", InspectionRecord.object_token == material.qr_token)
-                    .order_by(InspectionRecord.created_at.desc())
-                ).all()
-                return jsonify(
-                    {
-                        "material": material_to_dict(material),
-                        "material_inspections": [
-                            {
-                                "result": i.result,
-                                "inspector": i.inspector,
-                                "note": i.note,
-                                "created_at": format_ts(i.created_at),
-                            }
-                            for i in inspections
-                        ],
-                    }
-                )
-
-            return jsonify({"error": "Product not found for token"}), 404
-
-        work_order = None
-        if product.process_data:
-            work_order = session.scalars(select(WorkOrder).where(WorkOrder.code == product.process_data)).first()
-
-        materials = []
-        if work_order and work_order.material_batch:
-            # work_order.material_batch currently stores material name; also match batch_code for backward compatibility
-            materials = session.scalars(
-                select(Material).where(
-                    (Material.name == work_order.material_batch) | (Material.batch_code == work_order.material_batch)
-                )
-            ).all()
-
-        material_inspections = []
-        if materials:
-            material_tokens = [m.qr_token for m in materials]
-            material_inspections = session.scalars(
-                select(InspectionRecord)
-                .where(InspectionRecord.object_type == "material", InspectionRecord.object_token.in_(material_tokens))
-                .order_by(InspectionRecord.created_at.desc())
-            ).all()
-
-        product_inspections = session.scalars(
-            select(InspectionRecord)
-            .where(InspectionRecord.object_type == "product", InspectionRecord.object_token == product.qr_token)
-            .order_by(InspectionRecord.created_at.desc())
-        ).all()
-
-        semi_chain = []
-        semi_tokens = []
-        current_token = product.parent_token
-        last_parent = None
-        while current_token:
-            sp = session.scalars(select(SemiProduct).where(SemiProduct.qr_token == current_token)).first()
-            if not sp:
-                last_parent = current_token
-                break
-            semi_chain.append(semi_product_to_dict(sp))
-            semi_tokens.append(sp.qr_token)
-            last_parent = sp.parent_token
-            current_token = sp.parent_token
-
-        if last_parent:
-            mat_extra = session.scalars(select(Material).where(Material.qr_token == last_parent)).first()
-            if mat_extra and mat_extra not in materials:
-                materials.append(mat_extra)
-
-        semi_inspections = []
-        if semi_tokens:
-            semi_inspections = session.scalars(
-                select(InspectionRecord)
-                .where(InspectionRecord.object_token.in_(semi_tokens))
-                .order_by(InspectionRecord.created_at.desc())
-            ).all()
-
-        # operator info for semi chain
-        operator_ids = []
-        for sp in semi_chain:
-            sp_dict = sp if isinstance(sp, dict) else semi_product_to_dict(sp)
-            if sp_dict.get("operator_id"):
-                operator_ids.append(sp_dict.get("operator_id"))
-        operator_map = {}
-        if operator_ids:
-            ops = session.scalars(select(Personnel).where(Personnel.id.in_(operator_ids))).all()
-            operator_map = {o.id: personnel_to_dict(o) for o in ops}
-
-        operators = []
-        if work_order:
-            operator_ids = [p.operator_id for p in session.scalars(select(WorkOrderProgress).where(WorkOrderProgress.work_order_id == work_order.id)).all() if p.operator_id]
-            if operator_ids:
-                operators = session.scalars(select(Personnel).where(Personnel.id.in_(operator_ids))).all()
-
-        return jsonify(
-            {
-                "product": {
-                    "name": product.name,
-                    "status": product.status,
-                    "final_inspection": product.final_inspection,
-                    "parent_token": product.parent_token,
-                    "qty": product.qty,
-                    "inspection_qr_token": product.inspection_qr_token,
-                    "created_at": format_ts(product.created_at),
-                },
-                "product_inspections": [
-                    {
-                        "result": i.result,
-                        "inspector": i.inspector,
-                        "note": i.note,
-                        "created_at": format_ts(i.created_at),
-                    }
-                    for i in product_inspections
-                ],
-                "work_order": work_order_to_dict(work_order) if work_order else None,
-                "materials": [
-                    {
-                        "name": m.name,
-                        "batch_code": m.batch_code,
-                        "supplier": m.supplier,
-                        "inspection_result": m.inspection_result,
-                    }
-                    for m in materials
-                ],
-                "material_inspections": [
-                    {
-                        "result": i.result,
-                        "inspector": i.inspector,
-                        "note": i.note,
-                        "created_at": format_ts(i.created_at),
-                    }
-                    for i in material_inspections
-                ],
-                "semi_products": [
-                    (
-                        lambda sp_dict: {**sp_dict, "operator": operator_map.get(sp_dict.get("operator_id"))}
-                    )(sp if isinstance(sp, dict) else semi_product_to_dict(sp))
-                    for sp in semi_chain
-                ],
-                "semi_inspections": [
-                    {
-                        "object_token": i.object_token,
-                        "result": i.result,
-                        "inspector": i.inspector,
-                        "note": i.note,
-                        "created_at": format_ts(i.created_at),
-                    }
-                    for i in semi_inspections
-                ],
-                "operators": [
-                    {
-                        "name": p.name,
-                        "employee_id": p.employee_id,
-                        "role": p.role,
-                    }
-                    for p in operators
-                ],
-            }
-        )
+                return cache_trace(key, material_trace(session, material), since)
+        return jsonify({"error": "Product not found for token"}), 404
 
 
-@app.get("/api/trace/semi/<string:qr_token>")
+@bp.get("/api/trace/semi/<string:qr_token>")
 def trace_semi(qr_token: str):
-    with SessionLocal() as session:
-        semi = session.scalars(select(SemiProduct).where(SemiProduct.qr_token == qr_token)).first()
-        if not semi:
-            return jsonify({"error": "Semi-product not found for token"}), 404
-
-        # upstream chain
-        semi_chain = [semi_product_to_dict(semi)]
-        semi_tokens = [semi.qr_token]
-        current_token = semi.parent_token
-        last_parent = None
-        while current_token:
-            sp = session.scalars(select(SemiProduct).where(SemiProduct.qr_token == current_token)).first()
-            if not sp:
-                last_parent = current_token
-                break
-            semi_chain.append(semi_product_to_dict(sp))
-            semi_tokens.append(sp.qr_token)
-            last_parent = sp.parent_token
-            current_token = sp.parent_token
-
-        materials = []
-        if last_parent:
-            mat_extra = session.scalars(select(Material).where(Material.qr_token == last_parent)).first()
-            if mat_extra:
-                materials.append(mat_extra)
-
-        material_inspections = []
-        if materials:
-            material_tokens = [m.qr_token for m in materials]
-            material_inspections = session.scalars(
-                select(InspectionRecord)
-                .where(InspectionRecord.object_type == "material", InspectionRecord.object_token.in_(material_tokens))
-                .order_by(InspectionRecord.created_at.desc())
-            ).all()
-
-        semi_inspections = session.scalars(
-            select(InspectionRecord)
-            .where(InspectionRecord.object_token.in_(semi_tokens))
-            .order_by(InspectionRecord.created_at.desc())
-        ).all()
-
-        products = session.scalars(select(Product).where(Product.parent_token == qr_token)).all()
-        # resolve operator details for semi chain
-        operator_ids = []
-        for sp in semi_chain:
-            if isinstance(sp, dict) and sp.get("operator_id"):
-                operator_ids.append(sp.get("operator_id"))
-            elif getattr(sp, "operator_id", None):
-                operator_ids.append(sp.operator_id)
-        operators = []
-        if operator_ids:
-            operators = session.scalars(select(Personnel).where(Personnel.id.in_(operator_ids))).all()
-        operator_map = {o.id: personnel_to_dict(o) for o in operators}
-        work_order = None
-        if semi.work_order_id:
-            work_order = session.get(WorkOrder, semi.work_order_id)
-
-        return jsonify(
-            {
-                "semi_products": [
-                    {**sp, "operator": operator_map.get(sp.get("operator_id")) if isinstance(sp, dict) else None}
-                    for sp in semi_chain
-                ],
-                "semi_inspections": [
-                    {
-                        "object_token": i.object_token,
-                        "result": i.result,
-                        "inspector": i.inspector,
-                        "note": i.note,
-                        "created_at": format_ts(i.created_at),
-                    }
-                    for i in semi_inspections
-                ],
-                "materials": [
-                    {
-                        "name": m.name,
-                        "batch_code": m.batch_code,
-                        "supplier": m.supplier,
-                        "inspection_result": m.inspection_result,
-                    }
-                    for m in materials
-                ],
-                "material_inspections": [
-                    {
-                        "result": i.result,
-                        "inspector": i.inspector,
-                        "note": i.note,
-                        "created_at": format_ts(i.created_at),
-                    }
-                    for i in material_inspections
-                ],
-                "products": [product_to_dict(p) for p in products],
-                "work_order": work_order_to_dict(work_order) if work_order else None,
-            }
-        )
+    with db_session() as session:
+        key = f"semi:{qr_token}"
+        cache = current_services().trace_cache
+        body = cache.get(key)
+        if body is not None:
+            return trace_response(body, "HIT")
+        since = cache.generation()
+        with trace_reads(cache):
+            semi = session.scalars(select(SemiProduct).where(SemiProduct.qr_token == qr_token)).first()
+            if not semi:
+                return jsonify({"error": "Semi-product not found for token"}), 404
+            return cache_trace(key, semi_trace(session, semi), since)
 
 
-@app.get("/api/trace/material/<string:qr_token>")
+@bp.get("/api/trace/material/<string:qr_token>")
 def trace_material(qr_token: str):
-    with SessionLocal() as session:
-        material = session.scalars(select(Material).where(Material.qr_token == qr_token)).first()
-        if not material:
-            return jsonify({"error": "Material not found for token"}), 404
+    with db_session() as session:
+        key = f"material:{qr_token}"
+        cache = current_services().trace_cache
+        body = cache.get(key)
+        if body is not None:
+            return trace_response(body, "HIT")
+        since = cache.generation()
+        with trace_reads(cache):
+            material = session.scalars(select(Material).where(Material.qr_token == qr_token)).first()
+            if not material:
+                return jsonify({"error": "Material not found for token"}), 404
+            return cache_trace(key, material_trace(session, material), since)
 
-        inspections = session.scalars(
-            select(InspectionRecord)
-            .where(InspectionRecord.object_type == "material", InspectionRecord.object_token == material.qr_token)
-            .order_by(InspectionRecord.created_at.desc())
-        ).all()
 
-        return jsonify(
-            {
-                "material": material_to_dict(material),
-                "material_inspections": [
-                    {
-                        "result": i.result,
-                        "inspector": i.inspector,
-                        "note": i.note,
-                        "created_at": format_ts(i.created_at),
-                    }
-                    for i in inspections
-                ],
-            }
-        )
+SCAN_SERIALIZERS = {
+    "material": material_to_dict,
+    "personnel": personnel_to_dict,
+    "product": product_to_dict,
+    "semi_product": semi_product_to_dict,
+    "work_order": work_order_to_dict,
+    "work_order_completion": work_order_to_dict,
+}
 
 
-@app.route("/")
+@bp.get("/api/trace/forward/<string:qr_token>")
+def trace_forward(qr_token: str):
+    """Downstream (recall) trace of a material or semi-product token."""
+    qr_token = (qr_token or "").strip()
+    with db_session() as session:
+        key = f"forward:{qr_token}"
+        cache = current_services().trace_cache
+        body = cache.get(key)
+        if body is not None:
+            return trace_response(body, "HIT")
+        since = cache.generation()
+        with trace_reads(cache):
+            entry = resolve_token(session, qr_token, current_services().token_cache)
+            if not entry:
+                return jsonify({"error": "QR token not found"}), 404
+            typ, object_id = entry
+            if typ not in {"material", "semi_product"}:
+                return jsonify({"error": "forward trace requires a material or semi-product token"}), 400
+            obj = session.get(TOKEN_MODELS[typ], object_id)
+            if not obj:
+                return jsonify({"error": "QR token not found"}), 404
+            return cache_trace(key, forward_trace(session, typ, qr_token, SCAN_SERIALIZERS[typ](obj)), since)
+
+
+@bp.get("/api/trace/derived")
+def trace_derived():
+    """Answer "is <token> derived from <ancestor>" with one closure-table lookup."""
+    token = (request.args.get("token") or "").strip()
+    ancestor = (request.args.get("ancestor") or "").strip()
+    if not token or not ancestor:
+        return jsonify({"error": "token and ancestor are required"}), 400
+    with db_session() as session:
+        # 成品质检码换成成品码，闭包表只记录 qr_token
+        product = session.scalars(select(Product).where(Product.inspection_qr_token == token)).first()
+        if product:
+            token = product.qr_token
+        depth = is_derived(session, token, ancestor)
+        return jsonify({"token": token, "ancestor": ancestor, "derived": depth is not None and depth > 0, "depth": depth})
+
+
+@bp.route("/")
 def index():
     # Serve frontend index for HTTPS access to pages
-    return send_from_directory(app.static_folder, "index.html")
+    return send_from_directory(current_app.static_folder, "index.html")
 
 
-@app.get("/api/scan/<string:qr_token>")
+@bp.get("/api/scan/<string:qr_token>")
 def scan_token(qr_token: str):
-    with SessionLocal() as session:
-        material = session.scalars(select(Material).where(Material.qr_token == qr_token)).first()
-        if material:
-            return jsonify({"type": "material", "data": material_to_dict(material)})
-        person = session.scalars(select(Personnel).where(Personnel.qr_token == qr_token)).first()
-        if person:
-            return jsonify({"type": "personnel", "data": personnel_to_dict(person)})
-        product = session.scalars(select(Product).where(Product.qr_token == qr_token)).first()
-        if product:
-            return jsonify({"type": "product", "data": product_to_dict(product)})
-        product_inspected = session.scalars(select(Product).where(Product.inspection_qr_token == qr_token)).first()
-        if product_inspected:
-            return jsonify({"type": "product", "data": product_to_dict(product_inspected)})
-        semi = session.scalars(select(SemiProduct).where(SemiProduct.qr_token == qr_token)).first()
-        if semi:
-            return jsonify({"type": "semi_product", "data": semi_product_to_dict(semi)})
-        work_order = session.scalars(select(WorkOrder).where((WorkOrder.qr_token == qr_token) | (WorkOrder.completion_qr_token == qr_token))).first()
-        if work_order:
-            typ = "work_order_completion" if work_order.completion_qr_token == qr_token else "work_order"
-            return jsonify({"type": typ, "data": work_order_to_dict(work_order)})
+    with db_session() as session:
+        # 注册表命中后按主键取行；token->类型 映射走进程内 LRU 缓存
+        entry = resolve_token(session, qr_token, current_services().token_cache)
+        if entry:
+            typ, object_id = entry
+            obj = session.get(TOKEN_MODELS[typ], object_id)
+            if obj:
+                return jsonify({"type": typ, "data": SCAN_SERIALIZERS[typ](obj)})
     return jsonify({"error": "QR token not found"}), 404
 
 
-@app.get("/health")
+@bp.cli.command("db-upgrade")
+def db_upgrade_command():
+    """Create missing tables and apply pending schema migrations."""
+    engine = current_services().engine
+    for migration in schema_upgrade(engine):
+        print(f"applied {migration.version:04d} {migration.name}")
+    print(f"schema at version {max(applied_versions(engine), default=0)}")
+
+
+@bp.cli.command("import-materials")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--employee-id", required=True, help="QA employee_id recorded as inspector")
+@click.option("--format", "fmt", type=click.Choice(FORMATS), help="defaults to the file extension")
+@click.option("--chunk-size", type=int, default=None, help="rows per executemany batch")
+@click.option("--report", type=click.File("w", encoding="utf-8"), default="-", help="per-row NDJSON report, default stdout")
+def import_materials_command(path, employee_id, fmt, chunk_size, report):
+    """Bulk-import material inspections/receipts from a CSV or NDJSON file."""
+    fmt = detect_format(path, explicit=fmt)
+    with db_session() as session:
+        qa_person, err = require_personnel(session, "qa", employee_id)
+        if err:
+            raise click.ClickException(f"no qa personnel with employee_id {employee_id}")
+        with open(path, "rb") as stream:
+            for entry in import_material_inspections(
+                session, stream, fmt, current_services(), inspector=qa_person.name, operator=employee_id, chunk_size=chunk_size
+            ):
+                report.write(dumps(entry) + "\n")
+    # 等待排队中的二维码渲染完成后再退出
+    current_services().qr_service.shutdown(wait=True)
+
+
+@bp.cli.command("backfill-tokens")
+def backfill_tokens_command():
+    """Register QR tokens of rows created before the qr_tokens table existed."""
+    current_services().verify_schema()
+    with db_session() as session:
+        inserted = backfill_tokens(session)
+    print(f"registered {inserted} tokens")
+
+
+@bp.cli.command("recompute-workorder-totals")
+def recompute_work_order_totals_command():
+    """Rebuild WorkOrder.actual_qty/defect_qty from work_order_progress with one grouped query."""
+    current_services().verify_schema()
+    with db_session() as session:
+        updated = recompute_work_order_totals(session)
+    print(f"recomputed totals for {updated} work orders")
+
+
+@bp.cli.command("rebuild-lineage")
+def rebuild_lineage_command():
+    """Regenerate the lineage_closure table from parent_token data."""
+    current_services().verify_schema()
+    with db_session() as session:
+        rows = rebuild_lineage(session)
+    print(f"lineage_closure rebuilt with {rows} rows")
+
+
+@bp.get("/api/events")
+def event_stream():
+    """Server-sent events: work_order (status/totals), exception and semi_product, optionally ?line= or ?work_order_id=.
+
+    Subscribers are fed from memory; reconnecting clients resume via Last-Event-ID or get a resync event.
+    """
+    services = current_services()
+    max_streams = services.settings["SSE_MAX_STREAMS"]
+    if max_streams and services.broker.subscribers >= max_streams:
+        # 每条 SSE 连接占住一个工作线程，超出上限时让看板稍后重连，不挤占接口请求
+        resp = jsonify({"error": "too many event streams on this worker"})
+        resp.status_code = 503
+        resp.headers["Retry-After"] = str(max(1, services.broker.retry_ms // 1000))
+        return resp
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        return jsonify({"error": "Last-Event-ID must be an integer"}), 400
+    stream = services.broker.stream(
+        last_id=last_id,
+        line=request.args.get("line"),
+        work_order_id=request.args.get("work_order_id", type=int),
+    )
+    resp = Response(stream, mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"  # 关闭 nginx 缓冲
+    return resp
+
+
+@bp.get("/api/admin/pool")
+def db_pool_stats():
+    """Connection pool occupancy, for sizing DB_POOL_SIZE / DB_MAX_OVERFLOW."""
+    services = current_services()
+    stats = {"database": pool_stats(services.engine)}
+    if services.read_engine is not services.engine:
+        stats["read_replica"] = pool_stats(services.read_engine)
+    return jsonify(stats)
+
+
+@bp.get("/api/admin/trace-cache")
+def trace_cache_stats():
+    return jsonify(current_services().trace_cache.stats())
+
+
+@bp.delete("/api/admin/trace-cache")
+def clear_trace_cache():
+    current_services().trace_cache.clear()
+    return jsonify({"status": "cleared"})
+
+
+@bp.get("/api/admin/sql")
+def sql_diagnostics():
+    """Worst slow-query shapes and N+1 suspects seen by this process (needs SQL_DIAGNOSTICS=true)."""
+    limit = max(1, min(request.args.get("limit", 20, type=int), 200))
+    settings = current_services().settings
+    return jsonify(
+        {
+            "enabled": settings["SQL_DIAGNOSTICS"],
+            "slow_query_ms": settings["SLOW_QUERY_MS"],
+            "n_plus_one_threshold": settings["N_PLUS_ONE_THRESHOLD"],
+            **querylog.diagnostics.summary(limit),
+        }
+    )
+
+
+@bp.delete("/api/admin/sql")
+def reset_sql_diagnostics():
+    querylog.diagnostics.reset()
+    return jsonify({"status": "reset"})
+
+
+@bp.get("/metrics")
+def prometheus_metrics():
+    """Prometheus text exposition of this process's request/SQL/QR metrics plus pool occupancy."""
+    services = current_services()
+    engines = {"primary": services.engine}
+    if services.read_engine is not services.engine:
+        engines["replica"] = services.read_engine
+    pools = {name: pool_stats(eng) for name, eng in engines.items()}
+    body = metrics.expose() + metrics.gauge(
+        "mes_db_pool_checked_out",
+        "Connections currently checked out of the pool.",
+        [({"engine": name}, stats["checked_out"]) for name, stats in pools.items() if "checked_out" in stats],
+    )
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+
+@bp.get("/health")
 def health():
     return {"status": "ok"}
 
@@ -1396,5 +1586,5 @@ if __name__ == "__main__":
     base_dir = Path(__file__).resolve().parent
     cert = base_dir / "cert.pem"
     key = base_dir / "key.pem"
-    app.run(host=config.HOST, port=config.PORT, debug=config.DEBUG, ssl_context=(cert, key))
+    create_app().run(host=config.HOST, port=config.PORT, debug=config.DEBUG, ssl_context=(cert, key))
 
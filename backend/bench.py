@@ -0,0 +1,328 @@
+"""性能基准：在临时 SQLite 库中生成一座合成工厂，用 Flask test client 压测扫码、追溯、工单、工序与质检接口。
+
+输出每个场景的 p50/p95/p99 延迟、每请求 SQL 条数与吞吐（JSON）。
+用法（在 backend/ 目录）：
+  python bench.py                      # 默认规模，打印结果
+  python bench.py --scale 5            # 数据量放大 5 倍
+  python bench.py --check              # 与 bench_baseline.json 对比：SQL 条数超出即失败，p95 超出基线 --tolerance 倍也失败
+  python bench.py --update-baseline    # 以本次结果重写基线
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import perf_counter
+
+BASE_DIR = Path(__file__).resolve().parent
+BASELINE_FILE = BASE_DIR / "bench_baseline.json"
+PRODUCTS = ("赤霞珠", "梅洛", "霞多丽", "雷司令")
+LINES = ("L1", "L2", "L3", "L4")
+
+
+@dataclass
+class Plant:
+    """Synthetic dataset size; every count is multiplied by --scale."""
+
+    materials: int = 200
+    operators: int = 20
+    inspectors: int = 5
+    work_orders: int = 400
+    chains_per_order: int = 3  # 每张工单的 榨汁→发酵→装瓶→成品 链条数
+    progress_per_order: int = 6
+    extra_inspections: int = 10000  # 额外的历史质检记录
+
+    def scaled(self, scale: float) -> "Plant":
+        return Plant(**{k: max(1, int(v * scale)) for k, v in asdict(self).items()})
+
+
+def seed(plant: Plant, rng: random.Random, session_factory) -> dict:
+    """Bulk-insert the plant with explicit ids, then let the app's own backfills build tokens, lineage and totals.
+
+    Returns the token pools the scenarios draw from.
+    """
+    from sqlalchemy import insert
+
+    from lineage import rebuild_lineage
+    from models import WORK_ORDER_STATUSES, InspectionRecord, Material, MaterialReceipt, Personnel, Product, SemiProduct, WorkOrder, WorkOrderProgress
+    from progress import recompute_work_order_totals
+    from tokens import backfill_tokens, new_token
+    from versions import bump_versions
+
+    start = datetime.utcnow() - timedelta(days=90)
+    clock = iter(start + timedelta(seconds=i) for i in range(10**9))
+    rows = {model: [] for model in (Material, MaterialReceipt, Personnel, WorkOrder, SemiProduct, Product, WorkOrderProgress, InspectionRecord)}
+
+    def add(model, **values):
+        table = rows[model]
+        values.setdefault("id", len(table) + 1)
+        values.setdefault("created_at", next(clock))
+        table.append(values)
+        return values
+
+    materials = [
+        add(Material, name=f"葡萄-{i % 20}", batch_code=f"B{i:05d}", supplier=f"S{i % 7}", inspection_result="合格", stock_qty=10**6, qr_token=new_token())
+        for i in range(plant.materials)
+    ]
+    for m in materials:
+        add(MaterialReceipt, material_id=m["id"], location="R1", qty=m["stock_qty"], operator="bench")
+    operators = [add(Personnel, name=f"操作员{i}", employee_id=f"op{i}", role="operator", qr_token=new_token()) for i in range(plant.operators)]
+    inspectors = [add(Personnel, name=f"质检员{i}", employee_id=f"qa{i}", role="qa", qr_token=new_token()) for i in range(plant.inspectors)]
+    add(Personnel, name="主管", employee_id="mgr", role="manager", qr_token=new_token())
+
+    def inspect(object_type, token):
+        add(InspectionRecord, object_type=object_type, object_token=token, result=rng.choice(("合格", "合格", "合格", "不合格")), inspector=rng.choice(inspectors)["name"])
+
+    for m in materials:
+        inspect("material", m["qr_token"])
+    work_orders, ferments, products = [], [], []
+    for i in range(plant.work_orders):
+        material = rng.choice(materials)
+        wo = add(
+            WorkOrder,
+            code=f"WO-BENCH-{i:06d}",
+            product_name=rng.choice(PRODUCTS),
+            material_batch=material["name"],
+            plan_qty=rng.randint(50, 500),
+            line=rng.choice(LINES),
+            status=rng.choice(WORK_ORDER_STATUSES),
+            qr_token=new_token(),
+            created_by="mgr",
+        )
+        work_orders.append(wo)
+        for _ in range(plant.chains_per_order):
+            operator_id = rng.choice(operators)["id"]
+            parent = material["qr_token"]
+            for stage, name, out in (("juice", "-葡萄汁", None), ("ferment", "-酒液", ferments), ("bottle", "", None)):
+                semi = add(
+                    SemiProduct,
+                    name=wo["product_name"] + name,
+                    stage=stage,
+                    stock_qty=10**4,
+                    parent_token=parent,
+                    qr_token=new_token(),
+                    work_order_id=wo["id"],
+                    operator_id=operator_id,
+                )
+                if out is not None:
+                    out.append(semi)
+                if stage == "ferment":
+                    inspect("semi_product", semi["qr_token"])
+                parent = semi["qr_token"]
+            product = add(
+                Product,
+                name=wo["product_name"],
+                status="合格",
+                final_inspection="合格",
+                linked_materials=material["name"],
+                process_data=wo["code"],
+                parent_token=parent,
+                qty=rng.randint(10, 100),
+                inspection_qr_token=new_token(),
+                qr_token=new_token(),
+            )
+            products.append(product)
+            inspect("product", product["qr_token"])
+        for _ in range(plant.progress_per_order):
+            add(WorkOrderProgress, work_order_id=wo["id"], actual_qty=rng.randint(1, 50), defect_qty=rng.randint(0, 3), operator_id=rng.choice(operators)["id"])
+    history = [m["qr_token"] for m in materials] + [f["qr_token"] for f in ferments] + [p["qr_token"] for p in products]
+    for _ in range(plant.extra_inspections):
+        inspect(rng.choice(("material", "semi_product", "product")), rng.choice(history))
+
+    with session_factory() as session:
+        for model, values in rows.items():
+            for offset in range(0, len(values), 5000):
+                session.execute(insert(model), values[offset : offset + 5000])
+        bump_versions(session, "materials", "personnel", "work_orders", "semi_products", "products", "inspection_records")
+        session.commit()
+        backfill_tokens(session)
+        rebuild_lineage(session)
+        recompute_work_order_totals(session)
+
+    scannable = history + [p["inspection_qr_token"] for p in products] + [w["qr_token"] for w in work_orders] + [o["qr_token"] for o in operators]
+    return {
+        "counts": {model.__tablename__: len(values) for model, values in rows.items()},
+        "scan": scannable,
+        "products": [p["qr_token"] for p in products],
+        "materials": [m["qr_token"] for m in materials],
+        "ferments": [f["qr_token"] for f in ferments],
+        "work_orders": [w["id"] for w in work_orders],
+        "operators": [o["employee_id"] for o in operators],
+        "inspectors": [q["employee_id"] for q in inspectors],
+    }
+
+
+def scenarios(pools: dict, rng: random.Random) -> dict:
+    """name -> callable(client) returning the response; writes use ?qr=url so PNG encoding is not timed."""
+    from models import WORK_ORDER_STATUSES
+
+    chain = {"step": "bottle", "token": None}
+
+    def scan(client):
+        return client.get(f"/api/scan/{rng.choice(pools['scan'])}")
+
+    def trace_product(client):
+        return client.get(f"/api/trace/product/{rng.choice(pools['products'])}")
+
+    def workorders(client):
+        params = rng.choice(("limit=50", f"status={rng.choice(WORK_ORDER_STATUSES)}&limit=50", f"line={rng.choice(LINES)}&limit=50"))
+        return client.get(f"/api/workorders?{params}")
+
+    def process_steps(client):
+        # 依次走 榨汁 → 发酵 → 装瓶，上游 token 取自上一步的产出
+        step = {"juice": "ferment", "ferment": "bottle", "bottle": "juice"}[chain["step"]]
+        token = rng.choice(pools["materials"]) if step == "juice" else chain["token"]
+        resp = client.post(
+            "/api/process/steps?qr=url",
+            json={"step": step, "work_order_id": rng.choice(pools["work_orders"]), "qty": 1, "input_token": token, "employee_id": rng.choice(pools["operators"])},
+        )
+        if resp.status_code == 200:
+            chain["step"], chain["token"] = step, resp.get_json()["semi_product"]["qr_token"]
+        return resp
+
+    def inspections_list(client):
+        params = rng.choice(("limit=50", "result=合格&limit=50", f"object_type={rng.choice(('material', 'semi_product', 'product'))}&limit=50"))
+        return client.get(f"/api/inspections?{params}")
+
+    def inspections_create(client):
+        return client.post(
+            "/api/inspections?qr=url",
+            json={"object_type": "semi_product", "object_token": rng.choice(pools["ferments"]), "result": "合格", "employee_id": rng.choice(pools["inspectors"])},
+        )
+
+    return {
+        "scan": scan,
+        "trace_product": trace_product,
+        "workorders": workorders,
+        "process_steps": process_steps,
+        "inspections_list": inspections_list,
+        "inspections_create": inspections_create,
+    }
+
+
+def _queries(resp) -> int:
+    # Server-Timing: app;dur=…, db;dur=…;desc="N queries"
+    timing = resp.headers.get("Server-Timing", "")
+    marker = 'desc="'
+    at = timing.find(marker)
+    return int(timing[at + len(marker) :].split(" ", 1)[0]) if at >= 0 else -1
+
+
+def run(client, name: str, call, requests: int, warmup: int) -> dict:
+    for _ in range(warmup):
+        call(client)
+    latencies, queries = [], []
+    started = perf_counter()
+    for _ in range(requests):
+        t0 = perf_counter()
+        resp = call(client)
+        latencies.append((perf_counter() - t0) * 1000)
+        if resp.status_code != 200:
+            raise RuntimeError(f"{name}: {resp.request.path} returned {resp.status_code}: {resp.get_data(as_text=True)[:300]}")
+        queries.append(_queries(resp))
+    elapsed = perf_counter() - started
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "requests": requests,
+        "p50_ms": round(cuts[49], 2),
+        "p95_ms": round(cuts[94], 2),
+        "p99_ms": round(cuts[98], 2),
+        "queries_per_request": round(statistics.mean(queries), 2),
+        "max_queries": max(queries),
+        "throughput_rps": round(requests / elapsed, 1),
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float, partial: bool = False) -> list[str]:
+    """Regressions against the baseline: more SQL per request (exact), or p95 above baseline * tolerance."""
+    failures = []
+    for name, base in baseline["scenarios"].items():
+        result = report["scenarios"].get(name)
+        if result is None:
+            if not partial:
+                failures.append(f"{name}: missing from this run")
+            continue
+        if result["max_queries"] > base["max_queries"]:
+            failures.append(f"{name}: {result['max_queries']} queries per request, baseline {base['max_queries']}")
+        if result["p95_ms"] > base["p95_ms"] * tolerance:
+            failures.append(f"{name}: p95 {result['p95_ms']} ms > {tolerance} x baseline {base['p95_ms']} ms")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every dataset size")
+    parser.add_argument("--requests", type=int, default=300, help="timed requests per scenario")
+    parser.add_argument("--warmup", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--only", action="append", help="run just these scenarios (repeatable)")
+    parser.add_argument("--check", action="store_true", help=f"fail on regressions against {BASELINE_FILE.name}")
+    parser.add_argument("--tolerance", type=float, default=2.0, help="allowed p95 ratio against the baseline (machines differ)")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--output", type=Path, help="also write the JSON report here")
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    # 必须在导入 config / app 之前设置
+    os.environ.update(
+        {
+            "DATABASE_URL": f"sqlite:///{Path(tmp.name) / 'bench.db'}",
+            "QR_OUTPUT_DIR": str(Path(tmp.name) / "qrcodes"),
+            "READ_DATABASE_URL": "",
+            "METRICS_ENABLED": "true",
+            "SERVER_TIMING": "true",
+            "SQL_DIAGNOSTICS": "false",
+            "SCHEMA_AUTO_UPGRADE": "true",
+        }
+    )
+    sys.path.insert(0, str(BASE_DIR))
+    from app import create_app
+    from migrations import upgrade
+    from services import EXTENSION
+
+    rng = random.Random(args.seed)
+    plant = Plant().scaled(args.scale)
+    app = create_app()
+    services = app.extensions[EXTENSION]
+    upgrade(services.engine)
+    t0 = perf_counter()
+    pools = seed(plant, rng, services.session)
+    seed_seconds = perf_counter() - t0
+
+    client = app.test_client()
+    report = {
+        "plant": asdict(plant),
+        "rows": pools.pop("counts"),
+        "seed_seconds": round(seed_seconds, 2),
+        "environment": {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version, "machine": platform.machine()},
+        "scenarios": {},
+    }
+    for name, call in scenarios(pools, rng).items():
+        if args.only and name not in args.only:
+            continue
+        report["scenarios"][name] = run(client, name, call, args.requests, args.warmup)
+    services.close()
+    tmp.cleanup()
+
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+    if args.update_baseline:
+        BASELINE_FILE.write_text(json.dumps(report, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+        print(f"baseline written to {BASELINE_FILE}", file=sys.stderr)
+    if args.check:
+        failures = compare(report, json.loads(BASELINE_FILE.read_text(encoding="utf-8")), args.tolerance, partial=bool(args.only))
+        if failures:
+            sys.exit("benchmark regressions:\n  " + "\n  ".join(failures))
+        print("no regressions against baseline", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
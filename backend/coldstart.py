@@ -0,0 +1,100 @@
+"""冷启动计时：每轮起一个全新解释器，测量 import app -> create_app -> 首个接口请求的耗时，输出 JSON（CI 会汇报）。
+
+用法（在 backend/ 目录）：python coldstart.py [--runs 5] [--max-ms 2000]
+默认使用临时 SQLite 库（先迁移好，计时只覆盖启动本身）；设置 DATABASE_URL 可测真实数据库。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+BASE_DIR = Path(__file__).resolve().parent
+PHASES = ("import_ms", "create_app_ms", "first_request_ms", "import_to_first_request_ms", "warm_request_ms")
+PROBE_URL = "/api/materials"
+
+
+def _ms(start: float, end: float) -> float:
+    return round((end - start) * 1000, 1)
+
+
+def probe():
+    """Runs in the child interpreter: time each startup phase and print one JSON line."""
+    t0 = perf_counter()
+    import app as appmod
+
+    t1 = perf_counter()
+    application = appmod.create_app()
+    t2 = perf_counter()
+    client = application.test_client()
+    resp = client.get(PROBE_URL)
+    t3 = perf_counter()
+    if resp.status_code != 200:
+        sys.exit(f"{PROBE_URL} returned {resp.status_code}: {resp.get_data(as_text=True)}")
+    client.get(PROBE_URL)
+    t4 = perf_counter()
+    print(
+        json.dumps(
+            {
+                "import_ms": _ms(t0, t1),
+                "create_app_ms": _ms(t1, t2),
+                "first_request_ms": _ms(t2, t3),
+                "import_to_first_request_ms": _ms(t0, t3),
+                "warm_request_ms": _ms(t3, t4),
+            }
+        )
+    )
+
+
+def _child(env: dict, *args: str) -> str:
+    result = subprocess.run(
+        [sys.executable, str(Path(__file__).resolve()), *args], cwd=BASE_DIR, env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        sys.exit(result.stderr or result.stdout)
+    return result.stdout.strip().splitlines()[-1]
+
+
+def _write_summary(report: dict):
+    path = os.getenv("GITHUB_STEP_SUMMARY")
+    if not path:
+        return
+    with open(path, "a", encoding="utf-8") as fh:
+        fh.write(f"### Cold start (median of {report['runs']} runs)\n\n| phase | ms |\n| --- | --- |\n")
+        for phase in PHASES:
+            fh.write(f"| {phase} | {report['median'][phase]} |\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-ms", type=float, help="fail if the median import_to_first_request_ms exceeds this")
+    parser.add_argument("--probe", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.probe:
+        probe()
+        return
+
+    env = dict(os.environ)
+    with tempfile.TemporaryDirectory() as tmp:
+        if "DATABASE_URL" not in os.environ:
+            env["DATABASE_URL"] = f"sqlite:///{Path(tmp) / 'coldstart.db'}"
+            subprocess.run([sys.executable, "-m", "flask", "--app", "app", "db-upgrade"], cwd=BASE_DIR, env=env, check=True, capture_output=True)
+        samples = [json.loads(_child(env, "--probe")) for _ in range(args.runs)]
+    report = {
+        "runs": args.runs,
+        "median": {phase: round(statistics.median(s[phase] for s in samples), 1) for phase in PHASES},
+        "max": {phase: max(s[phase] for s in samples) for phase in PHASES},
+    }
+    print(json.dumps(report, indent=2))
+    _write_summary(report)
+    if args.max_ms and report["median"]["import_to_first_request_ms"] > args.max_ms:
+        sys.exit(f"cold start {report['median']['import_to_first_request_ms']} ms exceeds --max-ms {args.max_ms}")
+
+
+if __name__ == "__main__":
+    main()
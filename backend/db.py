@@ -1,14 +1,99 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session, declarative_base
-import config
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session, sessionmaker, scoped_session, declarative_base
+from sqlalchemy.pool import QueuePool
+
+
+def _sqlite_pragmas(settings: dict):
+    def apply(dbapi_conn, _record):
+        # WAL 允许读写并发；busy_timeout 让写锁冲突时等待而不是立即 "database is locked"
+        cursor = dbapi_conn.cursor()
+        cursor.execute(f"PRAGMA journal_mode={settings['SQLITE_JOURNAL_MODE']}")
+        cursor.execute(f"PRAGMA synchronous={settings['SQLITE_SYNCHRONOUS']}")
+        cursor.execute(f"PRAGMA busy_timeout={settings['SQLITE_BUSY_TIMEOUT_MS']}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+    return apply
+
+
+def build_engine(url: str, settings: dict):
+    """Create an engine with the pool settings of one app; SQLite files also get WAL and a busy timeout."""
+    parsed = make_url(url)
+    pool_args = {
+        "pool_size": settings["DB_POOL_SIZE"],
+        "max_overflow": settings["DB_MAX_OVERFLOW"],
+        "pool_timeout": settings["DB_POOL_TIMEOUT"],
+        "pool_recycle": settings["DB_POOL_RECYCLE"],
+        "pool_pre_ping": settings["DB_POOL_PRE_PING"],
+    }
+    if parsed.get_backend_name() == "sqlite":
+        connect_args = {"check_same_thread": False, "timeout": settings["SQLITE_BUSY_TIMEOUT_MS"] / 1000}
+        if parsed.database in (None, "", ":memory:"):
+            # 内存库只能单连接共享，沿用 SQLAlchemy 默认连接池
+            return create_engine(url, echo=False, future=True, connect_args=connect_args)
+        eng = create_engine(url, echo=False, future=True, connect_args=connect_args, **pool_args)
+        event.listen(eng, "connect", _sqlite_pragmas(settings))
+        return eng
+    return create_engine(url, echo=False, future=True, **pool_args)
+
+
+def pool_stats(eng) -> dict:
+    pool = eng.pool
+    stats = {"class": type(pool).__name__, "status": pool.status()}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            {
+                "size": pool.size(),
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                "overflow": pool.overflow(),
+                "timeout": pool.timeout(),
+            }
+        )
+    return stats
+
+
+# 当前上下文是否允许读副本：默认 False（CLI、后台线程、写请求都走主库），由请求钩子按请求设置
+_replica_reads: ContextVar[bool] = ContextVar("replica_reads", default=False)
 
-engine = create_engine(config.DATABASE_URL, echo=False, future=True)
-SessionLocal = scoped_session(sessionmaker(bind=engine, autoflush=False, autocommit=False))
-Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
+def set_replica_reads(enabled: bool):
+    """Allow (or forbid) replica reads for the rest of the current request/thread context."""
+    _replica_reads.set(enabled)
+
+
+@contextmanager
+def use_primary():
+    """Read-your-writes escape hatch: force every statement in the block onto the primary."""
+    token = _replica_reads.set(False)
     try:
-        yield db
+        yield
     finally:
-        db.close()
+        _replica_reads.reset(token)
+
+
+class RoutingSession(Session):
+    """Sends reads to read_bind when the context allows it; flushes and DML always go to the primary bind."""
+
+    def __init__(self, *args, read_bind=None, **kw):
+        super().__init__(*args, **kw)
+        self.read_bind = read_bind if read_bind is not None else self.bind
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self.read_bind is self.bind or not _replica_reads.get():
+            return self.bind
+        if self._flushing or getattr(clause, "is_dml", False):
+            return self.bind
+        return self.read_bind
+
+
+def session_factory(engine, read_engine=None):
+    """Thread-scoped sessions bound to engine, reading from read_engine where allowed (one factory per app)."""
+    return scoped_session(sessionmaker(bind=engine, read_bind=read_engine, class_=RoutingSession, autoflush=False, autocommit=False))
+
+
+Base = declarative_base()
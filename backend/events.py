@@ -0,0 +1,217 @@
+"""实时推送：写接口提交后发布事件，/api/events 以 SSE 推给看板，订阅者不访问数据库。
+
+EVENT_BUS=memory（默认）时事件只在本进程内可见；多进程部署用 EVENT_BUS=redis：事件 id 取自 Redis 计数器，
+经 pub/sub 分发到每个进程的缓冲，看板连到任一进程都能收到全部写入，并按全局 Last-Event-ID 续传。
+"""
+import bisect
+import json
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+
+from json_provider import dumps
+from serializers import exception_to_dict, work_order_to_dict
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - optional dependency
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Event:
+    id: int
+    type: str
+    line: str | None
+    work_order_id: int | None
+    data: str  # 发布时序列化一次，所有订阅者共用
+
+    def encode(self) -> str:
+        return f"id: {self.id}\nevent: {self.type}\ndata: {self.data}\n\n"
+
+
+def resync_frame(head: int) -> str:
+    # 客户端的 Last-Event-ID 无法续传（超前于当前 id 或早于缓冲）：通知其重新拉取全量，再从 head 之后推送
+    return f"id: {head}\nevent: resync\ndata: {{}}\n\n"
+
+
+class EventBroker:
+    """In-process fan-out over a bounded ring buffer of recent events.
+
+    Subscribers block on a condition variable and replay from the buffer, so a
+    reconnecting client resumes from Last-Event-ID as long as it is still buffered;
+    otherwise it gets a resync event and continues from the current head.
+    """
+
+    def __init__(self, buffer_size: int, heartbeat: float = 15, retry_ms: int = 3000):
+        self.heartbeat = heartbeat
+        self.retry_ms = retry_ms
+        self._buffer: deque[Event] = deque(maxlen=buffer_size)
+        self._last_id = 0
+        self._epoch = 0  # 缓冲被整体重置（跨进程订阅重连）时递增，进行中的流据此补发 resync
+        self._cond = threading.Condition()
+        self.subscribers = 0
+
+    @property
+    def last_id(self) -> int:
+        return self._last_id
+
+    def publish(self, event_type: str, payload: dict, line: str | None = None, work_order_id: int | None = None):
+        with self._cond:
+            self._append(Event(self._last_id + 1, event_type, line, work_order_id, dumps(payload)))
+
+    def _append(self, event: Event):
+        """Buffer an event and wake subscribers; caller holds self._cond."""
+        if event.id <= self._last_id:
+            return
+        self._last_id = event.id
+        self._buffer.append(event)
+        self._cond.notify_all()
+
+    def _resumable(self, cursor: int) -> bool:
+        # 缓冲内 id 递增但不一定连续，cursor 之后的事件必须都还在缓冲里
+        oldest = self._buffer[0].id if self._buffer else self._last_id + 1
+        return oldest - 1 <= cursor <= self._last_id
+
+    def _since(self, cursor: int) -> list[Event]:
+        start = bisect.bisect_right(self._buffer, cursor, key=lambda e: e.id)
+        return [self._buffer[i] for i in range(start, len(self._buffer))]
+
+    def _ready(self):
+        """Hook for brokers that must connect before the first stream."""
+
+    def stream(self, last_id: int | None = None, line: str | None = None, work_order_id: int | None = None, heartbeat: float | None = None):
+        """Yield SSE frames for matching events after last_id (default: only new ones), with keepalive comments."""
+        heartbeat = heartbeat or self.heartbeat
+        self._ready()
+        with self._cond:
+            self.subscribers += 1
+        try:
+            yield from self._frames(last_id, line, work_order_id, heartbeat)
+        finally:
+            with self._cond:
+                self.subscribers -= 1
+
+    def _frames(self, last_id, line, work_order_id, heartbeat):
+        yield f"retry: {self.retry_ms}\n\n"
+        with self._cond:
+            epoch = self._epoch
+            cursor = self._last_id
+            resync = last_id is not None and not self._resumable(last_id)
+            if last_id is not None and not resync:
+                cursor = last_id
+        if resync:
+            yield resync_frame(cursor)
+        while True:
+            with self._cond:
+                if self._epoch == epoch and self._last_id <= cursor:
+                    self._cond.wait(heartbeat)
+                if self._epoch != epoch:
+                    epoch, cursor = self._epoch, self._last_id
+                    pending = None
+                else:
+                    pending = self._since(cursor)
+            if pending is None:
+                yield resync_frame(cursor)
+                continue
+            if not pending:
+                yield ": keepalive\n\n"
+                continue
+            for event in pending:
+                cursor = event.id
+                if line and event.line != line:
+                    continue
+                if work_order_id and event.work_order_id != work_order_id:
+                    continue
+                yield event.encode()
+
+
+class RedisEventBroker(EventBroker):
+    """Cross-process broker: ids come from one Redis counter and every process buffers the events it receives over pub/sub.
+
+    A process subscribes when it serves its first stream, so API workers that only publish never hold a subscription.
+    """
+
+    # INCR 与 PUBLISH 在同一脚本内原子执行：频道上的消息顺序与 id 顺序一致
+    PUBLISH_SCRIPT = "local id = redis.call('INCR', KEYS[1]) redis.call('PUBLISH', KEYS[2], id .. '|' .. ARGV[1]) return id"
+
+    def __init__(self, buffer_size: int, url: str, channel: str = "mes:events", **kw):
+        if redis is None:
+            raise RuntimeError("EVENT_BUS=redis but the redis package is not installed")
+        super().__init__(buffer_size, **kw)
+        self.client = redis.Redis.from_url(url)
+        self.channel = channel
+        self.counter_key = channel + ":id"
+        self._publish = self.client.register_script(self.PUBLISH_SCRIPT)
+        self._listener: threading.Thread | None = None
+        self._subscribed = threading.Event()
+        self._listener_lock = threading.Lock()
+
+    def publish(self, event_type: str, payload: dict, line: str | None = None, work_order_id: int | None = None):
+        message = json.dumps([event_type, line, work_order_id, dumps(payload)], ensure_ascii=False)
+        try:
+            self._publish(keys=[self.counter_key, self.channel], args=[message])
+        except redis.RedisError:
+            # 事件是尽力而为的增量，写入本身已提交；看板重连时按缺口收到 resync
+            logger.exception("failed to publish %s event", event_type)
+
+    def _ready(self):
+        if self._listener is None:
+            with self._listener_lock:
+                if self._listener is None:
+                    self._listener = threading.Thread(target=self._listen, name="event-bus", daemon=True)
+                    self._listener.start()
+        self._subscribed.wait(timeout=5)
+
+    def _reset(self, head: int):
+        with self._cond:
+            self._buffer.clear()
+            self._last_id = head
+            self._epoch += 1
+            self._cond.notify_all()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # 订阅建立后再读计数器：之后发布的都会收到，之前的不在本进程缓冲里，断线期间的缺口同样按 resync 处理
+                self._reset(int(self.client.get(self.counter_key) or 0))
+                self._subscribed.set()
+                for message in pubsub.listen():
+                    event_id, raw = message["data"].decode("utf-8").split("|", 1)
+                    event_type, line, work_order_id, data = json.loads(raw)
+                    with self._cond:
+                        self._append(Event(int(event_id), event_type, line, work_order_id, data))
+            except redis.RedisError:
+                logger.exception("event bus subscription lost, reconnecting")
+                time.sleep(1)
+
+
+def build_broker(settings: dict) -> EventBroker:
+    backend = settings["EVENT_BUS"]
+    timing = {"heartbeat": settings["SSE_HEARTBEAT_SECONDS"], "retry_ms": settings["SSE_RETRY_MS"]}
+    if backend == "memory":
+        return EventBroker(settings["SSE_BUFFER_SIZE"], **timing)
+    if backend == "redis":
+        return RedisEventBroker(settings["SSE_BUFFER_SIZE"], settings["EVENT_BUS_URL"], **timing)
+    raise ValueError(f"unknown EVENT_BUS backend: {backend}")
+
+
+def publish_work_order(broker: EventBroker, wo):
+    """Status / running totals of a committed work order."""
+    broker.publish("work_order", work_order_to_dict(wo), line=wo.line, work_order_id=wo.id)
+
+
+def publish_exception(broker: EventBroker, exc, line: str | None = None):
+    broker.publish("exception", exception_to_dict(exc), line=line, work_order_id=exc.work_order_id)
+
+
+def publish_semi_products(broker: EventBroker, items: list[dict], line: str | None = None):
+    """New semi-products, already serialized (callers build the dicts before commit expires the rows)."""
+    for item in items:
+        broker.publish("semi_product", item, line=line, work_order_id=item["work_order_id"])
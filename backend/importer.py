@@ -0,0 +1,173 @@
+"""来料质检批量导入：逐行流式读取 CSV / NDJSON，分批 executemany 写入物料、入库与质检记录。"""
+import codecs
+import csv
+import json
+from itertools import islice
+from typing import TYPE_CHECKING
+
+from sqlalchemy import insert, select
+
+from models import InspectionRecord, Material, MaterialReceipt
+from tokens import new_token, register_tokens
+from tracecache import material_batch_tag
+from versions import bump_versions
+
+if TYPE_CHECKING:
+    from services import Services
+
+FORMATS = ("csv", "ndjson")
+REQUIRED_FIELDS = ("name", "batch_code", "supplier", "result")
+
+
+class ImportFormatError(ValueError):
+    """Raised when the upload format cannot be determined or decoded."""
+
+
+def detect_format(filename: str | None = None, content_type: str | None = None, explicit: str | None = None) -> str:
+    if explicit:
+        if explicit not in FORMATS:
+            raise ImportFormatError("format must be csv or ndjson")
+        return explicit
+    name = (filename or "").lower()
+    ctype = (content_type or "").lower()
+    if name.endswith(".csv") or "csv" in ctype:
+        return "csv"
+    if name.endswith((".ndjson", ".jsonl")) or "ndjson" in ctype or "jsonl" in ctype:
+        return "ndjson"
+    raise ImportFormatError("cannot detect format, pass ?format=csv|ndjson")
+
+
+def iter_rows(stream, fmt: str):
+    """Yield (row_no, dict or error string) from a binary stream without reading it whole."""
+    lines = codecs.iterdecode(stream, "utf-8-sig")
+    if fmt == "csv":
+        reader = csv.DictReader(lines)
+        for row_no, row in enumerate(reader, start=1):
+            yield row_no, {k.strip(): v.strip() for k, v in row.items() if k and v is not None and v.strip() != ""}
+        return
+    row_no = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        row_no += 1
+        try:
+            row = json.loads(line)
+        except ValueError as err:
+            yield row_no, f"invalid JSON: {err}"
+            continue
+        yield row_no, row if isinstance(row, dict) else "row must be a JSON object"
+
+
+def _text(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _validate(row) -> tuple[dict | None, str | None]:
+    if isinstance(row, str):
+        return None, row
+    missing = [k for k in REQUIRED_FIELDS if not row.get(k)]
+    if missing:
+        return None, f"missing fields: {', '.join(missing)}"
+    qty = row.get("qty")
+    if qty is not None:
+        try:
+            qty = int(qty)
+        except (TypeError, ValueError):
+            return None, "qty must be an integer"
+        if qty < 0:
+            return None, "qty must be >= 0"
+    return {**row, "qty": qty}, None
+
+
+def _write_chunk(session, chunk, inspector: str | None, operator: str | None, trace_cache) -> list[dict]:
+    """Insert one chunk of validated rows with three executemany statements; returns report entries."""
+    materials = []
+    for _, row in chunk:
+        materials.append(
+            {
+                "name": row["name"],
+                "batch_code": row["batch_code"],
+                "supplier": row["supplier"],
+                "inspection_result": row.get("inspection_result") or row["result"],
+                "stock_qty": row["qty"] or 0,
+                "qr_token": new_token(),
+                "extra": _text(row.get("extra")),
+            }
+        )
+    session.execute(insert(Material), materials)
+    tokens = [m["qr_token"] for m in materials]
+    ids = dict(session.execute(select(Material.qr_token, Material.id).where(Material.qr_token.in_(tokens))).all())
+
+    receipts, records, report = [], [], []
+    for (row_no, row), token in zip(chunk, tokens):
+        if row["qty"] is not None:
+            receipts.append(
+                {
+                    "material_id": ids[token],
+                    "location": row.get("location"),
+                    "qty": row["qty"],
+                    "operator": row.get("operator") or operator,
+                }
+            )
+        records.append(
+            {
+                "object_type": "material",
+                "object_token": token,
+                "result": row["result"],
+                "inspector": inspector,
+                "items": _text(row.get("items")),
+                "note": row.get("note"),
+            }
+        )
+        report.append({"row": row_no, "status": "ok", "material_id": ids[token], "qr_token": token})
+    if receipts:
+        session.execute(insert(MaterialReceipt), receipts)
+    session.execute(insert(InspectionRecord), records)
+    register_tokens(session, [(token, "material", ids[token]) for token in tokens])
+    bump_versions(session, "materials", "inspection_records")
+    session.commit()
+    # 新物料会出现在按物料名/批次号匹配的成品追溯里
+    trace_cache.invalidate({material_batch_tag(m[key]) for m in materials for key in ("name", "batch_code")})
+    return report
+
+
+def import_material_inspections(
+    session, stream, fmt: str, services: "Services", inspector: str | None = None, operator: str | None = None, chunk_size: int | None = None
+):
+    """Stream rows from stream into materials/receipts/inspections and yield one report dict per input row.
+
+    Each chunk is validated, written and committed on its own, so memory stays bounded by
+    chunk_size and a bad row only fails itself. QR images for new materials are queued on the
+    app's render service after each commit. The final item is {"summary": {...}}.
+    """
+    chunk_size = chunk_size or services.settings["IMPORT_CHUNK_SIZE"]
+    rows = iter_rows(stream, fmt)
+    total = ok = 0
+    while True:
+        batch = list(islice(rows, chunk_size))
+        if not batch:
+            break
+        valid, results = [], []
+        for row_no, row in batch:
+            parsed, error = _validate(row)
+            if error:
+                results.append({"row": row_no, "status": "error", "error": error})
+            else:
+                valid.append((row_no, parsed))
+        if valid:
+            try:
+                written = _write_chunk(session, valid, inspector, operator, services.trace_cache)
+            except Exception as err:  # 整批回滚，逐行标记失败后继续下一批
+                session.rollback()
+                written = [{"row": row_no, "status": "error", "error": f"chunk rejected: {err}"} for row_no, _ in valid]
+            for entry in written:
+                if entry["status"] == "ok":
+                    services.qr_service.submit(entry["qr_token"], category="materials", filename=f"material_{entry['material_id']}.png")
+            results.extend(written)
+        total += len(batch)
+        for entry in sorted(results, key=lambda e: e["row"]):
+            ok += entry["status"] == "ok"
+            yield entry
+    yield {"summary": {"rows": total, "imported": ok, "failed": total - ok}}
@@ -0,0 +1,66 @@
+"""JSON 序列化后端：安装了 orjson 时用 orjson，否则回退到标准库（不排序键、紧凑输出）。"""
+import decimal
+import json
+
+from flask.json.provider import DefaultJSONProvider, JSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+
+def _default(obj):
+    # MySQL 聚合结果为 Decimal；其余类型（日期、UUID、dataclass 等）沿用 Flask 默认规则
+    if isinstance(obj, decimal.Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    return DefaultJSONProvider.default(obj)
+
+
+class StdlibJSONProvider(DefaultJSONProvider):
+    """Flask's provider without key sorting or ASCII escaping, compact unless in debug."""
+
+    sort_keys = False
+    ensure_ascii = False
+    default = staticmethod(_default)
+
+
+class OrjsonProvider(JSONProvider):
+    """orjson-backed provider; encodes straight to bytes for responses."""
+
+    def _options(self) -> int:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self._app.debug:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=_default, option=self._options()).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=_default, option=self._options()), mimetype="application/json")
+
+
+PROVIDERS = {"orjson": OrjsonProvider, "stdlib": StdlibJSONProvider}
+
+
+def provider_class(name: str = "auto"):
+    """Resolve JSON_PROVIDER (auto / orjson / stdlib) to a provider class."""
+    if name == "auto":
+        name = "orjson" if orjson is not None else "stdlib"
+    if name not in PROVIDERS:
+        raise ValueError(f"unknown JSON provider: {name}")
+    if name == "orjson" and orjson is None:
+        raise RuntimeError("JSON_PROVIDER=orjson but orjson is not installed")
+    return PROVIDERS[name]
+
+
+def dumps(obj) -> str:
+    """Module-level encoder for non-request code (SSE payloads, exports)."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME).decode("utf-8")
+    return json.dumps(obj, default=_default, ensure_ascii=False, separators=(",", ":"))
@@ -0,0 +1,150 @@
+"""批量标签打印：多联二维码标签排版成 PDF 或 PNG 分页，按页分发到进程池并行渲染。"""
+import io
+import os
+import threading
+import zipfile
+from typing import TYPE_CHECKING
+
+from qr_service import make_qr_image
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+# A4 @ 150 dpi
+PAGE_SIZE = (1240, 1754)
+PAGE_MARGIN = 40
+DPI = 150
+MAX_LABELS = 5000
+
+_pool: "ProcessPoolExecutor | None" = None
+_pool_lock = threading.Lock()
+
+
+def _executor(workers: int) -> "ProcessPoolExecutor":
+    global _pool
+    # 进程池模块（multiprocessing）按需导入，不计入启动耗时
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # 工作进程里已有请求线程、渲染线程池等，fork 会复制其持有的锁，子进程可能死锁；spawn 启动干净的解释器。
+                # 进程池按进程共享，大小取首次使用时的 LABEL_RENDER_WORKERS
+                _pool = ProcessPoolExecutor(
+                    max_workers=workers or os.cpu_count(),
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+    return _pool
+
+
+# 未配置 LABEL_FONT_PATH 时按顺序探测的常见中文字体（Noto Sans CJK / 文泉驿 / 系统自带）
+CJK_FONT_CANDIDATES = (
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
+    "/usr/share/fonts/wenquanyi/wqy-microhei/wqy-microhei.ttc",
+    "/usr/share/fonts/wqy-microhei/wqy-microhei.ttc",
+    "/System/Library/Fonts/PingFang.ttc",
+    "C:/Windows/Fonts/msyh.ttc",
+)
+
+_fonts = {}
+
+
+def label_font(font_path: str | None) -> str | None:
+    """The configured caption font, else the first CJK font found on this machine, else None (Pillow's Latin-only default)."""
+    if font_path:
+        return font_path
+    return next((path for path in CJK_FONT_CANDIDATES if os.path.isfile(path)), None)
+
+
+def needs_cjk_font(labels: list[tuple[str, str]]) -> bool:
+    """True if any caption has characters outside Latin-1, which the default font renders as boxes."""
+    return any(ord(ch) > 0xFF for _, caption in labels for ch in caption)
+
+
+def _font(size: int, font_path: str | None):
+    from PIL import ImageFont
+
+    if (font_path, size) not in _fonts:
+        if font_path:
+            _fonts[font_path, size] = ImageFont.truetype(font_path, size)
+        else:
+            _fonts[font_path, size] = ImageFont.load_default(size=size)
+    return _fonts[font_path, size]
+
+
+def _fit_text(draw, text: str, size: int, max_width: int, font_path: str | None):
+    """Largest font up to size whose rendering of text fits max_width; returns (font, width)."""
+    font = _font(size, font_path)
+    width = draw.textlength(text, font=font)
+    if width > max_width:
+        size = max(6, int(size * max_width / width))
+        font = _font(size, font_path)
+        width = draw.textlength(text, font=font)
+    return font, width
+
+
+def render_page(labels: list[tuple[str, str]], cols: int, rows: int, fmt: str, font_path: str | None = None) -> bytes:
+    """Compose one sheet of (token, caption) labels and return it encoded as PNG, or as raw grayscale pixels for PDF assembly."""
+    from PIL import Image, ImageDraw
+
+    page = Image.new("L", PAGE_SIZE, 255)
+    draw = ImageDraw.Draw(page)
+    cell_w = (PAGE_SIZE[0] - 2 * PAGE_MARGIN) // cols
+    cell_h = (PAGE_SIZE[1] - 2 * PAGE_MARGIN) // rows
+    text_h = max(12, cell_h // 9)
+    qr_side = min(cell_w, cell_h - 2 * text_h - 8) - 8
+
+    for idx, (token, caption) in enumerate(labels):
+        x0 = PAGE_MARGIN + (idx % cols) * cell_w
+        y0 = PAGE_MARGIN + (idx // cols) * cell_h
+        qr = make_qr_image(token, box_size=1, border=2).resize((qr_side, qr_side), Image.NEAREST)
+        page.paste(qr, (x0 + (cell_w - qr_side) // 2, y0 + 4))
+        text_y = y0 + qr_side + 8
+        for line in (caption, token):
+            if line:
+                font, width = _fit_text(draw, line, text_h, cell_w - 8, font_path)
+                draw.text((x0 + max(0, (cell_w - width) / 2), text_y), line, fill=0, font=font)
+            text_y += text_h
+
+    if fmt == "pdf":
+        return page.tobytes()
+    buffer = io.BytesIO()
+    page.save(buffer, format="PNG", dpi=(DPI, DPI))
+    return buffer.getvalue()
+
+
+def render_label_sheet(
+    labels: list[tuple[str, str]], fmt: str = "pdf", cols: int = 3, rows: int = 8, font_path: str | None = None, workers: int = 0
+):
+    """Lay out labels multi-up and return (bytes, mimetype, filename); pages render in parallel across processes.
+
+    font_path is a TTF for the captions (LABEL_FONT_PATH, resolved with label_font), workers sizes the process pool (0 = CPU count).
+    """
+    from PIL import Image
+
+    per_page = cols * rows
+    chunks = [labels[i : i + per_page] for i in range(0, len(labels), per_page)]
+    if len(chunks) == 1:
+        pages = [render_page(chunks[0], cols, rows, fmt, font_path)]
+    else:
+        n = len(chunks)
+        pages = list(_executor(workers).map(render_page, chunks, [cols] * n, [rows] * n, [fmt] * n, [font_path] * n))
+
+    if fmt == "pdf":
+        images = [Image.frombytes("L", PAGE_SIZE, raw) for raw in pages]
+        buffer = io.BytesIO()
+        images[0].save(buffer, format="PDF", save_all=True, append_images=images[1:], resolution=DPI)
+        return buffer.getvalue(), "application/pdf", "labels.pdf"
+    if len(pages) == 1:
+        return pages[0], "image/png", "labels.png"
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zf:
+        for no, png in enumerate(pages, start=1):
+            zf.writestr(f"labels_{no:03d}.png", png)
+    return buffer.getvalue(), "application/zip", "labels.zip"
@@ -0,0 +1,67 @@
+"""血缘闭包表维护：写入时追加 (祖先, 后代, 深度)，任意深度的上下游追溯都变成一次索引连接。"""
+from sqlalchemy import delete, func, literal, select, union_all
+
+from models import LineageClosure, Product, SemiProduct
+
+# 防御 parent_token 成环导致递归不终止；实际链路只有 榨汁→酿造→装瓶→成品 几段
+MAX_CHAIN_DEPTH = 32
+
+closure = LineageClosure.__table__
+
+
+def link_lineage(session, parent_token: str | None, child_token: str):
+    """Attach child_token under parent_token: copy the parent's ancestors one level deeper, plus the direct edge and a self row."""
+    link_lineage_many(session, [(parent_token, child_token)])
+
+
+def link_lineage_many(session, pairs):
+    """Attach many (parent_token, child_token) pairs with one ancestor read and one bulk insert."""
+    parents = {parent for parent, _ in pairs if parent}
+    ancestors = {}
+    if parents:
+        for ancestor, descendant, depth in session.execute(
+            select(closure.c.ancestor_token, closure.c.descendant_token, closure.c.depth).where(
+                closure.c.descendant_token.in_(parents), closure.c.depth > 0
+            )
+        ):
+            ancestors.setdefault(descendant, []).append((ancestor, depth))
+    rows = []
+    for parent, child in pairs:
+        rows.append({"ancestor_token": child, "descendant_token": child, "depth": 0})
+        if parent:
+            rows.append({"ancestor_token": parent, "descendant_token": child, "depth": 1})
+            rows.extend({"ancestor_token": a, "descendant_token": child, "depth": d + 1} for a, d in ancestors.get(parent, []))
+    session.execute(closure.insert(), rows)
+
+
+def is_derived(session, descendant_token: str, ancestor_token: str):
+    """Return the lineage depth between two tokens, or None if descendant_token does not come from ancestor_token."""
+    return session.scalar(
+        select(closure.c.depth).where(closure.c.ancestor_token == ancestor_token, closure.c.descendant_token == descendant_token)
+    )
+
+
+def rebuild_lineage(session) -> int:
+    """Regenerate the whole closure table from parent_token data in two bulk statements; returns the row count."""
+    edges = union_all(
+        select(SemiProduct.parent_token.label("parent"), SemiProduct.qr_token.label("child")).where(SemiProduct.parent_token.is_not(None)),
+        select(Product.parent_token.label("parent"), Product.qr_token.label("child")).where(Product.parent_token.is_not(None)),
+    ).cte("edges")
+    pairs = select(edges.c.parent.label("ancestor_token"), edges.c.child.label("descendant_token"), literal(1).label("depth")).cte(
+        "pairs", recursive=True
+    )
+    pairs = pairs.union_all(
+        select(pairs.c.ancestor_token, edges.c.child, pairs.c.depth + 1)
+        .join(edges, edges.c.parent == pairs.c.descendant_token)
+        .where(pairs.c.depth < MAX_CHAIN_DEPTH)
+    )
+    nodes = union_all(
+        select(SemiProduct.qr_token, SemiProduct.qr_token, literal(0)),
+        select(Product.qr_token, Product.qr_token, literal(0)),
+        select(pairs.c.ancestor_token, pairs.c.descendant_token, pairs.c.depth),
+    )
+
+    session.execute(delete(LineageClosure))
+    session.execute(closure.insert().from_select(["ancestor_token", "descendant_token", "depth"], nodes))
+    session.commit()
+    return session.scalar(select(func.count()).select_from(LineageClosure))
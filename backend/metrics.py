@@ -0,0 +1,195 @@
+"""运行指标：引擎事件与请求钩子累计各接口耗时直方图、SQL 条数/耗时与二维码渲染耗时，/metrics 输出 Prometheus 文本格式。
+
+每条 SQL 只在请求自己的计数器上累加（ContextVar，无锁），请求结束时一次性记入共享指标，开销可常开。
+指标按进程统计：gunicorn 多工作进程时每次抓取只看到其中一个进程。
+"""
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from dataclasses import dataclass
+from time import perf_counter
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+BACKGROUND = "-"  # 请求之外（CLI、后台线程）执行的 SQL 记在这个 endpoint 下
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _num(value: float) -> str:
+    return repr(round(value, 6)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter keyed by a tuple of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_num(value)}"
+
+
+class Histogram:
+    """Fixed-bucket histogram keyed by a tuple of label values; observe() is one bisect under a lock."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames, self.buckets = name, help, labelnames, buckets
+        self._values: dict[tuple, list] = {}  # labels -> [每个桶的计数..., +Inf 计数, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(labels)
+            if row is None:
+                row = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[index] += 1
+            row[-1] += value
+
+    def samples(self):
+        with self._lock:
+            items = sorted((labels, list(row)) for labels, row in self._values.items())
+        names = self.labelnames + ("le",)
+        for labels, row in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), row[:-1]):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(names, labels + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_num(row[-1])}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
+
+
+http_duration = Histogram("mes_http_request_duration_seconds", "Request latency by endpoint.", ("endpoint", "method"))
+http_requests = Counter("mes_http_requests_total", "Requests by endpoint and status.", ("endpoint", "method", "status"))
+sql_per_request = Histogram("mes_sql_statements_per_request", "SQL statements issued per request.", ("endpoint",), QUERY_BUCKETS)
+sql_statements = Counter("mes_sql_statements_total", "SQL statements executed.", ("endpoint",))
+sql_seconds = Counter("mes_sql_duration_seconds_total", "Time spent executing SQL.", ("endpoint",))
+qr_render = Histogram("mes_qr_render_duration_seconds", "QR image render time (cache misses only).", ("format",))
+REGISTRY = [http_duration, http_requests, sql_per_request, sql_statements, sql_seconds, qr_render]
+
+
+@dataclass
+class RequestStats:
+    start: float
+    status: int = 500  # after_request 填入；未走到说明处理中断
+    sql_count: int = 0
+    sql_seconds: float = 0.0
+    qr_seconds: float = 0.0
+
+
+_current: ContextVar[RequestStats | None] = ContextVar("request_stats", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._mes_started = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_mes_started", None)
+    if started is None:
+        return
+    elapsed = perf_counter() - started
+    stats = _current.get()
+    if stats is not None:
+        stats.sql_count += 1
+        stats.sql_seconds += elapsed
+    else:
+        sql_statements.inc((BACKGROUND,))
+        sql_seconds.inc((BACKGROUND,), elapsed)
+
+
+_installed = False
+
+
+def install():
+    """Listen on every Engine (including ones built later); safe to call more than once."""
+    global _installed
+    if not _installed:
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        _installed = True
+
+
+def start_request() -> RequestStats:
+    stats = RequestStats(perf_counter())
+    _current.set(stats)
+    return stats
+
+
+def current() -> RequestStats | None:
+    return _current.get()
+
+
+def finish_request(endpoint: str, method: str):
+    """Fold the current request's totals into the shared metrics and detach it from the context."""
+    stats = _current.get()
+    if stats is None:
+        return
+    _current.set(None)
+    http_duration.observe((endpoint, method), perf_counter() - stats.start)
+    http_requests.inc((endpoint, method, stats.status))
+    sql_per_request.observe((endpoint,), stats.sql_count)
+    if stats.sql_count:
+        sql_statements.inc((endpoint,), stats.sql_count)
+        sql_seconds.inc((endpoint,), stats.sql_seconds)
+
+
+def server_timing(stats: RequestStats) -> str:
+    """Server-Timing header value: total, SQL (with statement count) and, if any, in-request QR rendering."""
+    parts = [
+        f"app;dur={(perf_counter() - stats.start) * 1000:.1f}",
+        f'db;dur={stats.sql_seconds * 1000:.1f};desc="{stats.sql_count} queries"',
+    ]
+    if stats.qr_seconds:
+        parts.append(f"qr;dur={stats.qr_seconds * 1000:.1f}")
+    return ", ".join(parts)
+
+
+def observe_qr_render(fmt: str, seconds: float):
+    qr_render.observe((fmt,), seconds)
+    stats = _current.get()
+    if stats is not None:
+        stats.qr_seconds += seconds
+
+
+def expose() -> str:
+    """All registered metrics in Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+def gauge(name: str, help: str, samples: list[tuple[dict, float]]) -> str:
+    """A gauge sampled at scrape time (e.g. pool occupancy), in the same text format."""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+    for labels, value in samples:
+        lines.append(f"{name}{_labels(tuple(labels), tuple(labels.values()))} {_num(value)}")
+    return "\n".join(lines) + "\n"
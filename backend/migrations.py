@@ -0,0 +1,163 @@
+"""轻量版本化迁移：create_all 只建缺失的表，已有表的新列、索引与数据回填按版本号依次执行并记录。
+
+用法：`flask --app app db-upgrade`（SQLite / MySQL 通用）。应用在首个请求时调用 ensure_schema 检查一次。
+"""
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+from sqlalchemy.orm import Session
+
+import models  # noqa: F401  注册全部模型表，保证单独调用 upgrade() 时 metadata 完整
+from db import Base
+
+version_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    version_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String(120), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    upgrade: Callable
+
+
+def _create_indexes(conn, names):
+    """Create the named model indexes on existing tables, skipping those already present."""
+    wanted = set(names)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in wanted:
+                index.create(bind=conn, checkfirst=True)
+                wanted.discard(index.name)
+    if wanted:
+        raise RuntimeError(f"unknown indexes in migration: {sorted(wanted)}")
+
+
+def _add_column(conn, table_name: str, column_name: str):
+    """ALTER TABLE ... ADD COLUMN using the model's definition, if the column is missing."""
+    if column_name in {c["name"] for c in inspect(conn).get_columns(table_name)}:
+        return
+    column = Base.metadata.tables[table_name].c[column_name]
+    ddl = f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column.type.compile(dialect=conn.dialect)}"
+    if column.server_default is not None:
+        ddl += f" DEFAULT {column.server_default.arg}"
+    if not column.nullable:
+        ddl += " NOT NULL"
+    conn.execute(text(ddl))
+
+
+def _0001_query_indexes(conn):
+    # 追溯（parent_token / 闭包 / object_token）、扫码与列表分页（created_at,id + 过滤列）的查询形状
+    _create_indexes(
+        conn,
+        [
+            "ix_semi_products_parent_token",
+            "ix_semi_products_work_order",
+            "ix_products_parent_token",
+            "ix_products_process_data",
+            "ix_inspection_records_token_type_created_at",
+            "ix_inspection_records_type_created_at",
+            "ix_inspection_records_result_created_at",
+            "ix_work_orders_status_created_at",
+            "ix_work_orders_line_created_at",
+            "ix_materials_name",
+            "ix_materials_batch_code",
+            "ix_work_order_progress_wo_created_at",
+            "ix_work_order_exceptions_wo",
+            "ix_material_receipts_material",
+            "ix_product_inventory_moves_product_direction",
+            "ix_materials_created_at_id",
+            "ix_personnel_created_at_id",
+            "ix_products_created_at_id",
+            "ix_processes_created_at_id",
+            "ix_users_created_at_id",
+            "ix_work_orders_created_at_id",
+            "ix_work_order_progress_created_at_id",
+            "ix_work_order_exceptions_created_at_id",
+            "ix_inspection_records_created_at_id",
+            "ix_material_receipts_created_at_id",
+            "ix_product_inventory_moves_created_at_id",
+            "ix_semi_products_created_at_id",
+            "ix_stocktake_records_created_at_id",
+        ],
+    )
+
+
+def _0002_work_order_totals(conn):
+    from progress import recompute_work_order_totals
+
+    _add_column(conn, "work_orders", "actual_qty")
+    _add_column(conn, "work_orders", "defect_qty")
+    recompute_work_order_totals(Session(bind=conn))
+
+
+def _0003_token_registry_and_lineage(conn):
+    from lineage import rebuild_lineage
+    from tokens import backfill_tokens
+
+    backfill_tokens(Session(bind=conn))
+    rebuild_lineage(Session(bind=conn))
+
+
+def _0004_resource_versions(conn):
+    from versions import seed_versions
+
+    session = Session(bind=conn)
+    seed_versions(session)
+    session.flush()
+
+
+MIGRATIONS = [
+    Migration(1, "query indexes", _0001_query_indexes),
+    Migration(2, "work order running totals", _0002_work_order_totals),
+    Migration(3, "backfill qr_tokens and lineage_closure", _0003_token_registry_and_lineage),
+    Migration(4, "seed resource_versions", _0004_resource_versions),
+]
+
+
+def applied_versions(engine) -> set[int]:
+    version_metadata.create_all(bind=engine)
+    with engine.connect() as conn:
+        return set(conn.scalars(select(schema_migrations.c.version)).all())
+
+
+def upgrade(engine) -> list[Migration]:
+    """Create missing tables, then apply pending migrations in version order; returns those applied."""
+    Base.metadata.create_all(bind=engine)
+    done = applied_versions(engine)
+    applied = []
+    for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+        if migration.version in done:
+            continue
+        with engine.begin() as conn:
+            migration.upgrade(conn)
+            conn.execute(
+                schema_migrations.insert().values(version=migration.version, name=migration.name, applied_at=datetime.utcnow())
+            )
+        applied.append(migration)
+    return applied
+
+
+class SchemaOutOfDate(RuntimeError):
+    """Raised by ensure_schema when migrations are pending and auto-upgrade is off."""
+
+
+def ensure_schema(engine, auto_upgrade: bool = True):
+    """Check the schema version of engine, upgrading it if allowed.
+
+    Stateless: callers remember the result per engine (Services.verify_schema), so a
+    failed check (e.g. database down) simply runs again on the next call.
+    """
+    pending = {m.version for m in MIGRATIONS} - applied_versions(engine)
+    if pending:
+        if not auto_upgrade:
+            raise SchemaOutOfDate(f"pending migrations {sorted(pending)}, run `flask --app app db-upgrade`")
+        upgrade(engine)
@@ -1,9 +1,20 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Boolean, Index
 from db import Base
 
+# 工单状态：建单待执行，首条进度/入库后执行中，完成量达到计划量后完成
+WORK_ORDER_PENDING = "待执行"
+WORK_ORDER_RUNNING = "执行中"
+WORK_ORDER_DONE = "完成"
+WORK_ORDER_STATUSES = (WORK_ORDER_PENDING, WORK_ORDER_RUNNING, WORK_ORDER_DONE)
+
 class Material(Base):
     __tablename__ = "materials"
+    __table_args__ = (
+        Index("ix_materials_created_at_id", "created_at", "id"),
+        Index("ix_materials_name", "name"),
+        Index("ix_materials_batch_code", "batch_code"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(120), nullable=False)
@@ -18,6 +29,7 @@ class Material(Base):
 
 class Personnel(Base):
     __tablename__ = "personnel"
+    __table_args__ = (Index("ix_personnel_created_at_id", "created_at", "id"),)
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(120), nullable=False)
@@ -30,6 +42,10 @@ class Personnel(Base):
 
 class Product(Base):
     __tablename__ = "products"
+    __table_args__ = (
+        Index("ix_products_created_at_id", "created_at", "id"),
+        Index("ix_products_process_data", "process_data", mysql_length=120),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(120), nullable=False)
@@ -37,7 +53,7 @@ class Product(Base):
     final_inspection = Column(String(50), nullable=True)
     linked_materials = Column(Text, nullable=True)
     process_data = Column(Text, nullable=True)
-    parent_token = Column(String(64), nullable=True)
+    parent_token = Column(String(64), nullable=True, index=True)
     qty = Column(Integer, nullable=False, default=0)
     inspection_qr_token = Column(String(64), unique=True, nullable=True)
     qr_token = Column(String(64), unique=True, nullable=False)
@@ -46,6 +62,7 @@ class Product(Base):
 
 class Process(Base):
     __tablename__ = "processes"
+    __table_args__ = (Index("ix_processes_created_at_id", "created_at", "id"),)
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(120), nullable=False)
@@ -56,6 +73,7 @@ class Process(Base):
 
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (Index("ix_users_created_at_id", "created_at", "id"),)
 
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String(120), unique=True, nullable=False)
@@ -69,6 +87,11 @@ class User(Base):
 
 class WorkOrder(Base):
     __tablename__ = "work_orders"
+    __table_args__ = (
+        Index("ix_work_orders_created_at_id", "created_at", "id"),
+        Index("ix_work_orders_status_created_at", "status", "created_at", "id"),
+        Index("ix_work_orders_line_created_at", "line", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     code = Column(String(120), unique=True, nullable=False)
@@ -76,11 +99,13 @@ class WorkOrder(Base):
     material_batch = Column(String(120), nullable=True)
     plan_qty = Column(Integer, nullable=False, default=0)
     line = Column(String(120), nullable=True)
-    status = Column(String(50), nullable=False, default="待执行")
+    status = Column(String(50), nullable=False, default=WORK_ORDER_PENDING)
     planned_start = Column(String(50), nullable=True)
     planned_end = Column(String(50), nullable=True)
     qr_token = Column(String(64), unique=True, nullable=False)
     completion_qr_token = Column(String(64), unique=True, nullable=True)
+    actual_qty = Column(Integer, nullable=False, default=0, server_default="0")  # running SUM(work_order_progress.actual_qty)
+    defect_qty = Column(Integer, nullable=False, default=0, server_default="0")  # running SUM(work_order_progress.defect_qty)
     created_by = Column(String(120), nullable=True)
     notes = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -88,6 +113,10 @@ class WorkOrder(Base):
 
 class WorkOrderProgress(Base):
     __tablename__ = "work_order_progress"
+    __table_args__ = (
+        Index("ix_work_order_progress_wo_created_at", "work_order_id", "created_at", "id"),
+        Index("ix_work_order_progress_created_at_id", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     work_order_id = Column(Integer, ForeignKey("work_orders.id"), nullable=False)
@@ -100,6 +129,10 @@ class WorkOrderProgress(Base):
 
 class WorkOrderException(Base):
     __tablename__ = "work_order_exceptions"
+    __table_args__ = (
+        Index("ix_work_order_exceptions_wo", "work_order_id", "status"),
+        Index("ix_work_order_exceptions_created_at_id", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     work_order_id = Column(Integer, ForeignKey("work_orders.id"), nullable=False)
@@ -113,6 +146,12 @@ class WorkOrderException(Base):
 
 class InspectionRecord(Base):
     __tablename__ = "inspection_records"
+    __table_args__ = (
+        Index("ix_inspection_records_token_type_created_at", "object_token", "object_type", "created_at"),
+        Index("ix_inspection_records_created_at_id", "created_at", "id"),
+        Index("ix_inspection_records_type_created_at", "object_type", "created_at", "id"),
+        Index("ix_inspection_records_result_created_at", "result", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     object_type = Column(String(50), nullable=False)  # material/process/product/workorder
@@ -126,6 +165,10 @@ class InspectionRecord(Base):
 
 class MaterialReceipt(Base):
     __tablename__ = "material_receipts"
+    __table_args__ = (
+        Index("ix_material_receipts_material", "material_id"),
+        Index("ix_material_receipts_created_at_id", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     material_id = Column(Integer, ForeignKey("materials.id"), nullable=False)
@@ -137,6 +180,10 @@ class MaterialReceipt(Base):
 
 class ProductInventoryMove(Base):
     __tablename__ = "product_inventory_moves"
+    __table_args__ = (
+        Index("ix_product_inventory_moves_product_direction", "product_id", "direction"),
+        Index("ix_product_inventory_moves_created_at_id", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     product_id = Column(Integer, ForeignKey("products.id"), nullable=True)
@@ -152,12 +199,16 @@ class ProductInventoryMove(Base):
 
 class SemiProduct(Base):
     __tablename__ = "semi_products"
+    __table_args__ = (
+        Index("ix_semi_products_work_order", "work_order_id", "id"),
+        Index("ix_semi_products_created_at_id", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(120), nullable=False)
     stage = Column(String(50), nullable=False)  # juice / ferment
     stock_qty = Column(Integer, nullable=False, default=0)
-    parent_token = Column(String(64), nullable=True)  # upstream material/semi/product token
+    parent_token = Column(String(64), nullable=True, index=True)  # upstream material/semi/product token
     qr_token = Column(String(64), unique=True, nullable=False)
     work_order_id = Column(Integer, ForeignKey("work_orders.id"), nullable=True)
     operator_id = Column(Integer, ForeignKey("personnel.id"), nullable=True)
@@ -166,6 +217,7 @@ class SemiProduct(Base):
 
 class StocktakeRecord(Base):
     __tablename__ = "stocktake_records"
+    __table_args__ = (Index("ix_stocktake_records_created_at_id", "created_at", "id"),)
 
     id = Column(Integer, primary_key=True, index=True)
     item_type = Column(String(50), nullable=False)  # material/product
@@ -174,3 +226,29 @@ class StocktakeRecord(Base):
     delta = Column(Integer, nullable=False, default=0)
     note = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class QrToken(Base):
+    __tablename__ = "qr_tokens"
+
+    token = Column(String(64), primary_key=True)
+    object_type = Column(String(50), nullable=False)  # material/personnel/product/semi_product/work_order/work_order_completion
+    object_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class LineageClosure(Base):
+    __tablename__ = "lineage_closure"
+    __table_args__ = (Index("ix_lineage_closure_descendant_depth", "descendant_token", "depth"),)
+
+    ancestor_token = Column(String(64), primary_key=True)
+    descendant_token = Column(String(64), primary_key=True)
+    depth = Column(Integer, nullable=False, default=0)  # 0 = self row for semi/product nodes
+
+
+class ResourceVersion(Base):
+    __tablename__ = "resource_versions"
+
+    name = Column(String(64), primary_key=True)  # table name of the resource
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
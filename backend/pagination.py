@@ -0,0 +1,100 @@
+"""列表接口的游标分页（按 created_at,id 键集）与通用过滤参数。"""
+import base64
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+from flask import request
+from sqlalchemy import and_, or_
+
+from serializers import TZ
+from services import current_services
+
+
+class BadPageRequest(ValueError):
+    """Raised for malformed limit/cursor/date parameters; endpoints turn it into a 400."""
+
+
+def encode_cursor(created_at: datetime | None, row_id: int) -> str:
+    raw = f"{created_at.isoformat() if created_at else ''}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode("ascii")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("ascii")
+        ts, row_id = raw.rsplit("|", 1)
+        return (datetime.fromisoformat(ts) if ts else None), int(row_id)
+    except ValueError as err:
+        raise BadPageRequest("invalid cursor") from err
+
+
+def parse_datetime(value: str) -> datetime:
+    """Parse an ISO date/datetime filter; naive values are UTC+8 like the API output. Returns naive UTC for comparison."""
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError as err:
+        raise BadPageRequest(f"invalid datetime: {value}") from err
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=TZ)
+    return dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def page_limit() -> int:
+    """Page size for this request: ?limit= (DEFAULT_PAGE_SIZE with only a cursor), capped at MAX_PAGE_SIZE.
+
+    Requests with neither limit nor cursor get MAX_PAGE_SIZE rows and an X-Next-Cursor if more remain.
+    """
+    settings = current_services().settings
+    if "limit" not in request.args and "cursor" not in request.args:
+        return settings["MAX_PAGE_SIZE"]
+    limit = request.args.get("limit", settings["DEFAULT_PAGE_SIZE"], type=int)
+    if limit is None or limit <= 0:
+        raise BadPageRequest("limit must be a positive integer")
+    return min(limit, settings["MAX_PAGE_SIZE"])
+
+
+def apply_filters(stmt, model, fields=()):
+    """Apply ?created_from=&created_to= plus exact-match filters for the given column names."""
+    if request.args.get("created_from"):
+        stmt = stmt.where(model.created_at >= parse_datetime(request.args["created_from"]))
+    if request.args.get("created_to"):
+        stmt = stmt.where(model.created_at < parse_datetime(request.args["created_to"]))
+    for field in fields:
+        value = request.args.get(field)
+        if value:
+            stmt = stmt.where(getattr(model, field) == value)
+    return stmt
+
+
+def paginate(session, stmt, model, descending: bool = True):
+    """Run stmt one keyset page at a time; returns (rows, next_cursor or None).
+
+    stmt may select the entity (rows are ORM objects) or a column projection (rows are Row tuples).
+    """
+    limit = page_limit()
+    cursor = request.args.get("cursor")
+    created_at, row_id = model.created_at, model.id
+    if cursor:
+        ts, last_id = decode_cursor(cursor)
+        if descending:
+            stmt = stmt.where(or_(created_at < ts, and_(created_at == ts, row_id < last_id)))
+        else:
+            stmt = stmt.where(or_(created_at > ts, and_(created_at == ts, row_id > last_id)))
+    order = (created_at.desc(), row_id.desc()) if descending else (created_at.asc(), row_id.asc())
+    stmt = stmt.order_by(*order)
+    stmt = stmt.limit(limit + 1)
+    result = session.execute(stmt)
+    rows = result.scalars().all() if len(stmt.column_descriptions) == 1 else result.all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1].created_at, rows[-1].id)
+
+
+def page_response(resp, next_cursor: str | None):
+    """Attach the next-page cursor as headers so list bodies stay plain JSON arrays for existing clients."""
+    if next_cursor:
+        resp.headers["X-Next-Cursor"] = next_cursor
+        args = {**request.args.to_dict(), "cursor": next_cursor}
+        resp.headers["Link"] = f'<{request.path}?{urlencode(args)}>; rel="next"'
+    return resp
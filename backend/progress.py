@@ -0,0 +1,46 @@
+"""工单进度：写入进度记录时同步累加工单上的实绩/不良合计，列表与完工判断不再逐单 SUM。"""
+from sqlalchemy import func, select, update
+
+from models import WorkOrder, WorkOrderProgress
+from versions import bump_versions
+
+
+def add_progress(session, wo: WorkOrder, actual_qty: int, defect_qty: int = 0, operator_id: int | None = None, note: str | None = None):
+    """Insert a progress row and bump wo's running totals with an in-database increment; returns the new row.
+
+    The totals are written as ``actual_qty = actual_qty + :n`` so concurrent reports never lose an update;
+    reading wo.actual_qty afterwards reloads the committed-plus-ours value.
+    """
+    prog = WorkOrderProgress(
+        work_order_id=wo.id,
+        actual_qty=actual_qty,
+        defect_qty=defect_qty,
+        operator_id=operator_id,
+        note=note,
+    )
+    session.add(prog)
+    wo.actual_qty = WorkOrder.actual_qty + actual_qty
+    wo.defect_qty = WorkOrder.defect_qty + defect_qty
+    bump_versions(session, "work_orders", "work_order_progress")
+    session.flush()
+    return prog
+
+
+def recompute_work_order_totals(session) -> int:
+    """Rebuild every work order's totals from progress history with one grouped query; returns orders updated."""
+    totals = session.execute(
+        select(
+            WorkOrderProgress.work_order_id,
+            func.coalesce(func.sum(WorkOrderProgress.actual_qty), 0),
+            func.coalesce(func.sum(WorkOrderProgress.defect_qty), 0),
+        ).group_by(WorkOrderProgress.work_order_id)
+    ).all()
+    session.execute(update(WorkOrder).values(actual_qty=0, defect_qty=0))
+    if totals:
+        session.execute(
+            update(WorkOrder),
+            [{"id": wo_id, "actual_qty": int(actual), "defect_qty": int(defect)} for wo_id, actual, defect in totals],
+        )
+    bump_versions(session, "work_orders")
+    session.commit()
+    return len(totals)
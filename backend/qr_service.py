@@ -0,0 +1,179 @@
+"""二维码渲染服务：PNG 编码与落盘放到后台线程池，请求事务提交后即可返回 token。"""
+import base64
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter
+
+from metrics import observe_qr_render
+
+# QR_OUTPUT_DIR 未配置时的落盘目录；磁盘缓存位于其下 cache/
+DEFAULT_OUTPUT_DIR = Path(__file__).resolve().parent / "qrcodes"
+
+DEFAULT_BOX_SIZE = 8
+DEFAULT_BORDER = 2
+# 渲染参数或二维码库升级时递增，使旧 ETag 与磁盘缓存失效
+RENDER_VERSION = "1"
+MIMETYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+def make_qr_image(data: str, box_size: int = DEFAULT_BOX_SIZE, border: int = DEFAULT_BORDER):
+    """Build the QR code as a PIL image; shared by single PNGs and label sheets."""
+    import qrcode
+    from qrcode.image.pil import PilImage
+
+    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=box_size, border=border)
+    qr.add_data(data)
+    qr.make(fit=True)
+    # Use PIL image backend so we can save with format="PNG" without PyPNG issues
+    img: PilImage = qr.make_image(image_factory=PilImage, fill_color="black", back_color="white")
+    return img.get_image()
+
+
+def render_qr_png(data: str, box_size: int = DEFAULT_BOX_SIZE, border: int = DEFAULT_BORDER) -> bytes:
+    img = make_qr_image(data, box_size=box_size, border=border)
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def render_qr_svg(data: str, box_size: int = DEFAULT_BOX_SIZE, border: int = DEFAULT_BORDER) -> bytes:
+    import qrcode
+    from qrcode.image.svg import SvgPathImage
+
+    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=box_size, border=border)
+    qr.add_data(data)
+    qr.make(fit=True)
+    buffer = io.BytesIO()
+    qr.make_image(image_factory=SvgPathImage).save(buffer)
+    return buffer.getvalue()
+
+
+RENDERERS = {"png": render_qr_png, "svg": render_qr_svg}
+
+
+class QrImageCache:
+    """Two-tier cache of rendered QR images: a byte-bounded in-memory LRU over files in cache_dir (<output dir>/cache/).
+
+    Keys are derived from (token, format, box_size, border, RENDER_VERSION); the same key always
+    yields the same bytes, so the key digest doubles as a strong ETag.
+    """
+
+    def __init__(self, max_bytes: int, cache_dir: Path):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self._data: OrderedDict[str, bytes] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(token: str, fmt: str = "png", box_size: int = DEFAULT_BOX_SIZE, border: int = DEFAULT_BORDER) -> str:
+        raw = f"{token}|{fmt}|{box_size}|{border}|{RENDER_VERSION}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+    def _path(self, key: str, fmt: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.{fmt}"
+
+    def _remember(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._data[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._size -= len(evicted)
+
+    def put(self, key: str, fmt: str, data: bytes):
+        path = self._path(key, fmt)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        self._remember(key, data)
+
+    def get(self, token: str, fmt: str = "png", box_size: int = DEFAULT_BOX_SIZE, border: int = DEFAULT_BORDER) -> tuple[bytes, str]:
+        """Return (image bytes, key), rendering and storing on a miss in both tiers."""
+        key = self.key(token, fmt, box_size, border)
+        with self._lock:
+            data = self._data.get(key)
+            if data is not None:
+                self._data.move_to_end(key)
+                return data, key
+        path = self._path(key, fmt)
+        if path.exists():
+            data = path.read_bytes()
+            self._remember(key, data)
+            return data, key
+        started = perf_counter()
+        data = RENDERERS[fmt](token, box_size=box_size, border=border)
+        observe_qr_render(fmt, perf_counter() - started)
+        self.put(key, fmt, data)
+        return data, key
+
+
+class QrRenderService:
+    """Background QR renderer; jobs are keyed by token so clients can wait on or poll them."""
+
+    def __init__(self, workers: int, max_jobs: int, image_cache: QrImageCache, output_dir: Path):
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.image_cache = image_cache
+        self.output_dir = output_dir
+        self._executor: ThreadPoolExecutor | None = None
+        self._jobs: OrderedDict[str, Future] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ThreadPoolExecutor:
+        # 首次使用时才建线程池，避免 import 阶段起线程
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="qr-render")
+        return self._executor
+
+    def submit(self, token: str, category: str = "misc", filename: str | None = None) -> Future:
+        future = self._pool().submit(self.generate_base64, token, category, filename)
+        with self._lock:
+            self._jobs[token] = future
+            self._jobs.move_to_end(token)
+            # 只淘汰已完成的旧任务，进行中的任务保留以便轮询
+            while len(self._jobs) > self.max_jobs:
+                oldest, job = next(iter(self._jobs.items()))
+                if not job.done():
+                    break
+                del self._jobs[oldest]
+        return future
+
+    def generate_base64(self, data: str, category: str = "misc", filename: str | None = None) -> str:
+        png, _ = self.image_cache.get(data)
+
+        # persist to categorized folder for printing/archival
+        save_dir = self.output_dir / category
+        save_dir.mkdir(parents=True, exist_ok=True)
+        file_name = filename or f"{data}.png"
+        (save_dir / file_name).write_bytes(png)
+
+        return base64.b64encode(png).decode("ascii")
+
+    def get(self, token: str) -> Future | None:
+        with self._lock:
+            return self._jobs.get(token)
+
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+def job_status(future: Future) -> dict:
+    if not future.done():
+        return {"status": "pending"}
+    err = future.exception()
+    if err is not None:
+        return {"status": "error", "error": str(err)}
+    return {"status": "done", "qr_image_base64": future.result()}
@@ -0,0 +1,169 @@
+"""SQL 诊断（默认关闭，SQL_DIAGNOSTICS=true 开启）：慢查询日志与运行时 N+1 检测。
+
+- 单条 SQL 耗时超过 SLOW_QUERY_MS 时记录语句、绑定参数与发起的接口；
+- 同一请求内同一语句形状（字面量与 IN 列表归一后的 SQL）执行超过 N_PLUS_ONE_THRESHOLD 次，记为 N+1 嫌疑；
+- 两类结果按进程汇总，GET /api/admin/sql 返回最严重的若干条。
+"""
+import logging
+import re
+import threading
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime
+from functools import lru_cache
+from time import perf_counter
+
+from flask import has_request_context, request
+from sqlalchemy import event
+
+from serializers import format_ts
+
+logger = logging.getLogger(__name__)
+
+BACKGROUND = "-"
+MAX_PARAMS_REPR = 500
+RECENT_SLOW = 100
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+# 展开后的 IN (?, ?, ...) / IN (%(id_1_1)s, ...) 不论长短归为同一形状
+_IN_LIST = re.compile(r"\bIN\s*\(\s*(?:\?|%s|%\(\w+\)s|:\w+)(?:\s*,\s*(?:\?|%s|%\(\w+\)s|:\w+))*\s*\)", re.IGNORECASE)
+_SPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=2048)
+def normalize(statement: str) -> str:
+    """Statement shape: literals become ?, expanded IN lists collapse to IN (?), whitespace is squeezed."""
+    shape = _STRING.sub("?", statement)
+    shape = _NUMBER.sub("?", shape)
+    shape = _IN_LIST.sub("IN (?)", shape)
+    return _SPACE.sub(" ", shape).strip()
+
+
+def _params_repr(parameters, executemany: bool) -> str:
+    if executemany and parameters:
+        text = f"{len(parameters)} rows, first: {parameters[0]!r}"
+    else:
+        text = repr(parameters)
+    return text if len(text) <= MAX_PARAMS_REPR else text[:MAX_PARAMS_REPR] + "..."
+
+
+def _endpoint() -> str:
+    if has_request_context():
+        return f"{request.method} {request.endpoint or request.path}"
+    return BACKGROUND
+
+
+class QueryDiagnostics:
+    """Process-wide aggregates of slow statements and N+1 suspects, keyed by (endpoint, shape)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.slow: dict[tuple[str, str], dict] = {}
+            self.suspects: dict[tuple[str, str], dict] = {}
+            self.recent: deque[dict] = deque(maxlen=RECENT_SLOW)
+
+    def record_slow(self, endpoint: str, statement: str, params: str, elapsed_ms: float):
+        shape = normalize(statement)
+        now = format_ts(datetime.utcnow())
+        with self._lock:
+            entry = self.slow.get((endpoint, shape))
+            if entry is None:
+                entry = self.slow[(endpoint, shape)] = {"endpoint": endpoint, "statement": shape, "count": 0, "total_ms": 0.0, "max_ms": 0.0}
+            entry["count"] += 1
+            entry["total_ms"] += elapsed_ms
+            entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+            entry["last_params"] = params
+            entry["last_seen"] = now
+            self.recent.append({"endpoint": endpoint, "statement": statement, "params": params, "ms": round(elapsed_ms, 2), "at": now})
+
+    def record_suspect(self, endpoint: str, shape: str, repeats: int, total_ms: float):
+        with self._lock:
+            entry = self.suspects.get((endpoint, shape))
+            if entry is None:
+                entry = self.suspects[(endpoint, shape)] = {"endpoint": endpoint, "statement": shape, "requests": 0, "max_repeats": 0, "total_repeats": 0, "total_ms": 0.0}
+            entry["requests"] += 1
+            entry["max_repeats"] = max(entry["max_repeats"], repeats)
+            entry["total_repeats"] += repeats
+            entry["total_ms"] += total_ms
+            entry["last_seen"] = format_ts(datetime.utcnow())
+
+    def summary(self, limit: int) -> dict:
+        """Worst offenders first: slow shapes by total time, N+1 suspects by total repeats."""
+        with self._lock:
+            slow = sorted(self.slow.values(), key=lambda e: e["total_ms"], reverse=True)[:limit]
+            suspects = sorted(self.suspects.values(), key=lambda e: e["total_repeats"], reverse=True)[:limit]
+            recent = list(self.recent)[-limit:]
+        rounded = lambda e: {k: round(v, 2) if isinstance(v, float) else v for k, v in e.items()}
+        return {
+            "slow_queries": [rounded(e) for e in slow],
+            "n_plus_one": [rounded(e) for e in suspects],
+            "recent_slow": recent[::-1],
+        }
+
+
+diagnostics = QueryDiagnostics()
+
+# 当前请求内各语句形状的 [执行次数, 累计毫秒]；请求之外为 None，不做 N+1 统计
+_shapes: ContextVar[dict[str, list] | None] = ContextVar("sql_shapes", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._diag_started = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany, slow_query_ms: float):
+    started = getattr(context, "_diag_started", None)
+    if started is None:
+        return
+    elapsed_ms = (perf_counter() - started) * 1000
+    shapes = _shapes.get()
+    if shapes is not None:
+        counts = shapes.get(statement)
+        if counts is None:
+            counts = shapes[statement] = [0, 0.0]
+        counts[0] += 1
+        counts[1] += elapsed_ms
+    if elapsed_ms >= slow_query_ms:
+        endpoint = _endpoint()
+        params = _params_repr(parameters, executemany)
+        logger.warning("slow query %.1f ms [%s] %s -- params %s", elapsed_ms, endpoint, _SPACE.sub(" ", statement), params)
+        diagnostics.record_slow(endpoint, statement, params, elapsed_ms)
+
+
+def install(engine, slow_query_ms: float):
+    """Attach the listeners to engine (once per engine built by an app with SQL_DIAGNOSTICS on)."""
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        _after_cursor_execute(conn, cursor, statement, parameters, context, executemany, slow_query_ms)
+
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+def start_request():
+    _shapes.set({})
+
+
+def finish_request(threshold: int):
+    """Flag statement shapes the current request ran more than threshold (N_PLUS_ONE_THRESHOLD) times."""
+    shapes = _shapes.get()
+    if shapes is None:
+        return
+    _shapes.set(None)
+    # 计数按原始语句累加（免去每条都归一化），此处再按形状合并
+    merged: dict[str, list] = {}
+    for statement, (count, total_ms) in shapes.items():
+        entry = merged.setdefault(normalize(statement), [0, 0.0])
+        entry[0] += count
+        entry[1] += total_ms
+    endpoint = None
+    for shape, (count, total_ms) in merged.items():
+        if count > threshold:
+            endpoint = endpoint or _endpoint()
+            logger.warning("N+1 suspect [%s] %d x %s", endpoint, count, shape)
+            diagnostics.record_suspect(endpoint, shape, count, total_ms)
@@ -0,0 +1,219 @@
+from datetime import datetime, timezone, timedelta
+
+from models import (
+    Material,
+    Personnel,
+    Product,
+    Process,
+    User,
+    WorkOrder,
+    WorkOrderProgress,
+    WorkOrderException,
+    InspectionRecord,
+    MaterialReceipt,
+    ProductInventoryMove,
+    SemiProduct,
+)
+
+TZ = timezone(timedelta(hours=8))  # UTC+8
+_TZ_OFFSET = TZ.utcoffset(None)
+_TZ_SUFFIX = datetime(2000, 1, 1, tzinfo=TZ).isoformat()[-6:]  # "+08:00"
+
+
+def format_ts(dt):
+    if not dt:
+        return None
+    # Assume stored as UTC naive; shifting by the fixed offset gives the same string as astimezone(TZ) without tz objects
+    if dt.tzinfo is None:
+        return (dt + _TZ_OFFSET).isoformat() + _TZ_SUFFIX
+    return dt.astimezone(TZ).isoformat()
+
+
+def format_ts_many(values) -> list:
+    """format_ts over a whole column at once."""
+    offset, suffix = _TZ_OFFSET, _TZ_SUFFIX
+    return [
+        None if not v else (v + offset).isoformat() + suffix if v.tzinfo is None else v.astimezone(TZ).isoformat()
+        for v in values
+    ]
+
+
+def columns_of(model, exclude=()):
+    """Column-only select list for model; the table's column order matches the *_to_dict field order."""
+    return tuple(getattr(model, c.key) for c in model.__table__.columns if c.key not in exclude)
+
+
+def rows_to_dicts(rows, ts_fields=("created_at",)) -> list[dict]:
+    """Turn projected Row tuples into API dicts without ORM entities; timestamp columns are formatted in one pass."""
+    if not rows:
+        return []
+    keys = rows[0]._fields
+    items = [dict(zip(keys, row)) for row in rows]
+    for field in ts_fields:
+        if field in keys:
+            for item, value in zip(items, format_ts_many([item[field] for item in items])):
+                item[field] = value
+    return items
+
+
+def material_to_dict(m: Material):
+    return {
+        "id": m.id,
+        "name": m.name,
+        "batch_code": m.batch_code,
+        "supplier": m.supplier,
+        "inspection_result": m.inspection_result,
+        "stock_qty": m.stock_qty,
+        "qr_token": m.qr_token,
+        "extra": m.extra,
+        "created_at": format_ts(m.created_at),
+    }
+
+
+def personnel_to_dict(p: Personnel):
+    return {
+        "id": p.id,
+        "name": p.name,
+        "employee_id": p.employee_id,
+        "role": p.role,
+        "allowed_operations": p.allowed_operations,
+        "qr_token": p.qr_token,
+        "created_at": format_ts(p.created_at),
+    }
+
+
+def product_to_dict(p: Product):
+    return {
+        "id": p.id,
+        "name": p.name,
+        "status": p.status,
+        "final_inspection": p.final_inspection,
+        "linked_materials": p.linked_materials,
+        "process_data": p.process_data,
+        "parent_token": p.parent_token,
+        "qty": p.qty,
+        "inspection_qr_token": p.inspection_qr_token,
+        "qr_token": p.qr_token,
+        "created_at": format_ts(p.created_at),
+    }
+
+
+def semi_product_to_dict(sp: SemiProduct):
+    return {
+        "id": sp.id,
+        "name": sp.name,
+        "stage": sp.stage,
+        "stock_qty": sp.stock_qty,
+        "parent_token": sp.parent_token,
+        "qr_token": sp.qr_token,
+        "work_order_id": sp.work_order_id,
+        "operator_id": sp.operator_id,
+        "created_at": format_ts(sp.created_at),
+    }
+
+
+def process_to_dict(p: Process):
+    return {
+        "id": p.id,
+        "name": p.name,
+        "sequence": p.sequence,
+        "description": p.description,
+        "created_at": format_ts(p.created_at),
+    }
+
+
+def user_to_dict(u: User):
+    return {
+        "id": u.id,
+        "username": u.username,
+        "name": u.name,
+        "role": u.role,
+        "permissions": u.permissions,
+        "is_active": u.is_active,
+        "created_at": u.created_at.isoformat(),
+    }
+
+
+def work_order_to_dict(w: WorkOrder):
+    return {
+        "id": w.id,
+        "code": w.code,
+        "product_name": w.product_name,
+        "material_batch": w.material_batch,
+        "plan_qty": w.plan_qty,
+        "line": w.line,
+        "status": w.status,
+        "planned_start": w.planned_start,
+        "planned_end": w.planned_end,
+        "qr_token": w.qr_token,
+        "completion_qr_token": w.completion_qr_token,
+        "actual_qty": int(w.actual_qty or 0),
+        "defect_qty": int(w.defect_qty or 0),
+        "created_by": w.created_by,
+        "notes": w.notes,
+        "created_at": format_ts(w.created_at),
+    }
+
+
+def progress_to_dict(p: WorkOrderProgress):
+    return {
+        "id": p.id,
+        "work_order_id": p.work_order_id,
+        "actual_qty": p.actual_qty,
+        "defect_qty": p.defect_qty,
+        "operator_id": p.operator_id,
+        "note": p.note,
+        "created_at": format_ts(p.created_at),
+    }
+
+
+def exception_to_dict(e: WorkOrderException):
+    return {
+        "id": e.id,
+        "work_order_id": e.work_order_id,
+        "exception_type": e.exception_type,
+        "description": e.description,
+        "action": e.action,
+        "status": e.status,
+        "resolved_at": format_ts(e.resolved_at),
+        "created_at": format_ts(e.created_at),
+    }
+
+
+def inspection_to_dict(r: InspectionRecord):
+    return {
+        "id": r.id,
+        "object_type": r.object_type,
+        "object_token": r.object_token,
+        "result": r.result,
+        "inspector": r.inspector,
+        "items": r.items,
+        "note": r.note,
+        "created_at": format_ts(r.created_at),
+    }
+
+
+def receipt_to_dict(r: MaterialReceipt):
+    return {
+        "id": r.id,
+        "material_id": r.material_id,
+        "location": r.location,
+        "qty": r.qty,
+        "operator": r.operator,
+        "created_at": format_ts(r.created_at),
+    }
+
+
+def product_move_to_dict(m: ProductInventoryMove):
+    return {
+        "id": m.id,
+        "product_id": m.product_id,
+        "product_name": m.product_name,
+        "direction": m.direction,
+        "qty": m.qty,
+        "location": m.location,
+        "order_code": m.order_code,
+        "customer": m.customer,
+        "note": m.note,
+        "created_at": format_ts(m.created_at),
+    }
@@ -0,0 +1,143 @@
+"""生产部署入口：gunicorn 预派生多进程 + 线程（gthread），证书存在时启用 HTTPS。
+
+用法（在 backend/ 目录）：python serve.py
+- 建表/迁移只在主进程派生工作进程前执行一次（子进程运行 `flask db-upgrade`），工作进程首个请求只核对版本、不再迁移；
+- `kill -HUP <主进程 pid>` 平滑重载：先执行新代码的迁移，再逐个替换工作进程，处理中的请求不受影响；
+- `kill -TERM` 平滑退出，最多等待 WEB_GRACEFUL_TIMEOUT 秒。
+
+`python serve.py events` 启动 SSE 专用推送服务（gevent 协程，EVENTS_PORT），由上游把 /api/events 转发过去；
+事件经 EVENT_BUS=redis 从接口进程送达，长连接不占接口进程的线程。
+"""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+EVENTS_MODE = sys.argv[1:2] == ["events"]
+
+# 必须在导入 config 之前设置：迁移由主进程统一执行，工作进程发现版本落后时报错而不是各自迁移
+os.environ["SCHEMA_AUTO_UPGRADE"] = "false"
+if not EVENTS_MODE:
+    # 接口进程里每条 SSE 连接占住一个线程：默认最多让一半线程挂推送，看板应连专用推送服务
+    os.environ.setdefault("SSE_MAX_STREAMS", str(max(1, int(os.getenv("WEB_THREADS", "4")) // 2)))
+    # 进程内追溯缓存只会被处理写请求的那个工作进程失效，其他进程会返回旧链路：多进程时默认关闭，共享缓存用 TRACE_CACHE=redis
+    if int(os.getenv("WEB_WORKERS", "0")) != 1:
+        os.environ.setdefault("TRACE_CACHE", "off")
+
+import config  # noqa: E402
+
+BASE_DIR = Path(__file__).resolve().parent
+
+
+def tls_files():
+    """(certfile, keyfile) from SSL_CERTFILE/SSL_KEYFILE or backend/cert.pem + key.pem, or None for plain HTTP."""
+    cert = Path(config.SSL_CERTFILE) if config.SSL_CERTFILE else BASE_DIR / "cert.pem"
+    key = Path(config.SSL_KEYFILE) if config.SSL_KEYFILE else BASE_DIR / "key.pem"
+    if cert.exists() and key.exists():
+        return str(cert), str(key)
+    return None
+
+
+def upgrade_schema(server):
+    # 迁移放在子进程里跑：主进程不持有数据库连接，也不加载业务代码，重载时总能用上新代码
+    server.log.info("applying schema migrations")
+    subprocess.run([sys.executable, "-m", "flask", "--app", "app", "db-upgrade"], cwd=BASE_DIR, check=True)
+
+
+def events_options() -> dict:
+    """Gunicorn settings for the dedicated SSE server: gevent workers hold thousands of idle streams each."""
+    opts = {
+        "bind": f"{config.HOST}:{config.EVENTS_PORT}",
+        "workers": config.EVENTS_WORKERS,
+        "worker_class": "gevent",
+        "worker_connections": config.EVENTS_CONNECTIONS,
+        "timeout": config.WEB_TIMEOUT,
+        "graceful_timeout": config.WEB_GRACEFUL_TIMEOUT,
+        "chdir": str(BASE_DIR),
+        "accesslog": "-",
+        "errorlog": "-",
+        "preload_app": False,
+    }
+    if config.WEB_PIDFILE:
+        opts["pidfile"] = config.WEB_PIDFILE + ".events"
+    tls = tls_files()
+    if tls:
+        opts["certfile"], opts["keyfile"] = tls
+    return opts
+
+
+def options() -> dict:
+    workers = config.WEB_WORKERS or (os.cpu_count() or 1) * 2 + 1
+    opts = {
+        "bind": f"{config.HOST}:{config.PORT}",
+        "workers": workers,
+        "threads": config.WEB_THREADS,
+        "worker_class": "gthread" if config.WEB_THREADS > 1 else "sync",
+        "timeout": config.WEB_TIMEOUT,
+        "graceful_timeout": config.WEB_GRACEFUL_TIMEOUT,
+        "max_requests": config.WEB_MAX_REQUESTS,
+        "max_requests_jitter": config.WEB_MAX_REQUESTS // 10,
+        "chdir": str(BASE_DIR),
+        "accesslog": "-",
+        "errorlog": "-",
+        "preload_app": False,
+        "on_starting": upgrade_schema,
+        "on_reload": upgrade_schema,
+    }
+    if config.WEB_PIDFILE:
+        opts["pidfile"] = config.WEB_PIDFILE
+    tls = tls_files()
+    if tls:
+        opts["certfile"], opts["keyfile"] = tls
+    return opts
+
+
+def main():
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        sys.exit("serve.py needs gunicorn (Linux/macOS): pip install -r requirements.txt; on Windows use `python app.py` for development")
+
+    class MesServer(BaseApplication):
+        def __init__(self, opts: dict):
+            self.opts = opts
+            super().__init__()
+
+        def load_config(self):
+            for name, value in self.opts.items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            # 每个工作进程各自建 app，连接池、线程池都在派生之后创建
+            from app import create_app
+
+            return create_app()
+
+    if EVENTS_MODE:
+        if config.EVENT_BUS != "redis":
+            sys.exit("serve.py events needs EVENT_BUS=redis: writes are handled by the API workers, not by this server")
+        try:
+            import gevent  # noqa: F401
+        except ImportError:
+            sys.exit("serve.py events needs gevent: pip install gevent redis")
+        opts = events_options()
+    else:
+        opts = options()
+        if opts["workers"] > 1 and config.TRACE_CACHE == "memory":
+            sys.exit(
+                f"TRACE_CACHE=memory with {opts['workers']} workers: a write only invalidates the cache of the worker that "
+                "handled it; set TRACE_CACHE=redis, or TRACE_CACHE=off"
+            )
+        if opts["workers"] > 1 and config.EVENT_BUS != "redis":
+            print(
+                f"warning: {opts['workers']} workers with EVENT_BUS={config.EVENT_BUS}: SSE clients only see writes handled by "
+                "their own worker; set EVENT_BUS=redis",
+                file=sys.stderr,
+            )
+    if "certfile" not in opts:
+        print("cert.pem/key.pem not found, serving plain HTTP", file=sys.stderr)
+    MesServer(opts).run()
+
+
+if __name__ == "__main__":
+    main()
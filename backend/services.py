@@ -0,0 +1,86 @@
+"""应用级服务：create_app 按本应用的设置构建数据库引擎、会话工厂、追溯缓存、二维码渲染、扫码缓存与事件总线，挂在 app.extensions["mes"] 上。
+
+设置 = config.py（环境变量）+ create_app 的 overrides，只存在本应用的 Services 里，不回写 config 模块，
+同一进程内设置不同的两个应用互不影响。导入本模块不建连接、不起线程。
+"""
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from flask import current_app
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import scoped_session
+
+import config
+from db import build_engine, session_factory
+from events import EventBroker, build_broker
+from migrations import ensure_schema
+from qr_service import DEFAULT_OUTPUT_DIR, QrImageCache, QrRenderService
+from tokens import TokenCache
+from tracecache import build_trace_cache
+
+EXTENSION = "mes"
+
+
+def load_settings(overrides: dict | None = None) -> dict:
+    """config.py settings with overrides applied; unknown names raise KeyError."""
+    settings = {name: value for name, value in vars(config).items() if name.isupper()}
+    for name, value in (overrides or {}).items():
+        if name not in settings:
+            raise KeyError(f"unknown setting: {name}")
+        settings[name] = value
+    return settings
+
+
+@dataclass
+class Services:
+    settings: dict
+    engine: Engine
+    read_engine: Engine  # 未配置只读副本时与 engine 为同一对象
+    session: scoped_session
+    trace_cache: object
+    image_cache: QrImageCache
+    qr_service: QrRenderService
+    token_cache: TokenCache
+    broker: EventBroker
+    schema_verified: bool = False  # 本应用的主库已核对过迁移版本；随应用而非进程记录，同一 URL 的新应用（如重建的库）会重新核对
+    _schema_lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def verify_schema(self):
+        """Run ensure_schema on this app's primary once; later calls are a flag check, failures retry next time."""
+        if self.schema_verified:
+            return
+        with self._schema_lock:
+            if not self.schema_verified:
+                ensure_schema(self.engine, auto_upgrade=self.settings["SCHEMA_AUTO_UPGRADE"])
+                self.schema_verified = True
+
+    def close(self):
+        """Finish queued QR renders and release pooled connections (CLI commands, benchmarks)."""
+        self.qr_service.shutdown(wait=True)
+        self.session.remove()
+        for eng in {self.engine, self.read_engine}:
+            eng.dispose()
+
+
+def build_services(settings: dict) -> Services:
+    engine = build_engine(settings["DATABASE_URL"], settings)
+    read_engine = build_engine(settings["READ_DATABASE_URL"], settings) if settings["READ_DATABASE_URL"] else engine
+    output_dir = Path(settings["QR_OUTPUT_DIR"]) if settings["QR_OUTPUT_DIR"] else DEFAULT_OUTPUT_DIR
+    image_cache = QrImageCache(settings["QR_IMAGE_CACHE_BYTES"], output_dir / "cache")
+    return Services(
+        settings=settings,
+        engine=engine,
+        read_engine=read_engine,
+        session=session_factory(engine, read_engine),
+        trace_cache=build_trace_cache(settings),
+        image_cache=image_cache,
+        qr_service=QrRenderService(settings["QR_RENDER_WORKERS"], settings["QR_JOB_HISTORY"], image_cache, output_dir),
+        token_cache=TokenCache(settings["TOKEN_CACHE_SIZE"]),
+        broker=build_broker(settings),
+    )
+
+
+def current_services() -> Services:
+    """Services of the app handling the current request / CLI command."""
+    return current_app.extensions[EXTENSION]
@@ -0,0 +1,37 @@
+"""库存变更：单条条件 UPDATE 原子扣减/增加，并发扣减同一批次时不会丢失更新或超扣。"""
+from sqlalchemy import func, update
+
+from versions import bump_versions
+
+
+def consume_stock(session, obj, qty: int) -> bool:
+    """Atomically take qty from obj.stock_qty if enough is left; returns False (and changes nothing) otherwise."""
+    if qty <= 0:
+        return True
+    model = type(obj)
+    result = session.execute(
+        update(model)
+        .where(model.id == obj.id, model.stock_qty >= qty)
+        .values(stock_qty=model.stock_qty - qty)
+        .execution_options(synchronize_session=False)
+    )
+    session.expire(obj, ["stock_qty"])
+    if result.rowcount != 1:
+        return False
+    bump_versions(session, model.__tablename__)
+    return True
+
+
+def add_stock(session, obj, qty: int):
+    """Atomically add qty to obj.stock_qty."""
+    if not qty:
+        return
+    model = type(obj)
+    session.execute(
+        update(model)
+        .where(model.id == obj.id)
+        .values(stock_qty=func.coalesce(model.stock_qty, 0) + qty)
+        .execution_options(synchronize_session=False)
+    )
+    session.expire(obj, ["stock_qty"])
+    bump_versions(session, model.__tablename__)
@@ -0,0 +1,114 @@
+"""二维码 token 注册表：token -> (对象类型, 行 id)，供扫码一次索引查询定位对象。"""
+import threading
+import uuid
+from collections import OrderedDict
+
+from sqlalchemy import select
+
+from models import Material, Personnel, Product, QrToken, SemiProduct, WorkOrder
+
+# 对象类型 -> 模型，扫码时按注册表中的类型直接主键取行
+TOKEN_MODELS = {
+    "material": Material,
+    "personnel": Personnel,
+    "product": Product,
+    "semi_product": SemiProduct,
+    "work_order": WorkOrder,
+    "work_order_completion": WorkOrder,
+}
+
+
+class TokenCache:
+    """Thread-safe LRU of token -> (object_type, object_id); tokens are never reassigned so entries never go stale."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict[str, tuple[str, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str):
+        if self.maxsize <= 0:
+            return None
+        with self._lock:
+            entry = self._data.get(token)
+            if entry is not None:
+                self._data.move_to_end(token)
+            return entry
+
+    def put(self, token: str, entry: tuple[str, int]):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[token] = entry
+            self._data.move_to_end(token)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+
+def new_token() -> str:
+    return uuid.uuid4().hex
+
+
+def register_token(session, token: str | None, object_type: str, object_id: int):
+    """Record a freshly issued token in the registry; the caller commits with the owning row."""
+    if not token:
+        return
+    session.add(QrToken(token=token, object_type=object_type, object_id=object_id))
+
+
+def register_tokens(session, entries):
+    """Bulk variant of register_token for (token, object_type, object_id) tuples."""
+    rows = [{"token": t, "object_type": typ, "object_id": oid} for t, typ, oid in entries if t]
+    if rows:
+        session.execute(QrToken.__table__.insert(), rows)
+
+
+def resolve_token(session, token: str, cache: TokenCache | None = None):
+    """Return (object_type, object_id) for a token, or None if it was never issued; cache is the app's TokenCache."""
+    entry = cache.get(token) if cache is not None else None
+    if entry is not None:
+        return entry
+    row = session.get(QrToken, token)
+    if not row:
+        return None
+    entry = (row.object_type, row.object_id)
+    if cache is not None:
+        cache.put(token, entry)
+    return entry
+
+
+def _existing_tokens(session) -> dict:
+    """Every token currently held by a business row, mapped to its registry entry."""
+    sources = [
+        ("material", Material.qr_token, Material.id),
+        ("personnel", Personnel.qr_token, Personnel.id),
+        ("product", Product.qr_token, Product.id),
+        ("product", Product.inspection_qr_token, Product.id),
+        ("semi_product", SemiProduct.qr_token, SemiProduct.id),
+        ("work_order", WorkOrder.qr_token, WorkOrder.id),
+        ("work_order_completion", WorkOrder.completion_qr_token, WorkOrder.id),
+    ]
+    found = {}
+    for object_type, token_col, id_col in sources:
+        for token, object_id in session.execute(select(token_col, id_col).where(token_col.is_not(None))):
+            found.setdefault(token, (object_type, object_id))
+    return found
+
+
+def backfill_tokens(session, batch_size: int = 1000) -> int:
+    """Register tokens issued before the registry existed; returns the number of rows inserted."""
+    registered = set(session.scalars(select(QrToken.token)).all())
+    missing = [
+        {"token": token, "object_type": object_type, "object_id": object_id}
+        for token, (object_type, object_id) in _existing_tokens(session).items()
+        if token not in registered
+    ]
+    for start in range(0, len(missing), batch_size):
+        session.execute(QrToken.__table__.insert(), missing[start : start + batch_size])
+    session.commit()
+    return len(missing)
@@ -0,0 +1,284 @@
+"""追溯引擎：基于血缘闭包表一次连接取出整条上下游链路，再批量取检验/物料/操作员，所有追溯接口共用。"""
+from sqlalchemy import case, func, or_, select
+
+from models import InspectionRecord, LineageClosure, Material, Personnel, Product, ProductInventoryMove, SemiProduct, WorkOrder, WorkOrderProgress
+from serializers import columns_of, format_ts, material_to_dict, personnel_to_dict, rows_to_dicts, work_order_to_dict
+from tracecache import material_batch_tag, wo_tag
+
+# 追溯只读取列投影（Row 元组），不构造 ORM 实体
+SEMI_COLUMNS = columns_of(SemiProduct)
+PRODUCT_COLUMNS = columns_of(Product)
+
+def upstream_chain(session, start_token: str | None):
+    """Return (semi_chain, last_parent) for start_token with one indexed join on the lineage closure.
+
+    semi_chain is ordered nearest-first and includes start_token itself when it is a SemiProduct;
+    last_parent is the first upstream token that is not a SemiProduct (normally the material token).
+    """
+    if not start_token:
+        return [], None
+    semi_chain = session.execute(
+        select(*SEMI_COLUMNS)
+        .join(LineageClosure, LineageClosure.ancestor_token == SemiProduct.qr_token)
+        .where(LineageClosure.descendant_token == start_token)
+        .order_by(LineageClosure.depth)
+    ).all()
+    last_parent = semi_chain[-1].parent_token if semi_chain else start_token
+    return semi_chain, last_parent
+
+
+def downstream_semis(session, root_token: str):
+    """Return every SemiProduct row descended from root_token (with a trailing depth column), in one indexed join."""
+    return session.execute(
+        select(*SEMI_COLUMNS, LineageClosure.depth)
+        .join(LineageClosure, LineageClosure.descendant_token == SemiProduct.qr_token)
+        .where(LineageClosure.ancestor_token == root_token, LineageClosure.depth > 0)
+        .order_by(LineageClosure.depth, SemiProduct.id)
+    ).all()
+
+
+def downstream_products(session, root_token: str):
+    """Return every Product descended from root_token, in one indexed join."""
+    return session.execute(
+        select(*PRODUCT_COLUMNS)
+        .join(LineageClosure, LineageClosure.descendant_token == Product.qr_token)
+        .where(LineageClosure.ancestor_token == root_token, LineageClosure.depth > 0)
+        .order_by(Product.id)
+    ).all()
+
+
+def _inspections_by_token(session, tokens):
+    """Fetch inspections for all tokens at once, newest first."""
+    tokens = [t for t in tokens if t]
+    if not tokens:
+        return []
+    return session.execute(
+        select(
+            InspectionRecord.object_type,
+            InspectionRecord.object_token,
+            InspectionRecord.result,
+            InspectionRecord.inspector,
+            InspectionRecord.note,
+            InspectionRecord.created_at,
+        )
+        .where(InspectionRecord.object_token.in_(tokens))
+        .order_by(InspectionRecord.created_at.desc())
+    ).all()
+
+
+def _operator_map(session, ids):
+    ids = {i for i in ids if i}
+    if not ids:
+        return {}
+    return {o.id: o for o in session.scalars(select(Personnel).where(Personnel.id.in_(ids))).all()}
+
+
+def _brief_inspection(i: InspectionRecord, with_token: bool = False):
+    data = {
+        "result": i.result,
+        "inspector": i.inspector,
+        "note": i.note,
+        "created_at": format_ts(i.created_at),
+    }
+    if with_token:
+        data = {"object_token": i.object_token, **data}
+    return data
+
+
+def _brief_material(m: Material):
+    return {
+        "name": m.name,
+        "batch_code": m.batch_code,
+        "supplier": m.supplier,
+        "inspection_result": m.inspection_result,
+    }
+
+
+def _chain_payload(semi_chain, operator_map):
+    result = rows_to_dicts(semi_chain)
+    for item in result:
+        op = operator_map.get(item["operator_id"])
+        item["operator"] = personnel_to_dict(op) if op else None
+    return result
+
+
+def semi_trace(session, semi: SemiProduct):
+    """Upstream chain of a semi-product plus its direct products and work order."""
+    semi_chain, last_parent = upstream_chain(session, semi.qr_token)
+    semi_tokens = [sp.qr_token for sp in semi_chain]
+
+    materials = []
+    if last_parent:
+        materials = session.scalars(select(Material).where(Material.qr_token == last_parent)).all()
+    material_tokens = {m.qr_token for m in materials}
+
+    inspections = _inspections_by_token(session, semi_tokens + list(material_tokens))
+    semi_token_set = set(semi_tokens)
+    semi_inspections = [i for i in inspections if i.object_token in semi_token_set]
+    material_inspections = [i for i in inspections if i.object_type == "material" and i.object_token in material_tokens]
+
+    operator_map = _operator_map(session, [sp.operator_id for sp in semi_chain])
+    products = session.execute(select(*PRODUCT_COLUMNS).where(Product.parent_token == semi.qr_token)).all()
+    work_order = session.get(WorkOrder, semi.work_order_id) if semi.work_order_id else None
+
+    return {
+        "semi_products": _chain_payload(semi_chain, operator_map),
+        "semi_inspections": [_brief_inspection(i, with_token=True) for i in semi_inspections],
+        "materials": [_brief_material(m) for m in materials],
+        "material_inspections": [_brief_inspection(i) for i in material_inspections],
+        "products": rows_to_dicts(products),
+        "work_order": work_order_to_dict(work_order) if work_order else None,
+    }
+
+
+def product_trace(session, product: Product):
+    """Full upstream trace of a finished product: work order, semi chain, materials, inspections and operators."""
+    work_order = None
+    if product.process_data:
+        work_order = session.scalars(select(WorkOrder).where(WorkOrder.code == product.process_data)).first()
+
+    semi_chain, last_parent = upstream_chain(session, product.parent_token)
+    semi_tokens = [sp.qr_token for sp in semi_chain]
+
+    # work_order.material_batch currently stores material name; also match batch_code for backward compatibility
+    material_filters = []
+    if work_order and work_order.material_batch:
+        material_filters += [Material.name == work_order.material_batch, Material.batch_code == work_order.material_batch]
+    if last_parent:
+        material_filters.append(Material.qr_token == last_parent)
+    materials = session.scalars(select(Material).where(or_(*material_filters)).order_by(Material.id)).all() if material_filters else []
+    material_tokens = {m.qr_token for m in materials}
+
+    inspections = _inspections_by_token(session, [product.qr_token] + semi_tokens + list(material_tokens))
+    semi_token_set = set(semi_tokens)
+    product_inspections = [i for i in inspections if i.object_type == "product" and i.object_token == product.qr_token]
+    semi_inspections = [i for i in inspections if i.object_token in semi_token_set]
+    material_inspections = [i for i in inspections if i.object_type == "material" and i.object_token in material_tokens]
+
+    progress_operator_ids = set()
+    if work_order:
+        progress_operator_ids = set(
+            session.scalars(
+                select(WorkOrderProgress.operator_id)
+                .where(WorkOrderProgress.work_order_id == work_order.id, WorkOrderProgress.operator_id.is_not(None))
+                .distinct()
+            ).all()
+        )
+    operator_map = _operator_map(session, [sp.operator_id for sp in semi_chain] + list(progress_operator_ids))
+    operators = [operator_map[i] for i in sorted(progress_operator_ids) if i in operator_map]
+
+    return {
+        "product": {
+            "name": product.name,
+            "status": product.status,
+            "final_inspection": product.final_inspection,
+            "parent_token": product.parent_token,
+            "qty": product.qty,
+            "inspection_qr_token": product.inspection_qr_token,
+            "created_at": format_ts(product.created_at),
+        },
+        "product_inspections": [_brief_inspection(i) for i in product_inspections],
+        "work_order": work_order_to_dict(work_order) if work_order else None,
+        "materials": [_brief_material(m) for m in materials],
+        "material_inspections": [_brief_inspection(i) for i in material_inspections],
+        "semi_products": _chain_payload(semi_chain, operator_map),
+        "semi_inspections": [_brief_inspection(i, with_token=True) for i in semi_inspections],
+        "operators": [
+            {
+                "name": p.name,
+                "employee_id": p.employee_id,
+                "role": p.role,
+            }
+            for p in operators
+        ],
+    }
+
+
+def material_trace(session, material: Material):
+    inspections = _inspections_by_token(session, [material.qr_token])
+    inspections = [i for i in inspections if i.object_type == "material"]
+    return {
+        "material": material_to_dict(material),
+        "material_inspections": [_brief_inspection(i) for i in inspections],
+    }
+
+
+def forward_trace(session, root_type: str, root_token: str, root_data: dict):
+    """Descendant tree of a material or semi-product for recalls, plus affected work orders and shipped quantities."""
+    descendants = downstream_semis(session, root_token)
+    products = downstream_products(session, root_token)
+
+    work_order_ids = {sp.work_order_id for sp in descendants if sp.work_order_id}
+    work_orders = []
+    if work_order_ids:
+        work_orders = rows_to_dicts(
+            session.execute(select(*columns_of(WorkOrder)).where(WorkOrder.id.in_(work_order_ids)).order_by(WorkOrder.id)).all()
+        )
+
+    moves = {}
+    if products:
+        rows = session.execute(
+            select(
+                ProductInventoryMove.product_id,
+                func.coalesce(func.sum(case((ProductInventoryMove.direction == "in", ProductInventoryMove.qty), else_=0)), 0),
+                func.coalesce(func.sum(case((ProductInventoryMove.direction == "out", ProductInventoryMove.qty), else_=0)), 0),
+            )
+            .where(ProductInventoryMove.product_id.in_([p.id for p in products]))
+            .group_by(ProductInventoryMove.product_id)
+        ).all()
+        moves = {pid: (int(qty_in), int(qty_out)) for pid, qty_in, qty_out in rows}
+
+    # 按 parent_token 把扁平结果拼回树
+    nodes = {root_token: {"type": root_type, "token": root_token, "depth": 0, "data": root_data, "children": []}}
+    depth_of = {root_token: 0}
+    semi_items = rows_to_dicts(descendants)
+    for item in semi_items:
+        depth = item.pop("depth")
+        depth_of[item["qr_token"]] = depth
+        nodes[item["qr_token"]] = {"type": "semi_product", "token": item["qr_token"], "depth": depth, "data": item, "children": []}
+    for item in semi_items:
+        nodes[item["parent_token"]]["children"].append(nodes[item["qr_token"]])
+
+    product_items = []
+    for item in rows_to_dicts(products):
+        qty_in, qty_out = moves.get(item["id"], (0, 0))
+        item.update(qty_in=qty_in, qty_shipped=qty_out)
+        product_items.append(item)
+        nodes[item["parent_token"]]["children"].append(
+            {"type": "product", "token": item["qr_token"], "depth": depth_of[item["parent_token"]] + 1, "data": item, "children": []}
+        )
+
+    return {
+        "root": nodes[root_token],
+        "semi_products": [{**item, "depth": depth_of[item["qr_token"]]} for item in semi_items],
+        "products": product_items,
+        "work_orders": work_orders,
+        "totals": {
+            "semi_products": len(descendants),
+            "products": len(products),
+            "qty_in": sum(p["qty_in"] for p in product_items),
+            "qty_shipped": sum(p["qty_shipped"] for p in product_items),
+        },
+    }
+
+
+def trace_tags(payload: dict) -> set[str]:
+    """Cache tags of a trace payload: every lineage token it shows plus the work orders / material batches it embeds."""
+    tags = set()
+    for key in ("semi_products", "products"):
+        for item in payload.get(key) or ():
+            tags.update(t for t in (item.get("qr_token"), item.get("parent_token")) if t)
+    product = payload.get("product") or {}
+    tags.update(t for t in (product.get("parent_token"), product.get("inspection_qr_token")) if t)
+    if payload.get("material"):
+        tags.add(payload["material"]["qr_token"])
+    if payload.get("root"):
+        tags.add(payload["root"]["token"])
+    work_orders = list(payload.get("work_orders") or ())
+    if payload.get("work_order"):
+        work_orders.append(payload["work_order"])
+    for wo in work_orders:
+        tags.add(wo_tag(wo["id"]))
+        if wo.get("material_batch"):
+            tags.add(material_batch_tag(wo["material_batch"]))
+    return tags
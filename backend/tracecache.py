@@ -0,0 +1,199 @@
+"""追溯响应缓存：按追溯类型 + token 缓存序列化后的响应体，条目带血缘标签（链路上各 token、工单 id）。
+
+写接口提交后按涉及的 token 失效标签，未触及的链路保持命中；TTL 兜底其余变更（人员改名等）。
+后端可选：memory（进程内 LRU，默认）或 redis（多工作进程共享，需要 pip install redis），off 关闭。
+"""
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - optional dependency
+    redis = None
+
+
+def wo_tag(work_order_id: int) -> str:
+    return f"wo:{work_order_id}"
+
+
+def material_batch_tag(value: str) -> str:
+    # 成品追溯按工单 material_batch 匹配物料名或批次号，同名/同批次号的新物料入库也要失效
+    return f"material-batch:{value}"
+
+
+class MemoryTraceCache:
+    """Per-process LRU with TTL and a tag -> keys index for invalidation."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, str, frozenset]] = OrderedDict()
+        self._tags: dict[str, set[str]] = {}
+        self._generation = 0
+        self._invalidated_at = 0.0
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def generation(self) -> int:
+        return self._generation
+
+    def invalidated_at(self) -> float:
+        """Wall-clock time of the latest invalidation (0 if none)."""
+        return self._invalidated_at
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, body: str, tags, since: int):
+        """Store body unless an invalidation ran after generation `since` (the body may predate it)."""
+        with self._lock:
+            if self._generation != since:
+                return
+            self._drop(key)
+            tags = frozenset(tags)
+            self._data[key] = (time.monotonic() + self.ttl, body, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._drop(next(iter(self._data)))
+
+    def _drop(self, key: str):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate(self, tags) -> int:
+        """Drop every entry carrying any of tags; returns how many were dropped."""
+        with self._lock:
+            self._generation += 1
+            self._invalidated_at = time.time()
+            keys = set()
+            for tag in tags:
+                keys |= self._tags.get(tag, set())
+            for key in keys:
+                self._drop(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._invalidated_at = time.time()
+            self._data.clear()
+            self._tags.clear()
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "entries": len(self._data), "maxsize": self.maxsize, "ttl": self.ttl, "hits": self.hits, "misses": self.misses}
+
+
+class RedisTraceCache:
+    """Shared cache for multi-worker deployments: entries and tag sets expire after ttl; size is bounded by Redis maxmemory."""
+
+    def __init__(self, url: str, ttl: float, prefix: str = "mes:trace:"):
+        if redis is None:
+            raise RuntimeError("TRACE_CACHE=redis but the redis package is not installed")
+        self.client = redis.Redis.from_url(url)
+        self.ttl = int(ttl)
+        self.prefix = prefix
+
+    def generation(self) -> int:
+        return int(self.client.get(self.prefix + "generation") or 0)
+
+    def invalidated_at(self) -> float:
+        return float(self.client.get(self.prefix + "invalidated_at") or 0)
+
+    def get(self, key: str) -> str | None:
+        body = self.client.get(self.prefix + key)
+        return body.decode("utf-8") if body is not None else None
+
+    def put(self, key: str, body: str, tags, since: int):
+        generation_key = self.prefix + "generation"
+        with self.client.pipeline() as pipe:
+            # WATCH 世代号：期间有失效则放弃写入
+            try:
+                pipe.watch(generation_key)
+                if int(pipe.get(generation_key) or 0) != since:
+                    return
+                pipe.multi()
+                pipe.set(self.prefix + key, body, ex=self.ttl)
+                for tag in tags:
+                    pipe.sadd(self.prefix + "tag:" + tag, key)
+                    pipe.expire(self.prefix + "tag:" + tag, self.ttl)
+                pipe.execute()
+            except redis.WatchError:
+                return
+
+    def invalidate(self, tags) -> int:
+        tag_keys = [self.prefix + "tag:" + tag for tag in tags]
+        if not tag_keys:
+            return 0
+        with self.client.pipeline() as pipe:
+            pipe.incr(self.prefix + "generation")
+            pipe.set(self.prefix + "invalidated_at", time.time(), ex=self.ttl)
+            pipe.sunion(tag_keys)
+            _, _, keys = pipe.execute()
+        if keys:
+            self.client.delete(*(self.prefix + k.decode("utf-8") for k in keys), *tag_keys)
+        return len(keys)
+
+    def clear(self):
+        self.client.incr(self.prefix + "generation")
+        keys = list(self.client.scan_iter(self.prefix + "*"))
+        keys = [k for k in keys if k != (self.prefix + "generation").encode()]
+        if keys:
+            self.client.delete(*keys)
+        self.client.set(self.prefix + "invalidated_at", time.time(), ex=self.ttl)
+
+    def stats(self) -> dict:
+        return {"backend": "redis", "ttl": self.ttl}
+
+
+class NullTraceCache:
+    """TRACE_CACHE=off: never stores anything."""
+
+    def generation(self) -> int:
+        return 0
+
+    def invalidated_at(self) -> float:
+        return 0.0
+
+    def get(self, key: str):
+        return None
+
+    def put(self, key: str, body: str, tags, since: int):
+        pass
+
+    def invalidate(self, tags) -> int:
+        return 0
+
+    def clear(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": "off"}
+
+
+def build_trace_cache(settings: dict):
+    backend = settings["TRACE_CACHE"]
+    if backend == "memory":
+        return MemoryTraceCache(settings["TRACE_CACHE_SIZE"], settings["TRACE_CACHE_TTL"])
+    if backend == "redis":
+        return RedisTraceCache(settings["TRACE_CACHE_URL"], settings["TRACE_CACHE_TTL"])
+    if backend == "off":
+        return NullTraceCache()
+    raise ValueError(f"unknown TRACE_CACHE backend: {backend}")
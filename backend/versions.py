@@ -0,0 +1,113 @@
+"""资源版本号：写事务提交后递增，读接口据此生成弱 ETag，未变化时直接 304。
+
+不发 Last-Modified：updated_at 只能精确到秒，同一秒内的第二次写入会让 If-Modified-Since 误判为未变化。
+
+版本行是所有写请求共享的热点行，不放进业务事务：bump_versions 只登记资源名，提交后由
+after_commit 钩子用一条独立的短语句统一递增，业务事务（库存条件扣减等）不会在版本行上互相排队。
+"""
+import hashlib
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+
+from flask import Response, request
+from sqlalchemy import event, insert, select, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from models import ResourceVersion
+
+logger = logging.getLogger(__name__)
+
+_PENDING = "pending_version_bumps"
+
+# 按表名跟踪的资源
+RESOURCES = (
+    "users",
+    "personnel",
+    "processes",
+    "materials",
+    "products",
+    "work_orders",
+    "work_order_progress",
+    "semi_products",
+    "inspection_records",
+)
+
+
+@dataclass(frozen=True)
+class Validators:
+    etag: str
+
+
+def seed_versions(session):
+    """Insert a version row for every tracked resource that does not have one yet."""
+    existing = set(session.scalars(select(ResourceVersion.name)).all())
+    missing = [{"name": name, "version": 0, "updated_at": datetime.utcnow()} for name in RESOURCES if name not in existing]
+    if missing:
+        session.execute(insert(ResourceVersion), missing)
+
+
+def bump_versions(session, *names: str):
+    """Mark resources as changed by session's transaction; their versions are bumped once it commits."""
+    if session.get_transaction() is None:
+        session.begin()
+    session.info.setdefault(_PENDING, set()).update(names)
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_after_commit(session):
+    names = session.info.pop(_PENDING, None)
+    if not names:
+        return
+    # 单条 IN 语句按主键顺序加锁，各写路径顺序一致，不会互相死锁
+    stmt = (
+        update(ResourceVersion)
+        .where(ResourceVersion.name.in_(sorted(names)))
+        .values(version=ResourceVersion.version + 1, updated_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    bind = session.get_bind(clause=stmt)
+    try:
+        if isinstance(bind, Connection):
+            # 绑定在外部连接上的会话（迁移）沿用该连接的事务
+            bind.execute(stmt)
+        else:
+            with bind.begin() as conn:
+                conn.execute(stmt)
+    except Exception:
+        # 数据已提交，版本号失败只会让客户端多拿一次旧的 304，下次写入时追平
+        logger.exception("failed to bump resource versions %s", sorted(names))
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _drop_pending_bumps(session, transaction):
+    # 回滚或未提交就关闭的会话不递增；scoped_session 复用会话对象，登记不能留到下一个事务
+    if transaction.parent is None:
+        session.info.pop(_PENDING, None)
+
+
+def resource_validators(session, names, scope: str | None = None) -> Validators:
+    """Weak ETag over the resources' versions and the request URL (filters/cursor)."""
+    rows = session.execute(select(ResourceVersion.name, ResourceVersion.version).where(ResourceVersion.name.in_(names))).all()
+    scope = request.full_path if scope is None else scope
+    raw = scope + "|" + ",".join(f"{name}:{version}" for name, version in sorted(rows))
+    return Validators(hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20])
+
+
+def content_validators(body: str) -> Validators:
+    """Weak ETag over a response body, for views whose scope is narrower than any resource version (traces)."""
+    return Validators(hashlib.sha1(body.encode("utf-8")).hexdigest()[:20])
+
+
+def not_modified(validators: Validators) -> Response | None:
+    """A 304 response if the client's If-None-Match still matches, else None."""
+    if not request.if_none_match or not request.if_none_match.contains_weak(validators.etag):
+        return None
+    return with_validators(Response(status=304), validators)
+
+
+def with_validators(resp: Response, validators: Validators) -> Response:
+    resp.set_etag(validators.etag, weak=True)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp